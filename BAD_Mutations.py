@@ -21,6 +21,7 @@ import sys
 #   To handle file copy
 import shutil
 import os
+import tempfile
 import pprint
 
 #   Import the dependency checking script
@@ -102,6 +103,11 @@ def fetch(arg, log):
         log.info('Fetching from Phytozome...')
         phy.get_xml_urls()
         phy.fetch_cds()
+        #   The new files are not databases yet, so the species catalog no
+        #   longer lists everything that has to be converted
+        if ens.to_convert or phy.to_convert:
+            import lrt_predict.General.catalog as catalog
+            catalog.mark_stale(arg['base'], log)
     else:
         log.debug('Downloading and converting Ensembl Plants files...')
         ens.get_ftp_urls()
@@ -111,6 +117,24 @@ def fetch(arg, log):
         phy.fetch_cds()
         ens.convert()
         phy.convert()
+    if arg['combined_db'] and not arg['fetch_only']:
+        log.info('Building the combined database...')
+        phy.build_combined()
+    return
+
+
+def check_blastp(arg, log):
+    """A function to check that blastp can be found if we are searching in
+    blastp mode. BLASTP is not in the configuration file if `setup' did not
+    find blastp, so we look for it on the PATH as well."""
+    if arg.get('search_mode') != 'blastp':
+        return
+    if not check_modules.check_executable(arg.get('blastp_path') or 'blastp'):
+        log.error(
+            '--search-mode blastp needs blastp, but it was not found. Please '
+            'install BLAST+ and set BLASTP in the configuration file, or '
+            'search with tblastx.')
+        exit(1)
     return
 
 
@@ -133,6 +157,7 @@ def blast(arg, log):
             'Some required executables were not found on your system: ' +
             '\n'.join(missing_reqs) + '\nPlease install them to continue.')
         exit(1)
+    check_blastp(arg, log)
     #   If all that checks out, import the BLAST class script
     import lrt_predict.Blast.blast_search as blast_search
     log.info('Creating a new instance to BLAST.')
@@ -141,98 +166,391 @@ def blast(arg, log):
         arg['target'],
         arg['fasta'],
         arg['evalue'],
-        arg['loglevel'])
+        arg['loglevel'],
+        workers=arg['blast_workers'],
+        cpus=arg['num_cpus'],
+        tblastx_path=arg['tblastx_path'],
+        cache_size=arg.get('blast_cache_size'),
+        search_mode=arg.get('search_mode'),
+        blastp_path=arg.get('blastp_path'),
+        combined=arg.get('combined_db'),
+        orthologs=True,
+        prefilter=arg.get('prefilter'))
     b_search.blast_all()
     #   hom contains the file object that has the unaligned sequence in it.
     hom = b_search.get_hit_seqs()
     return hom
 
 
-def align(arg, unaligned, log):
-    """A function to align the homologous sequences with pasta, and return
-    the aligned sequences and the phylogenetic tree."""
-    aligndeps = check_modules.check_modules(predict=True)
-    if aligndeps:
-        check_modules.missing_mods(aligndeps)
+def batch_blast(arg, log):
+    """A function to search the databases with a batch of query sequences at
+    once, and collect the homologous sequences for each of them. Returns a
+    list of tuples of query FASTA file and unaligned sequences, and the
+    temporary directory holding any queries split out of the batch."""
+    blastdeps = check_modules.check_modules(predict=True)
+    if blastdeps:
+        check_modules.missing_mods(blastdeps)
+        exit(1)
+    missing_reqs = check_modules.missing_executables(
+        [
+            arg['bash_path'],
+            arg['tblastx_path']
+        ])
+    if missing_reqs:
+        log.error(
+            'Some required executables were not found on your system: ' +
+            '\n'.join(missing_reqs) + '\nPlease install them to continue.')
+        exit(1)
+    check_blastp(arg, log)
+    import lrt_predict.General.parse_input as parse_input
+    import lrt_predict.Blast.batch_search as batch_search
+    #   Queries split out of a multi-record FASTA are written here
+    query_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Batch_')
+    queries = parse_input.read_batch(arg['batch'], query_dir, log)
+    if not queries:
+        log.error('The batch ' + arg['batch'] + ' does not contain any '
+                  'valid queries.')
+        shutil.rmtree(query_dir)
+        exit(1)
+    log.info('Creating a new instance to BLAST a batch of queries.')
+    b_search = batch_search.BatchBlastSearch(
+        arg['base'],
+        arg['target'],
+        queries,
+        arg['evalue'],
+        arg['loglevel'],
+        workers=arg['blast_workers'],
+        cpus=arg['num_cpus'],
+        tblastx_path=arg['tblastx_path'],
+        cache_size=arg.get('blast_cache_size'),
+        search_mode=arg.get('search_mode'),
+        blastp_path=arg.get('blastp_path'),
+        combined=arg.get('combined_db'),
+        orthologs=True,
+        prefilter=arg.get('prefilter'),
+        cluster_isoforms=arg.get('cluster_isoforms'))
+    b_search.blast_all()
+    return (b_search.get_hit_seqs(), query_dir)
+
+
+def orthologs(arg, log):
+    """A function to search every gene of the target species against the
+    other species databases, and save the best hits in the ortholog table.
+    Genes are searched in chunks, with one search of each database per
+    chunk."""
+    blastdeps = check_modules.check_modules(predict=True)
+    if blastdeps:
+        check_modules.missing_mods(blastdeps)
         exit(1)
-    #   Check for the required executables
     missing_reqs = check_modules.missing_executables(
         [
             arg['bash_path'],
-            arg['pasta_path']
+            arg['tblastx_path']
         ])
     if missing_reqs:
         log.error(
             'Some required executables were not found on your system: ' +
             '\n'.join(missing_reqs) + '\nPlease install them to continue.')
         exit(1)
+    check_blastp(arg, log)
+    import lrt_predict.General.parse_input as parse_input
+    import lrt_predict.General.catalog as catalog
+    import lrt_predict.Blast.batch_search as batch_search
+    import lrt_predict.Blast.ortholog_table as ortholog_table
+    target_cds = arg['target_cds']
+    if not target_cds:
+        #   Use the same test as BlastSearch uses to skip the target species
+        target_dbs = [
+            db for db in catalog.species_databases(arg['base'], log)
+            if arg['target'].upper() in db.upper()]
+        if len(target_dbs) != 1:
+            log.error(
+                'Could not find a single database for ' + arg['target'] +
+                ' in ' + arg['base'] + '. Please give the target species CDS '
+                'with --target-cds.')
+            exit(1)
+        target_cds = target_dbs[0]
+    log.info('Finding orthologues of the genes in ' + target_cds)
+    query_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Orthologs_')
+    queries = parse_input.read_batch(target_cds, query_dir, log)
+    if not queries:
+        log.error('Could not read any genes from ' + target_cds)
+        shutil.rmtree(query_dir)
+        exit(1)
+    rows = []
+    chunk = arg['chunk_size']
+    for start in range(0, len(queries), chunk):
+        log.info(
+            'Searching genes ' + str(start + 1) + ' to ' +
+            str(min(start + chunk, len(queries))) + ' of ' +
+            str(len(queries)) + '.')
+        #   The table takes the place of the hit cache here
+        b_search = batch_search.BatchBlastSearch(
+            arg['base'],
+            arg['target'],
+            queries[start:start + chunk],
+            arg['evalue'],
+            arg['loglevel'],
+            workers=arg['blast_workers'],
+            cpus=arg['num_cpus'],
+            tblastx_path=arg['tblastx_path'],
+            cache_size=0,
+            search_mode=arg.get('search_mode'),
+            blastp_path=arg.get('blastp_path'),
+            combined=arg.get('combined_db'),
+            orthologs=False,
+            prefilter=arg.get('prefilter'))
+        b_search.blast_all()
+        rows.extend(b_search.ortholog_rows())
+    shutil.rmtree(query_dir)
+    table = ortholog_table.OrthologTable(
+        arg['base'],
+        arg['target'],
+        arg['loglevel'])
+    table.write(rows)
+    return
+
+
+def align(arg, queries, log):
+    """A function to align the homologous sequences, and return the aligned
+    sequences and the phylogenetic tree. queries is a list of (query FASTA
+    file, unaligned sequences) tuples, which are aligned at once by a pool of
+    aligner jobs. The aligner is given by --aligner, or picked for each query
+    from its number and length of sequences. If a species tree is given, it
+    is pruned to the species of each query, and used as the guide tree of the
+    aligner, or as the output tree."""
+    aligndeps = check_modules.check_modules(predict=True)
+    if aligndeps:
+        check_modules.missing_mods(aligndeps)
+        exit(1)
     #   Then we import the necessary modules
     import lrt_predict.Predict.align as aligner
-    log.info('Creating a new instance of PastaAlign.')
-    aln = aligner.PastaAlign(
-        arg['pasta_path'],
-        unaligned,
-        arg['fasta'],
+    import lrt_predict.Predict.align_pool as align_pool
+    import lrt_predict.Predict.align_cache as align_cache
+    import lrt_predict.Predict.species_tree as species_tree
+    backend = arg.get('aligner') or 'auto'
+    paths = {
+        'pasta': arg.get('pasta_path'),
+        'prank': arg.get('prank_path')}
+    available = [
+        name for name in aligner.ALIGNERS
+        if paths[name] and check_modules.check_executable(paths[name])]
+    #   Check for the required executables
+    required = [arg['bash_path']]
+    if backend != 'auto':
+        required.append(paths[backend] or backend)
+    missing_reqs = check_modules.missing_executables(required)
+    if missing_reqs:
+        log.error(
+            'Some required executables were not found on your system: ' +
+            '\n'.join(missing_reqs) + '\nPlease install them to continue.')
+        exit(1)
+    if not available:
+        log.error(
+            'No aligner was found on your system. Please install PASTA or '
+            'PRANK, and set PASTA or PRANK in the configuration file.')
+        exit(1)
+
+    #   Read the species tree once, for all queries
+    if arg.get('species_tree'):
+        if not os.path.isfile(arg['species_tree']):
+            log.error(
+                'The species tree ' + arg['species_tree'] + ' does not exist.')
+            exit(1)
+        sp_tree = species_tree.read_tree(arg['species_tree'])
+        tree_mode = arg.get('species_tree_mode') or 'guide'
+    else:
+        sp_tree = None
+
+    def choose(query_file, unaligned):
+        """Return the name of the aligner to use for a query."""
+        if backend != 'auto':
+            return backend
+        n_seqs, max_length = aligner.input_size(unaligned.name)
+        return aligner.choose_aligner(n_seqs, max_length, available)
+
+    def make_aligner(name, unaligned, query_file):
+        """Create an aligner for a query, and prepare its sequences."""
+        align_class = aligner.ALIGNERS[name]
+        log.info('Creating a new instance of ' + align_class.__name__ +
+                 ' for ' + query_file)
+        aln = align_class(
+            paths[name],
+            unaligned,
+            query_file,
+            arg['loglevel'])
+        #   Prepare the sequences for alignment:
+        #       Check length is multiple of 3
+        #       Translate to protein
+        #       Remove STOP codons
+        aln.prepare_sequences()
+        if sp_tree:
+            aln.use_species_tree(sp_tree, arg.get('target') or '', tree_mode)
+        return aln
+
+    cache = align_cache.AlignCache(
+        arg['base'],
+        arg.get('align_cache_size'),
+        arg['loglevel'])
+    pool = align_pool.AlignmentPool(
+        arg['num_cpus'],
+        arg.get('pasta_cpus'),
+        arg.get('pasta_heap'),
         arg['loglevel'])
-    #   Prepare the sequences for alignment:
-    #       Check length is multiple of 3
-    #       Translate to protein
-    #       Remove STOP codons
-    aln.prepare_sequences()
-    #   Then align them
-    stdout, stderr = aln.pasta_align()
-    log.debug('stdout: \n' + stdout)
-    log.debug('stderr: \n' + stderr)
-    #   Backtranslate the alignment
-    aln.back_translate()
-    #   Then sanitize the alignment and tree
-    aln.sanitize_outputs()
-    #   Then copy them over
+    if arg.get('benchmark'):
+        #   Run every aligner on every query, and keep the outputs of the one
+        #   that would have been used
+        import lrt_predict.Predict.benchmark as benchmark
+        jobs, rows = benchmark.run_benchmark(
+            queries,
+            available,
+            make_aligner,
+            choose,
+            pool,
+            log)
+        benchmark.write_report(arg['output'], rows, log)
+        updated = []
+    else:
+        jobs = []
+        updated = []
+        for query_file, unaligned in queries:
+            aln = make_aligner(choose(query_file, unaligned), unaligned,
+                               query_file)
+            #   If the same sequences have been aligned before, copy the
+            #   cached alignment and tree instead of aligning
+            cached = cache.get(aln) if cache.max_entries else None
+            if cached:
+                copy_outputs(
+                    arg['output'],
+                    aln.query,
+                    cached[0],
+                    cached[1],
+                    log)
+                if aln.work_dir:
+                    shutil.rmtree(aln.work_dir)
+                continue
+            #   Otherwise, try to update the alignment from an earlier run
+            if arg.get('incremental'):
+                old_msa, old_tree = output_names(arg['output'], aln.query)
+                if os.path.isfile(old_msa) and os.path.isfile(old_tree):
+                    log.info('Updating earlier alignment ' + old_msa)
+                    if aln.incremental_update(
+                            old_msa,
+                            old_tree,
+                            arg.get('max_divergence')):
+                        updated.append(aln)
+                        continue
+            jobs.append(aln)
+        #   Then align them, back-translate the alignments, and sanitize the
+        #   alignments and trees. Jobs that failed are skipped, so that the
+        #   other alignments are still saved.
+        results = pool.align_all(jobs)
+        failed = [
+            aln for aln, result in zip(jobs, results) if result is None]
+        if failed:
+            log.error(
+                str(len(failed)) + ' of ' + str(len(jobs)) + ' alignments '
+                'failed, and were not saved: ' + ', '.join(
+                    [os.path.basename(aln.query) for aln in failed]))
+        jobs = [aln for aln in jobs if aln not in failed]
+    #   Then save them in the cache, and copy them over
+    for aln in updated + jobs:
+        if cache.max_entries:
+            cache.put(aln)
+        save_alignment(arg['output'], aln, log)
+    if cache.max_entries:
+        cache.evict()
+    return
+
+
+def save_alignment(output, aln, log):
+    """Copy the nucleotide alignment and the tree of a finished Aligner
+    job into the output directory, named after its query file."""
     log.info('Nucleotide alignment in ' + aln.final_aln)
     log.info('Tree in ' + aln.tree_out)
+    copy_outputs(output, aln.query, aln.final_aln, aln.tree_out, log)
+    #   Cleanup the temporary files
+    os.remove(aln.final_aln)
+    shutil.rmtree(aln.work_dir)
+    return
+
+
+def output_names(output, query):
+    """Return the names of the alignment and tree of a query in the output
+    directory."""
     new_nuc = os.path.join(
-        arg['output'],
+        output,
         os.path.basename(
-            arg['fasta'].replace(
+            query.replace(
                 '.fasta',
                 '_MSA.fasta')
             )
         )
     new_tree = os.path.join(
-        arg['output'],
+        output,
         os.path.basename(
-            arg['fasta'].replace('.fasta', '.tree')
+            query.replace('.fasta', '.tree')
             )
         )
+    return (new_nuc, new_tree)
+
+
+def copy_outputs(output, query, msa, tree, log):
+    """Copy a nucleotide alignment and tree into the output directory, named
+    after the query file."""
+    new_nuc, new_tree = output_names(output, query)
     open(new_nuc, 'w').close()
     open(new_tree, 'w').close()
-    shutil.copy2(aln.final_aln, new_nuc)
-    shutil.copy2(aln.tree_out, new_tree)
+    shutil.copy2(msa, new_nuc)
+    shutil.copy2(tree, new_tree)
     log.info('MSA copied to ' + new_nuc)
     log.info('Tree copied to ' + new_tree)
-    #   Cleanup the temporary file
-    os.remove(aln.final_aln)
     return
 
 
-def predict(arg, log):
-    """A function to run the HYPHY codon prediction model on each column of
-    the alignment and return a score for each one."""
-    predictdeps = check_modules.check_modules(predict=True)
+def check_predict_deps(arg, engine, log):
+    """A function to check for the modules and executables that the
+    prediction engine needs, and exit if any are missing."""
+    predictdeps = check_modules.check_modules(
+        predict=True,
+        native=(engine == 'native'))
     if predictdeps:
         check_modules.missing_mods(predictdeps)
         exit(1)
-    #   Check for the required executables
-    missing_reqs = check_modules.missing_executables(
-        [
-            arg['bash_path'],
-            arg['hyphy_path']
-        ])
+    if engine == 'native':
+        return
+    #   Check for the required executables. Batches keep HyPhy running, and
+    #   need stdbuf to read each report as soon as it is written.
+    required = [arg['bash_path'], arg['hyphy_path']]
+    if arg.get('batch'):
+        required.append('stdbuf')
+    missing_reqs = check_modules.missing_executables(required)
     if missing_reqs:
         log.error(
             'Some required executables were not found on your system: ' +
             '\n'.join(missing_reqs) + '\nPlease install them to continue.')
         exit(1)
+    return
+
+
+def predict(arg, log):
+    """A function to run the HYPHY codon prediction model on each column of
+    the alignment and return a score for each one. With the native engine,
+    the same model is fit in Python, without HyPhy."""
+    engine = arg.get('engine') or 'hyphy'
+    check_predict_deps(arg, engine, log)
+    if engine == 'native':
+        import lrt_predict.Predict.native_lrt as native_lrt
+        lrt = native_lrt.NativeLRT(
+            arg['alignment'],
+            arg['tree'],
+            arg['fasta'],
+            arg['substitutions'],
+            arg['loglevel'],
+            refit=arg.get('refit'))
+        lrt.get_query_position()
+        lrt.get_aligned_positions()
+        return lrt.predict_codons()
     #   import the predict script
     import lrt_predict.Predict.predict as predictor
     #   Create a new instance of class LRTPredict
@@ -242,15 +560,97 @@ def predict(arg, log):
         arg['tree'],
         arg['fasta'],
         arg['substitutions'],
-        arg['loglevel'])
+        arg['loglevel'],
+        full_scan=arg.get('full_scan'),
+        refit=arg.get('refit'))
     lrt.get_query_position()
     lrt.get_aligned_positions()
-    lrt.write_aligned_subs()
+    workers = arg.get('workers') or 1
+    if workers > 1:
+        return lrt.predict_sharded(workers)
     lrt.prepare_hyphy_inputs()
     outputfile = lrt.predict_codons()
     return outputfile
 
 
+def predict_batch(arg, log):
+    """A function to predict a batch of genes. With HyPhy, the genes are sent
+    to HyPhy processes that stay up between genes, so that LRT.hyphy sets up
+    the codon model once per process. Each prediction is written into the
+    output directory as it is finished."""
+    import lrt_predict.General.parse_input as parse_input
+    genes = parse_input.read_predict_batch(arg['batch'], log)
+    if not genes:
+        log.error('The batch ' + arg['batch'] + ' does not list any genes.')
+        exit(1)
+    engine = arg.get('engine') or 'hyphy'
+    check_predict_deps(arg, engine, log)
+    if engine == 'native':
+        import lrt_predict.Predict.native_lrt as native_lrt
+        for fasta, msa, tree, subs in genes:
+            lrt = native_lrt.NativeLRT(
+                msa,
+                tree,
+                fasta,
+                subs,
+                arg['loglevel'],
+                refit=arg.get('refit'))
+            lrt.get_query_position()
+            lrt.get_aligned_positions()
+            save_prediction(arg['output'], fasta, lrt.predict_codons(), log)
+        return
+    import lrt_predict.Predict.predict as predictor
+    import lrt_predict.Predict.hyphy_pool as hyphy_pool
+    pool = hyphy_pool.HyPhyWorkerPool(
+        arg['hyphy_path'],
+        arg.get('workers') or 1,
+        arg['loglevel'])
+    #   Genes are prepared a few at a time for each worker, so that the
+    #   alignments and temporary files of a large batch are not all open at
+    #   once
+    chunk = 10 * pool.n_workers
+    try:
+        for start in xrange(0, len(genes), chunk):
+            lrts = []
+            for fasta, msa, tree, subs in genes[start:start+chunk]:
+                lrt = predictor.LRTPredict(
+                    arg['hyphy_path'],
+                    msa,
+                    tree,
+                    fasta,
+                    subs,
+                    arg['loglevel'],
+                    full_scan=arg.get('full_scan'),
+                    refit=arg.get('refit'))
+                lrt.get_query_position()
+                lrt.get_aligned_positions()
+                lrt.prepare_hyphy_inputs()
+                lrts.append((fasta, lrt))
+            finished = pool.run_all(
+                [(lrt.hyphy_input, lrt.hyphy_output) for fasta, lrt in lrts])
+            for (fasta, lrt), done in zip(lrts, finished):
+                if not done:
+                    log.error('No prediction was made for ' + fasta + '.')
+                    continue
+                lrt.keep_fit()
+                save_prediction(arg['output'], fasta, lrt.hyphy_output, log)
+    finally:
+        pool.close()
+    return
+
+
+def save_prediction(output, fasta, out, log):
+    """A function to copy a prediction into the output directory, named after
+    the query FASTA file."""
+    out_fname = os.path.join(
+        output,
+        os.path.basename(fasta.replace('.fasta', '_Predictions.txt')))
+    open(out_fname, 'w').close()
+    shutil.copy2(out.name, out_fname)
+    log.info('Prediction in ' + out_fname)
+    return
+
+
 def compile_preds(arg, log):
     """A function to compile a directory full of HyPhy reports, and write a
     single report with all the necessary prediction information."""
@@ -346,31 +746,37 @@ def main():
             setup(arguments_valid)
         elif arguments_valid['action'] == 'fetch':
             fetch(arguments_valid, loglevel)
+        elif arguments_valid['action'] == 'orthologs':
+            orthologs(arguments_valid, loglevel)
         elif arguments_valid['action'] == 'align':
-            #   We will return the filename that contains the unaligned
-            #   sequences, as we will use these as inputs for pasta
-            unaligned_seqs = blast(arguments_valid, loglevel)
-            #   Then add the query sequence and align them
-            align(
-                arguments_valid,
-                unaligned_seqs,
-                loglevel)
+            if arguments_valid['batch']:
+                #   Search all of the queries at once, then align them all
+                #   at once
+                batch, query_dir = batch_blast(arguments_valid, loglevel)
+                align(arguments_valid, batch, loglevel)
+                shutil.rmtree(query_dir)
+            else:
+                #   We will return the filename that contains the unaligned
+                #   sequences, as we will use these as inputs for pasta
+                unaligned_seqs = blast(arguments_valid, loglevel)
+                #   Then add the query sequence and align them
+                align(
+                    arguments_valid,
+                    [(arguments_valid['fasta'], unaligned_seqs)],
+                    loglevel)
         elif arguments_valid['action'] == 'predict':
-            out = predict(arguments_valid, loglevel)
-            #   copy the output file into the destination directory
-            #   To build the output filename, we join the output directory
-            #   with a new name based on the input filename
-            out_fname = os.path.join(
-                arguments_valid['output'],
-                os.path.basename(
-                    arguments_valid['fasta'].replace(
-                        '.fasta',
-                        '_Predictions.txt')
-                    )
-                )
-            open(out_fname, 'w').close()
-            shutil.copy2(out.name, out_fname)
-            loglevel.info('Prediction in ' + out_fname)
+            if arguments_valid['batch']:
+                predict_batch(arguments_valid, loglevel)
+            else:
+                out = predict(arguments_valid, loglevel)
+                #   copy the output file into the destination directory
+                #   To build the output filename, we join the output directory
+                #   with a new name based on the input filename
+                save_prediction(
+                    arguments_valid['output'],
+                    arguments_valid['fasta'],
+                    out,
+                    loglevel)
         elif arguments_valid['action'] == 'compile':
             compile_preds(arguments_valid, loglevel)
             return
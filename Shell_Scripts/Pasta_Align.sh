@@ -6,10 +6,6 @@ set -e
 set -u
 set -o pipefail
 
-#   We have to set this environment variable to increase the java heap space,
-#   else it runs out of memory someitmes and fails to finish an alignment.
-export _JAVA_OPTIONS="-Xmx4g"
-
 #   Path to the Pasta executable as an argument
 PASTA=$1
 #   Input sequence as an argument
@@ -18,13 +14,33 @@ INPUT=$2
 TEMP_DIR=$3
 #   Job name
 JOBNAME=$4
+#   Number of CPUs for Pasta to use. Defaults to 1.
+CPUS=${5:-1}
+#   Java heap size, such as 4g or 2048m. Defaults to 4g.
+HEAP=${6:-4g}
+#   Starting tree, which replaces the first tree estimate. Optional.
+START_TREE=${7:-}
+#   Number of iterations. Defaults to 5.
+ITER_LIMIT=${8:-5}
+
+#   Only give Pasta a starting tree if we have one
+TREE_OPTS=()
+if [ -n "${START_TREE}" ]
+    then
+        TREE_OPTS=(-t "${START_TREE}")
+fi
+
+#   We have to set this environment variable to increase the java heap space,
+#   else it runs out of memory someitmes and fails to finish an alignment.
+export _JAVA_OPTIONS="-Xmx${HEAP}"
 
 $PASTA \
     -d protein\
     --no-return-final-tree-and-alignment\
-    --num-cpus=1\
+    --num-cpus=${CPUS}\
     --job=$JOBNAME\
-    --iter-limit=5\
+    --iter-limit=${ITER_LIMIT}\
     --temporaries=${TEMP_DIR}\
+    ${TREE_OPTS[@]+"${TREE_OPTS[@]}"}\
     -i $INPUT\
     -o ${TEMP_DIR}
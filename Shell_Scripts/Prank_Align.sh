@@ -16,5 +16,12 @@ INPUT=$2
 OUTPUT=$3
 #   Model type as argument
 MODEL=$4
+#   Guide tree, which replaces the one PRANK estimates. Optional.
+GUIDE_TREE=${5:-}
 
-$PRANK -d=$INPUT -o=$OUTPUT -$MODEL -F -showtree
+if [ -n "${GUIDE_TREE}" ]
+    then
+        $PRANK -d=$INPUT -o=$OUTPUT -t=$GUIDE_TREE -$MODEL -F -showtree
+    else
+        $PRANK -d=$INPUT -o=$OUTPUT -$MODEL -F -showtree
+fi
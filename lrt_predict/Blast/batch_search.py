@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""A script to BLAST search many query sequences at once."""
+
+#   Import standard library modules here
+import re
+import tempfile
+from collections import OrderedDict
+
+#   Import the Biopython library
+from Bio import SeqIO
+
+#   Import the single-query class that we build on
+from lrt_predict.Blast import blast_search
+
+
+class BatchBlastSearch(blast_search.BlastSearch):
+    """A class to search a batch of query sequences against the plant CDS
+    databases. All of the queries are written into one multi-record FASTA
+    file, and each species database is searched once with all of them. The
+    BLAST output is then split up by query ID into one set of orthologues for
+    each query.
+
+    Contains the following instance attributes, in addition to those of
+    BlastSearch:
+        query_files (OrderedDict)   Single-record FASTA file for each query
+                                    ID, in the order they were given
+        records (OrderedDict)       Query ID -> query SeqRecord
+        members (OrderedDict)       Query ID of each searched query -> IDs
+                                    of the other isoforms it stands for
+        search_args (dict)          Keyword settings, for searching doubtful
+                                    isoforms again
+        batch_query (file)          Temporary file holding all queries
+        orthologues (OrderedDict)   Query ID -> (database -> hit IDs)
+
+    Overrides the following methods of BlastSearch:
+        search_database():
+            Look up the cached hits for each query, and search the database
+            with only those queries that are not in the cache.
+
+        query_hit():
+            Keep the hits for all queries from search_combined().
+
+        remap_hits():
+            Map the hits of all queries in prefiltered candidates back to
+            database IDs.
+
+        get_seq_id():
+            Find the best hit for every query in the tabular BLAST report.
+            Returns a dictionary of query ID -> hit title.
+
+        store_hit():
+            Save the best hit for each query into its own orthologues.
+
+        get_hit_seqs():
+            Write a file of unaligned sequences for each query that has any
+            hits. Returns a list of (query file, unaligned sequences) tuples.
+
+        blast_all():
+            Search the queries, then share the hits of each representative
+            with the other isoforms in its cluster.
+
+    And adds the following methods:
+        cluster_queries():
+            Group the queries into clusters of isoforms of the same gene.
+
+        share_hits():
+            Give the hits of each representative to the other isoforms, and
+            search again with those whose hits are doubtful.
+
+        ortholog_rows():
+            Return the best hits of every query in every database, for
+            writing into the ortholog table.
+    """
+
+    #   Suffixes that mark isoforms of the same gene, such as .1, _T01, or -RA
+    ISOFORM_SUFFIX = re.compile(r'(\.\d+|_T\d+|-R[A-Z])$')
+    #   Members shorter or longer than this fraction of their representative
+    #   are searched on their own
+    MIN_LENGTH_RATIO = 0.9
+    #   Hits of the representative with an E-value above this fraction of the
+    #   threshold are doubtful
+    WEAK_HIT = 1e-3
+
+    def __init__(
+            self,
+            base,
+            target,
+            queries,
+            evalue,
+            verbose,
+            workers=None,
+            cpus=None,
+            tblastx_path=None,
+            cache_size=None,
+            search_mode=None,
+            blastp_path=None,
+            combined=False,
+            orthologs=True,
+            prefilter=None,
+            cluster_isoforms=False):
+        """Initialize the class with a list of single-record query FASTA
+        files. If cluster_isoforms is True, only one query of each cluster of
+        isoforms is searched. The other arguments are the same as those of
+        BlastSearch."""
+        self.query_files = OrderedDict()
+        self.records = OrderedDict()
+        for qfile in queries:
+            rec = SeqIO.read(qfile, 'fasta')
+            self.query_files[rec.id] = qfile
+            self.records[rec.id] = rec
+        #   Keep the settings, for searching again with doubtful isoforms
+        self.search_args = dict(
+            workers=workers,
+            cpus=cpus,
+            tblastx_path=tblastx_path,
+            cache_size=cache_size,
+            search_mode=search_mode,
+            blastp_path=blastp_path,
+            combined=combined,
+            orthologs=orthologs,
+            prefilter=prefilter)
+        if cluster_isoforms:
+            self.members = self.cluster_queries(self.records)
+        else:
+            self.members = OrderedDict(
+                [(qid, []) for qid in self.records])
+        #   Write the queries that are searched into one file, to be used as
+        #   the BLAST query
+        self.batch_query = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_BatchQuery_',
+            suffix='.fasta')
+        SeqIO.write(
+            [self.records[qid] for qid in self.members],
+            self.batch_query,
+            'fasta')
+        self.batch_query.flush()
+        blast_search.BlastSearch.__init__(
+            self,
+            base,
+            target,
+            self.batch_query.name,
+            evalue,
+            verbose,
+            **self.search_args)
+        self.orthologues = OrderedDict(
+            [(qid, OrderedDict()) for qid in self.query_files])
+        if cluster_isoforms:
+            self.mainlog.info(
+                'Clustered ' + str(len(self.query_files)) + ' queries into ' +
+                str(len(self.members)) + ' genes.')
+        self.mainlog.info(
+            'Searching ' + str(len(self.members)) + ' queries at once.')
+        return
+
+    def cluster_queries(self, records):
+        """Group the queries into clusters of isoforms. Two queries are in the
+        same cluster if their IDs are the same once the isoform suffix is
+        removed, or if their sequences are identical. The longest query of
+        each cluster represents it. Returns an ordered dictionary of
+        representative ID -> list of the other member IDs."""
+        parent = dict([(qid, qid) for qid in records])
+
+        def find(qid):
+            """Find the root of the cluster of a query."""
+            while parent[qid] != qid:
+                parent[qid] = parent[parent[qid]]
+                qid = parent[qid]
+            return qid
+
+        first_seen = {}
+        for qid, rec in records.iteritems():
+            keys = [
+                ('gene', self.ISOFORM_SUFFIX.sub('', qid)),
+                ('seq', str(rec.seq).upper())]
+            for key in keys:
+                if key in first_seen:
+                    parent[find(qid)] = find(first_seen[key])
+                else:
+                    first_seen[key] = qid
+        groups = OrderedDict()
+        for qid in records:
+            groups.setdefault(find(qid), []).append(qid)
+        members = OrderedDict()
+        for group in groups.values():
+            #   max() keeps the first of equally long queries
+            rep = max(group, key=lambda q: len(records[q].seq))
+            members[rep] = [qid for qid in group if qid != rep]
+        return members
+
+    def blast_all(self):
+        """Search the representative of each cluster, then give its hits to
+        the other members of the cluster."""
+        blast_search.BlastSearch.blast_all(self)
+        self.share_hits()
+        return
+
+    def share_hits(self):
+        """Give the hits of each representative to the other members of its
+        cluster. Members are searched on their own if they are much shorter
+        or longer than the representative, or if any hit of the
+        representative is close to the E-value threshold. Hits that came
+        from the hit cache or the ortholog table have no E-value, so they
+        could be close to the threshold, and are doubtful too. The members
+        are then looked up in the cache and table themselves, so this only
+        runs BLAST for members that were never searched."""
+        doubtful = []
+        for rep, members in self.members.iteritems():
+            if not members:
+                continue
+            weak = [
+                db for db in self.orthologues[rep]
+                if self.hit_evalues.get((rep, db), self.evalue) >
+                self.evalue * self.WEAK_HIT]
+            rep_len = len(self.records[rep].seq)
+            for qid in members:
+                self.orthologues[qid] = OrderedDict(self.orthologues[rep])
+                qlen = len(self.records[qid].seq)
+                ratio = float(min(qlen, rep_len)) / max(qlen, rep_len, 1)
+                if weak or ratio < self.MIN_LENGTH_RATIO:
+                    doubtful.append(qid)
+        if not doubtful:
+            return
+        self.mainlog.info(
+            'Searching ' + str(len(doubtful)) + ' isoforms again, since the '
+            'hits of their representatives are doubtful.')
+        check = BatchBlastSearch(
+            self.basedir,
+            self.target,
+            [self.query_files[qid] for qid in doubtful],
+            self.evalue,
+            self.verbose,
+            **self.search_args)
+        check.blast_all()
+        for qid in doubtful:
+            self.orthologues[qid] = check.orthologues[qid]
+        return
+
+    def search_database(self, database):
+        """Search one database with every query that does not have a cached
+        hit in it. Returns a tuple of the database and a dictionary of query
+        ID -> title of the best hit."""
+        best = {}
+        to_search = []
+        program = self.search_program(database)
+        key = self.cache_key(database, program)
+        for qid, query_seq in self.query_seqs.iteritems():
+            if self.cache:
+                found, hit = self.cache.get(
+                    query_seq,
+                    database,
+                    self.evalue,
+                    key)
+                if found:
+                    if hit:
+                        best[qid] = hit
+                    continue
+            to_search.append(qid)
+        if not to_search:
+            return (database, best)
+        hits = self.run_search(database, program, to_search)
+        for qid in to_search:
+            if self.cache:
+                self.cache.put(
+                    self.query_seqs[qid],
+                    database,
+                    self.evalue,
+                    key,
+                    hits.get(qid))
+            if qid in hits:
+                best[qid] = hits[qid]
+        return (database, best)
+
+    def query_hit(self, hits):
+        """The hits for every query are kept together."""
+        return hits
+
+    def remap_hits(self, hits, sid_map):
+        """Map the hit of each query back to database IDs."""
+        if hits is None:
+            return {}
+        return dict([
+            (qid, blast_search.BlastSearch.remap_hits(self, hit, sid_map))
+            for qid, hit in hits.iteritems()])
+
+    def get_seq_id(self, blast_proc, searched=None):
+        """Get the best hit for each query out of the tabular BLAST report.
+        The report is sorted by E-value within each query, so the first hit
+        that passes the threshold is the best one, and the rest of the hits
+        for that query are skipped. searched is the list of query IDs that
+        were in the search, and defaults to all of them."""
+        if searched is None:
+            searched = self.query_seqs.keys()
+        self.mainlog.debug('Beginning to parse the BLAST output for ' +
+                           self.query + '.')
+        best = {}
+        stopped_early = False
+        for line in iter(blast_proc.stdout.readline, ''):
+            qid, title, evalue = self.parse_hit(line)
+            #   BLAST may show the query IDs as local IDs
+            if qid.startswith('lcl|'):
+                qid = qid[4:]
+            if qid in best or evalue > self.evalue:
+                continue
+            self.mainlog.debug('Saving ' + title + ' as best hit for ' + qid)
+            best[qid] = title
+            self.hit_evalues[(qid, blast_proc.database)] = evalue
+            #   Once every query has a hit, there is nothing left to read
+            if len(best) == len(searched):
+                stopped_early = True
+                break
+        self.finish_blast(blast_proc, stopped_early)
+        self.mainlog.info(
+            'Found hits for ' + str(len(best)) + ' of ' +
+            str(len(searched)) + ' queries.')
+        return best
+
+    def store_hit(self, blast_db, homologous_locus):
+        """Save the best hit for each query into its own orthologues."""
+        for qid, locus in homologous_locus.iteritems():
+            if qid not in self.orthologues:
+                self.mainlog.warning(
+                    'BLAST returned unknown query ID ' + qid + '. Skipping.')
+                continue
+            fasta_info = locus.split(' ')
+            self.orthologues[qid][blast_db] = (fasta_info[0], fasta_info[1])
+        return
+
+    def get_hit_seqs(self):
+        """Write the unaligned sequences for each query. Queries without any
+        hits are skipped with a warning, rather than stopping the batch. The
+        hits of all queries are fetched together, so that each database is
+        only read once."""
+        hits = []
+        for qid in self.query_files:
+            hits.extend(self.orthologues[qid].items())
+        hit_seqs = self.fetch_hit_seqs(hits)
+        unaligned = []
+        for qid, qfile in self.query_files.iteritems():
+            if len(self.orthologues[qid]) == 0:
+                self.mainlog.warning(
+                    'Could not find any BLAST hits for ' + qid + '. Skipping.')
+                continue
+            unaligned.append(
+                (qfile, self.write_hit_seqs(
+                    qfile,
+                    self.orthologues[qid],
+                    hit_seqs)))
+        return unaligned
+
+    def ortholog_rows(self):
+        """Return the best hits of each query in a form that can be written
+        into the ortholog table. Every database that was searched gets a row,
+        whether or not it had a hit."""
+        rows = []
+        for qid in self.query_files:
+            hits = []
+            for database in self.searched:
+                hit = self.orthologues[qid].get(database)
+                if hit:
+                    hit = hit[0] + ' ' + hit[1]
+                hits.append((database, self.program, self.evalue, hit))
+            rows.append((qid, str(self.records[qid].seq), hits))
+        return rows
@@ -3,12 +3,15 @@
 
 #   Import standard library modules here
 import tempfile
+import subprocess
+import logging
 import os
 import re
+from StringIO import StringIO
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 #   Import the Biopython library
-from Bio.Blast.Applications import NcbitblastxCommandline
-from Bio.Blast import NCBIXML
 from Bio import SeqIO
 
 #   Import the script to give verbose messages
@@ -19,6 +22,20 @@ from lrt_predict.General import file_funcs
 from lrt_predict.General import check_modules
 #   For fetching sequences from the BLAST databases
 from lrt_predict.Blast import sequence_fetch
+#   For checking how many CPUs we can use
+from lrt_predict.General import resources
+#   For listing the species databases
+from lrt_predict.General import catalog
+#   For searching all species at once
+from lrt_predict.Blast import combined_db
+#   For looking up known orthologues
+from lrt_predict.Blast import ortholog_table
+#   For picking candidate sequences before searching
+from lrt_predict.Blast import kmer_index
+#   For saving hits between runs
+from lrt_predict.Blast import hit_cache
+#   For translating queries
+from lrt_predict.General import translation
 
 
 #   A class to handle our BLAST searches
@@ -30,227 +47,791 @@ class BlastSearch(object):
     The only functions that are designed to be called from outside the class
     are blast_all() and get_hit_seqs(). The others support the main two.
 
-    best_hit():
-        Iterates through a BlastRecord object, and returns the best (lowest
-        E-value) hit.
+    run_blast():
+        Starts tblastx with a query sequence on a databse, or blastp with the
+        translated query on the translated database. The tabular report is
+        written to a pipe, rather than a file. Returns the running process.
 
-    gen_output():
-        Creates a temporary file for storing BLAST output. Returns a filename
+    translate():
+        Translate a CDS into protein.
 
-    run_blast():
-        Runs tblastx with a query sequence on a databse. Uses the filename
-        from gen_output() to save the XML report. Returns the filename with
-        the NCBI XML BLAST output.
+    has_kmer_index():
+        Check for an up to date k-mer index of a database.
+
+    prefilter_subject():
+        Write the sequences of a database that share the most k-mers with
+        the queries into a FASTA file, to be searched instead of the whole
+        database.
+
+    db_size():
+        Return the size of a database, for E-values of prefiltered searches.
+
+    cache_key():
+        Return the program name that cached hits are keyed on.
+
+    run_search():
+        Search a database, through the prefilter if there is a k-mer index,
+        and parse the best hit out of the report.
+
+    remap_hits():
+        Map hits in the prefiltered candidates back to database IDs.
+
+    search_program():
+        Decide which program to search a database with. blastp is only used
+        if the translated protein database has been built.
+
+    query_file():
+        Return a FASTA file of query sequences for a search program,
+        translated if the program is blastp.
+
+    parse_hit():
+        Split a line of the tabular report into the query ID, the title of
+        the hit, and the E-value.
 
     get_seq_id():
-        Read through the BLAST XML and find the BlastRecord that has the
-        lowest E-value. Feed that BlastRecord to best_hit(), and return the
-        sequence ID of the hit.
+        Read the tabular report from the tblastx pipe, and stop at the first
+        hit that passes the E-value threshold. The report is sorted by
+        E-value, so this is the best hit. Returns the title of the hit.
+
+    finish_blast():
+        Close the pipe to tblastx and wait for it to exit.
+
+    balance_workers():
+        Decide how many databases to search at once, and how many threads
+        each tblastx process gets, so that the CPUs are all used without
+        being oversubscribed.
+
+    search_database():
+        Run and parse the BLAST search against a single database, or look up
+        the hit in the cache if the same search has been run before. This is
+        what each worker in the pool runs.
 
     blast_all():
         BLAST search the provided query sequence against each species databse.
-        Return the list of best BLAST hits.
+        The searches are run concurrently on a pool of workers, and the best
+        hits are saved in database order.
+
+    search_combined():
+        Search every species at once in the combined database, and take the
+        best hit in each species. E-values are scaled to what they would be
+        in a search of the species database alone.
+
+    query_hit():
+        Pick out the hit for the query from a dictionary of query ID -> hit,
+        as given by search_combined() and the ortholog table.
+
+    store_hit():
+        Save the best hit from one database into the orthologues.
 
     get_hit_seqs():
         Using the output from blast_all(), get the FASTA sequence of each of
         the homologous sequences and write them into a temporary file.
+
+    fetch_hit_seqs():
+        Fetch the sequences of hits, grouped by database, so that each
+        database is only read once. Returns a dictionary of
+        (database, sequence ID) -> sequence.
+
+    load_offset_index():
+        Read the byte offset index of a database FASTA file, for fetching
+        sequences when blastdbcmd is not available.
+
+    write_hit_seqs():
+        Write the sequences of a set of orthologues, along with their query
+        sequence, into a temporary file.
     """
+    #   The fields that we ask for in the tabular BLAST report. The title
+    #   has spaces in it, so it has to be the last field.
+    TABULAR_FIELDS = 'qseqid sseqid evalue bitscore stitle'
+    #   The search programs that we support
+    SEARCH_MODES = ['tblastx', 'blastp']
+    #   Default maximum number of cached hits
+    CACHE_SIZE = 100000
+    #   Number of targets to report for each species in a search of the
+    #   combined database. The limit is shared by all species, and a search
+    #   of one species only needs 5, but a species with many paralogues of
+    #   the query can take up more than its share and push the best hit of
+    #   another species out of the report.
+    COMBINED_TARGETS = 100
 
-    def __init__(self, base, target, query, evalue, verbose):
+    def __init__(
+            self,
+            base,
+            target,
+            query,
+            evalue,
+            verbose,
+            workers=None,
+            cpus=None,
+            tblastx_path=None,
+            cache_size=None,
+            search_mode=None,
+            blastp_path=None,
+            combined=False,
+            orthologs=True,
+            prefilter=None):
         """Initialize the class with base directory, query sequence, e-value
-        threshold and verbosity level."""
+        threshold and verbosity level. The number of concurrent searches and
+        the number of CPUs to spread them over are optional, and default to
+        one search per CPU allocated to the job. tblastx is found on the
+        PATH if its path is not given. Hits are cached in the base directory,
+        up to cache_size entries. A cache_size of 0 turns the cache off. The
+        search mode is tblastx by default, or blastp to search the translated
+        query against the translated databases built by `fetch'. If combined
+        is True, all species are searched at once in the combined database,
+        if `fetch' has built it. If orthologs is True, hits are looked up in
+        the ortholog table built by `orthologs' before searching. If
+        prefilter is given, only that many candidates per query, chosen with
+        the k-mer index built by `fetch', are searched in each database."""
         self.query = query
-        self.evalue = evalue
-        self.orthologues = {}
+        #   The query sequences are part of the key for cached hits
+        self.query_seqs = OrderedDict(
+            [(rec.id, str(rec.seq)) for rec in SeqIO.parse(query, 'fasta')])
+        self.evalue = float(evalue)
+        #   Keep the hits in the order that the databases are searched, so
+        #   that the unaligned sequences are always written in the same order
+        self.orthologues = OrderedDict()
         self.mainlog = set_verbosity.verbosity('BLAST_Search', verbose)
         self.basedir = base
         self.target = target
+        self.cpus = int(cpus) if cpus else resources.available_cpus()
+        self.workers = int(workers) if workers else self.cpus
+        #   Threads given to each tblastx process. Set by balance_workers()
+        self.threads = 1
+        self.tblastx = check_modules.check_executable(
+            tblastx_path or 'tblastx')
+        self.program = search_mode or 'tblastx'
+        self.combined = combined
+        self.verbose = verbose
+        self.prefilter = int(prefilter) if prefilter else 0
+        #   Species database lengths, read from the catalog when needed
+        self.db_lengths = None
+        #   E-values of the best hits found by searching, keyed on query ID
+        #   and database. Hits from the cache or ortholog table are not here.
+        self.hit_evalues = {}
+        if orthologs:
+            self.orthologs = ortholog_table.OrthologTable(
+                base,
+                target,
+                verbose)
+        else:
+            self.orthologs = None
+        #   The databases searched by blast_all()
+        self.searched = []
+        if self.program not in self.SEARCH_MODES:
+            self.mainlog.error(
+                'Unknown search mode ' + self.program + '. Choose one of ' +
+                ', '.join(self.SEARCH_MODES) + '.')
+            exit(1)
+        self.blastp = None
+        self.protein_query = None
+        if self.program == 'blastp':
+            self.blastp = check_modules.check_executable(
+                blastp_path or 'blastp')
+            self.protein_query = self.query_file('blastp')
+        if cache_size is None:
+            cache_size = self.CACHE_SIZE
+        if int(cache_size) > 0:
+            self.cache = hit_cache.HitCache(base, cache_size, verbose)
+        else:
+            self.cache = None
         return
 
-    def best_hit(self, brecord):
-        """Define a special function to get the best hit out of a BlastRecord
-        We need to do this because of the ugly nested nature of the data
-        structure 'return' immediately stops iteration, whereas 'break'
-        only works on one loop."""
-        for aln in brecord.alignments:
-            for hsp in aln.hsps:
-                frames = [str(f) for f in hsp.frame]
-                debug_msg = aln.title + ' Stats:\n' +\
-                    'Bit Score: ' + str(hsp.bits) + '\n'\
-                    'E-value: ' + str(hsp.expect) + '\n'\
-                    'Identities ' + str(hsp.identities) + '\n'\
-                    'Aln. Length: ' + str(hsp.align_length) + '\n'\
-                    'Hit Start: ' + str(hsp.sbjct_start) + '\n'\
-                    'Hit End: ' + str(hsp.sbjct_end) + '\n'\
-                    'Frames: ' + ', '.join(frames)
-                self.mainlog.debug(debug_msg)
-                if hsp.expect <= self.evalue:
-                    return aln.title
-        else:
-            return None
-
-    def gen_output(self):
-        """Define a function to create and manage output paths."""
-        self.mainlog.debug('Creating named temporary file for BLAST output.')
-        #   We use a python wrapper to mktemp - it automatically removes the
-        #   temporary file when the handle is closed. We will just use it to
-        #   store the BLAST output
-        #   We use mode=w+t since we want read/write in text mode.
-        #   We also need the filename, so used the NamedTemporaryFile method
-        temp_output = tempfile.NamedTemporaryFile(
+    def query_file(self, program, qids=None):
+        """Return the name of a FASTA file holding the query sequences for a
+        search program. qids is a list of query IDs to put in the file, and
+        defaults to all of them. For blastp, the sequences are translated.
+        New files are kept open as temporary files until the search is done,
+        so the file object is returned, too."""
+        if qids is None:
+            if program == 'blastp' and self.protein_query:
+                return (self.protein_query[0], None)
+            elif program == 'tblastx':
+                return (self.query, None)
+            qids = self.query_seqs.keys()
+        handle = tempfile.NamedTemporaryFile(
             mode='w+t',
-            prefix='BAD_Mutations_BlastSearch_',
-            suffix='_BLASTout.xml')
-        self.mainlog.debug('Temp file created with name ' + temp_output.name)
-        #   Return the file-like object
-        return temp_output
+            prefix='BAD_Mutations_Query_',
+            suffix='.fasta')
+        for qid in qids:
+            seq = self.query_seqs[qid]
+            if program == 'blastp':
+                seq = self.translate(seq)
+                if seq is None:
+                    self.mainlog.error(
+                        'Query ' + qid + ' could not be translated.')
+                    exit(1)
+            handle.write('>' + qid + '\n' + seq + '\n')
+        handle.flush()
+        return (handle.name, handle)
+
+    def translate(self, seq):
+        """Translate a CDS into protein, without the terminal stop codon.
+        Returns None if the sequence does not have a whole codon."""
+        return translation.translate(seq).rstrip('*') or None
+
+    def has_kmer_index(self, database):
+        """Check if the prefilter is turned on, and there is an up to date
+        k-mer index for a database."""
+        if not self.prefilter:
+            return False
+        index_file = kmer_index.index_name(database)
+        try:
+            return os.path.getmtime(index_file) >= os.path.getmtime(database)
+        except OSError:
+            self.mainlog.debug('No k-mer index for ' + database)
+            return False
+
+    def prefilter_subject(self, database, qids, program):
+        """Pick out the sequences of a database that share the most k-mers
+        with the queries, and write them into a FASTA file to be searched
+        with -subject. The records are named after their ordinal IDs in the
+        database. Returns the file, and a dictionary of subject ID -> title
+        that the hit would have had in a search of the whole database. The
+        file is None if there are no candidates."""
+        index = kmer_index.KmerIndex(database, self.verbose)
+        prots = [self.translate(self.query_seqs[qid]) or '' for qid in qids]
+        ordinals = index.candidates(prots, self.prefilter)
+        self.mainlog.debug(
+            str(len(ordinals)) + ' candidates in ' +
+            os.path.basename(database) + ' out of ' + str(index.n_seqs))
+        if not ordinals:
+            index.close()
+            return (None, {})
+        handle = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_Subject_',
+            suffix='.fasta')
+        sid_map = {}
+        for ordinal in ordinals:
+            gb_id, seq = index.record(ordinal)
+            sid = 'BL_ORD_' + str(ordinal)
+            sid_map[sid] = 'gnl|BL_ORD_ID|' + str(ordinal) + ' ' + gb_id
+            if program == 'blastp':
+                seq = self.translate(seq) or 'X'
+            handle.write('>' + sid + '\n' + seq + '\n')
+        handle.flush()
+        index.close()
+        return (handle, sid_map)
+
+    def db_size(self, database, program):
+        """Return the number of letters in a database, so that E-values from
+        a search of the candidates are the same as from a search of the whole
+        database. The lengths are read from the species catalog."""
+        if self.db_lengths is None:
+            entries = catalog.read_catalog(self.basedir, self.mainlog) or {}
+            self.db_lengths = dict(
+                [(path, entry['length']) for path, entry in entries.items()])
+        #   Without a catalog, the size of the file is close enough
+        length = self.db_lengths.get(
+            os.path.abspath(database),
+            os.path.getsize(database))
+        if program == 'blastp':
+            length //= 3
+        return length
 
-    def run_blast(self, database):
-        """Define a function to run the BLAST command."""
-        #   Create a temp file
-        blastout = self.gen_output()
+    def cache_key(self, database, program):
+        """Return the program name that cached hits are keyed on. The
+        prefilter can change which hit is found, so its hits are kept apart
+        from those of a search of the whole database, and from those of a
+        prefilter with another k-mer length or number of candidates."""
+        if self.has_kmer_index(database):
+            return (
+                program + ':prefilter:' + str(kmer_index.K) + ':' +
+                str(self.prefilter))
+        return program
+
+    def run_search(self, database, program, qids=None):
+        """Search a database with the queries in qids, or all of them, and
+        return the output of get_seq_id(). If there is a k-mer index, only the
+        candidate sequences are searched."""
+        if qids is not None and len(qids) == len(self.query_seqs):
+            query, handle = self.query_file(program)
+        else:
+            query, handle = self.query_file(program, qids)
+        subject = None
+        sid_map = {}
+        dbsize = None
+        if self.has_kmer_index(database):
+            subject, sid_map = self.prefilter_subject(
+                database,
+                qids or self.query_seqs.keys(),
+                program)
+            if subject is None:
+                if handle:
+                    handle.close()
+                return self.remap_hits(None, sid_map)
+            dbsize = self.db_size(database, program)
+        blast_proc = self.run_blast(
+            database,
+            query,
+            program,
+            subject=subject.name if subject else None,
+            dbsize=dbsize)
+        hits = self.get_seq_id(blast_proc, qids)
+        if handle:
+            handle.close()
+        if subject:
+            subject.close()
+        return self.remap_hits(hits, sid_map)
+
+    def remap_hits(self, hit, sid_map):
+        """Give a hit from a search of prefiltered candidates the title it
+        would have had in a search of the whole database."""
+        if hit and sid_map:
+            sid = hit.split(' ')[0]
+            if sid.startswith('lcl|'):
+                sid = sid[4:]
+            return sid_map.get(sid, hit)
+        return hit
+
+    def search_program(self, database):
+        """Return the program to search a database with. If the translated
+        database has not been built yet, we fall back on tblastx."""
+        if self.program == 'blastp':
+            if os.path.isfile(file_funcs.protein_db_name(database)):
+                return 'blastp'
+            self.mainlog.warning(
+                'No protein database for ' + os.path.basename(database) +
+                '. Searching it with tblastx. Run `fetch --convert-only\' '
+                'to build it.')
+        return 'tblastx'
+
+    def run_blast(
+            self,
+            database,
+            query=None,
+            program='tblastx',
+            evalue=None,
+            max_targets=5,
+            subject=None,
+            dbsize=None):
+        """Define a function to run the BLAST command. Searches with the query
+        file given to the class, unless another one is given. For blastp, the
+        query has to be a protein FASTA file, and the translated database is
+        searched. The E-value threshold and the number of hits to report can
+        be changed from the defaults for searching the combined database. If
+        a subject FASTA file is given, it is searched instead of the database,
+        with the database size given by dbsize."""
         #   Start building a command line
-        cline = NcbitblastxCommandline(
-            query=self.query,
-            out=blastout.name,
-            db=database,
-            evalue=self.evalue,
-            outfmt=5,
-            max_target_seqs=5)
-        self.mainlog.debug(str(cline))
-        #   And then execute it
-        cline()
-        return blastout
-
-    def get_seq_id(self, out):
-        """Define a function to get the best hit out of a BLAST record."""
-        #   Seek to the beginning of the temporary file to read its contents
-        out.seek(0)
-        #   Then read the xml out
+        if program == 'blastp':
+            cmd = [
+                self.blastp,
+                '-query', query or self.protein_query[0]]
+            db = file_funcs.protein_db_name(database)
+        else:
+            cmd = [
+                self.tblastx,
+                '-query', query or self.query]
+            db = database
+        #   BLAST does not run threads when searching a subject file
+        if subject:
+            cmd += ['-subject', subject, '-dbsize', str(dbsize)]
+        else:
+            cmd += ['-db', db, '-num_threads', str(self.threads)]
+        cmd += [
+            '-evalue', str(evalue or self.evalue),
+            '-outfmt', '6 ' + self.TABULAR_FIELDS,
+            '-max_target_seqs', str(max_targets)]
+        self.mainlog.debug(' '.join(cmd))
+        #   And then execute it. stderr goes to an unnamed temporary file, so
+        #   that a chatty BLAST can never block on a full pipe while we are
+        #   reading stdout.
+        errors = tempfile.TemporaryFile(mode='w+t')
+        blast_proc = subprocess.Popen(
+            cmd,
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=errors)
+        blast_proc.errors = errors
+        blast_proc.program = program
+        blast_proc.database = database
+        return blast_proc
+
+    def parse_hit(self, line):
+        """Split a line of the tabular report into a tuple of query ID, hit
+        title, and E-value. The title is built the same way as in the BLAST
+        XML report: the subject ID, a space, and the subject title."""
+        qseqid, sseqid, evalue, bitscore, stitle = line.rstrip(
+            '\n').split('\t', 4)
+        #   Only build the message if someone is going to read it
+        if self.mainlog.isEnabledFor(logging.DEBUG):
+            self.mainlog.debug(
+                sseqid + ' Stats:\n' +
+                'Bit Score: ' + bitscore + '\n' +
+                'E-value: ' + evalue)
+        return (qseqid, sseqid + ' ' + stitle, float(evalue))
+
+    def get_seq_id(self, blast_proc, searched=None):
+        """Define a function to get the best hit out of a BLAST report. There
+        is only one query, so searched is not used."""
         self.mainlog.debug('Beginning to parse the BLAST output for ' +
                            self.query + '.')
-        blast_records = NCBIXML.parse(out)
-        #   Convert it to a list, since it should be relatively small...
-        blast_records = list(blast_records)
-        self.mainlog.info('We found ' + str(len(blast_records)) +
-                          ' hits for ' + self.query + '.')
-        #   If the list is empty, then we have no hits
-        if len(blast_records) > 0:
-            #   For each record
-            for rec in blast_records:
-                best = self.best_hit(rec)
-                if best:
-                    self.mainlog.info('Saving ' + best + ' as best hit.')
-                    break
-        #   Close the temporary file to clean up
-        #   it's automatically deleted
-        out.close()
+        best = None
+        #   readline() instead of iterating over the file, since iteration
+        #   reads ahead and would wait for the whole report.
+        for line in iter(blast_proc.stdout.readline, ''):
+            qseqid, title, evalue = self.parse_hit(line)
+            if evalue <= self.evalue:
+                best = title
+                self.hit_evalues[(qseqid, blast_proc.database)] = evalue
+                self.mainlog.info('Saving ' + best + ' as best hit.')
+                break
+        self.finish_blast(blast_proc, best is not None)
         return best
 
+    def finish_blast(self, blast_proc, stopped_early):
+        """Close the pipe to tblastx and wait for it to exit. If we stopped
+        reading early, tblastx may be killed by the closed pipe, so we only
+        complain about its exit status if we read the whole report."""
+        blast_proc.stdout.close()
+        retcode = blast_proc.wait()
+        blast_proc.errors.seek(0)
+        err = blast_proc.errors.read()
+        blast_proc.errors.close()
+        if err:
+            self.mainlog.debug('stderr:\n' + err)
+        if retcode != 0 and not stopped_early:
+            self.mainlog.error(
+                blast_proc.program + ' exited with status ' + str(retcode) +
+                '\n' + err)
+        return
+
+    def balance_workers(self, n_databases):
+        """Split the available CPUs between concurrent searches and the
+        threads of each search. We never run more searches than there are
+        databases or CPUs, and the CPUs left over are given to each tblastx
+        process as threads. Returns the number of workers."""
+        workers = max(1, min(self.workers, n_databases, self.cpus))
+        self.threads = max(1, self.cpus // workers)
+        self.mainlog.info(
+            'Running ' + str(workers) + ' concurrent BLAST searches with ' +
+            str(self.threads) + ' thread(s) each.')
+        return workers
+
+    def search_database(self, database):
+        """Run BLAST against one database and parse out the best hit.
+        Returns a tuple of the database and the title of the best hit."""
+        query_seq = self.query_seqs.values()[0]
+        program = self.search_program(database)
+        key = self.cache_key(database, program)
+        if self.cache:
+            found, hit = self.cache.get(
+                query_seq,
+                database,
+                self.evalue,
+                key)
+            if found:
+                return (database, hit)
+        #   Run the search, and parse it as it comes out
+        hit = self.run_search(database, program)
+        if self.cache:
+            self.cache.put(query_seq, database, self.evalue, key, hit)
+        return (database, hit)
+
     def blast_all(self):
-        """Define a function to BLAST against every database."""
-        databases = file_funcs.get_file_by_ext(self.basedir,
-                                               '.fa',
-                                               self.mainlog)
+        """Define a function to BLAST against every database. The databases
+        are listed in the species catalog written by `fetch', or found by
+        searching the base directory if the catalog is out of date."""
+        databases = catalog.species_databases(self.basedir, self.mainlog)
         self.mainlog.info('Running BLAST on ' +
                           str(len(databases)) +
                           ' species databases.')
         self.mainlog.debug('BLAST databases:\n' + '\n'.join(databases))
-        #   databases will always be at least length 1
-        #   if there is nothing, then the list will just have the empty string
-        if databases[0] == '':
+        if not databases:
             self.mainlog.error('The base directory ' +
                                self.basedir +
                                ' does not contain any BLAST databases!')
             exit(1)
-        for blast_db in databases:
-            #   If the target species is in the filename of the FASTA sequence,
-            #   we will skip it.
-            if self.target.upper() in blast_db.upper():
+        #   If the target species is in the filename of the FASTA sequence,
+        #   we will skip it. We sort the rest, since the order that `find'
+        #   returns them in depends on the filesystem.
+        to_search = sorted(
+            [
+                blast_db
+                for blast_db
+                in databases
+                if self.target.upper() not in blast_db.upper()
+            ])
+        self.searched = to_search
+        #   Look up the orthologues that are already known
+        known = {}
+        if self.orthologs:
+            known = self.orthologs.lookup(
+                self.query_seqs,
+                to_search,
+                self.evalue,
+                self.program)
+            if known:
+                self.mainlog.info(
+                    'Found orthologues in ' + str(len(known)) + ' of ' +
+                    str(len(to_search)) + ' species in the ortholog table.')
+                to_search = [db for db in to_search if db not in known]
+        species = None
+        if self.combined:
+            species = combined_db.read_manifest(self.basedir, self.mainlog)
+            if species is None:
+                self.mainlog.warning(
+                    'The combined database is missing or out of date. '
+                    'Searching the species databases one at a time. Run '
+                    '`fetch --convert-only --combined-db\' to rebuild it.')
+        if species:
+            #   Species that were added after the combined database was built
+            #   are searched on their own
+            in_combined = [
+                db for db in to_search
+                if combined_db.species_tag(db) in species]
+            rest = [db for db in to_search if db not in in_combined]
+            hits = self.search_combined(in_combined, species)
+            to_search = rest
+        workers = self.balance_workers(len(to_search))
+        if not to_search:
+            results = []
+        elif workers > 1:
+            #   The work is done in tblastx subprocesses, so threads are
+            #   enough to keep them all busy. map() gives back the results in
+            #   the same order as the databases.
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self.search_database, to_search)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.search_database(db) for db in to_search]
+        if species:
+            results += [
+                (db, self.query_hit(hits[db]))
+                for db in in_combined]
+        results += [(db, self.query_hit(hits)) for db, hits in known.items()]
+        results.sort(key=lambda r: r[0])
+        for blast_db, homologous_locus in results:
+            self.store_hit(blast_db, homologous_locus)
+        return
+
+    def search_combined(self, databases, species):
+        """Search all of the species databases at once, in the combined
+        database. species is the manifest of the combined database. Returns a
+        dictionary of species database -> (query ID -> title of best hit).
+
+        E-values are proportional to the size of the database, so an E-value
+        from the combined database is scaled by the share of the combined
+        database that the species takes up, to give the E-value that the hit
+        would have had in a search of the species database alone. The
+        threshold given to BLAST is raised by the same factor for the
+        smallest species, so that no hit that would pass is cut off.
+
+        BLAST reports at most COMBINED_TARGETS targets per species for each
+        query, counted over all species together. If the hits in other species
+        that are better than the best hit of a species fill that limit, the
+        best hit is missed, which cannot happen when the species databases are
+        searched one at a time."""
+        database = combined_db.combined_path(self.basedir)
+        program = self.search_program(database)
+        cache_key = program + ':combined'
+        total = float(sum([length for path, length in species.values()]))
+        tags = dict([(combined_db.species_tag(db), db) for db in databases])
+        scale = dict([
+            (tag, species[tag][1] / total)
+            for tag in tags
+            if species[tag][1] > 0])
+        best = dict([(db, {}) for db in databases])
+        #   Look up the hits that are cached for each query and species
+        needed = set()
+        for qid, query_seq in self.query_seqs.iteritems():
+            for db in databases:
+                if self.cache:
+                    found, hit = self.cache.get(
+                        query_seq,
+                        db,
+                        self.evalue,
+                        cache_key)
+                    if found:
+                        if hit:
+                            best[db][qid] = hit
+                        continue
+                needed.add((qid, db))
+        if not needed or not scale:
+            return best
+        qids = [qid for qid in self.query_seqs if qid in set(
+            [n[0] for n in needed])]
+        if len(qids) < len(self.query_seqs):
+            query, handle = self.query_file(program, qids)
+        else:
+            query, handle = self.query_file(program)
+        #   There is only one BLAST process, so it gets all of the CPUs
+        self.threads = self.cpus
+        self.mainlog.info(
+            'Searching ' + str(len(tags)) + ' species at once in the '
+            'combined database.')
+        blast_proc = self.run_blast(
+            database,
+            query,
+            program,
+            evalue=self.evalue / min(scale.values()),
+            max_targets=self.COMBINED_TARGETS * len(species))
+        found = 0
+        for line in iter(blast_proc.stdout.readline, ''):
+            qid, title, evalue = self.parse_hit(line)
+            #   BLAST may show the query IDs as local IDs
+            if qid.startswith('lcl|'):
+                qid = qid[4:]
+            #   Drop the ordinal ID of the combined database
+            tag, title = combined_db.split_title(title.split(' ', 1)[1])
+            #   Skip the target species and anything we do not need
+            if tag not in scale or (qid, tags[tag]) not in needed:
+                continue
+            db = tags[tag]
+            if qid in best[db] or evalue * scale[tag] > self.evalue:
                 continue
-            #   Get the BLAST output
-            blast_output = self.run_blast(blast_db)
-            #   And parse it
-            homologous_locus = self.get_seq_id(blast_output)
-            #   We do this check in case there is no match in a species
-            #   Only save those that have a match
-            if homologous_locus:
-                #   We want the first and second parts, separated by a space
-                fasta_info = homologous_locus.split(' ')
-                seq_id = fasta_info[0]
-                #   We need this part if we want to search by regex
-                gb_id = fasta_info[1]
-                #   And then tack it onto the list of orthologues
-                self.orthologues[blast_db] = (seq_id, gb_id)
+            self.mainlog.debug('Saving ' + title + ' as best hit for ' + qid +
+                               ' in ' + tag)
+            best[db][qid] = title
+            self.hit_evalues[(qid, db)] = evalue * scale[tag]
+            found += 1
+            if found == len(needed):
+                break
+        self.finish_blast(blast_proc, found == len(needed))
+        if handle:
+            handle.close()
+        if self.cache:
+            for qid, db in needed:
+                self.cache.put(
+                    self.query_seqs[qid],
+                    db,
+                    self.evalue,
+                    cache_key,
+                    best[db].get(qid))
+        return best
+
+    def query_hit(self, hits):
+        """Return the best hit in one species from a dictionary of query ID ->
+        hit, in the form that store_hit() takes."""
+        return hits.get(self.query_seqs.keys()[0])
+
+    def store_hit(self, blast_db, homologous_locus):
+        """Save the best hit from a database into the orthologues."""
+        #   We do this check in case there is no match in a species
+        #   Only save those that have a match
+        if homologous_locus:
+            #   We want the first and second parts, separated by a space
+            fasta_info = homologous_locus.split(' ')
+            seq_id = fasta_info[0]
+            #   We need this part if we want to search by regex
+            gb_id = fasta_info[1]
+            #   And then tack it onto the list of orthologues
+            self.orthologues[blast_db] = (seq_id, gb_id)
         return
 
     def get_hit_seqs(self):
         """Define a function to get the hit sequences out of the databses."""
-        #   Create a temporary file for holding sequence information while we
-        #   collect it
         if len(self.orthologues) == 0:
             self.mainlog.critical(
                 'Could not find any BLAST hits! Try raising the E-value '
                 'threshold for homology.')
             exit(2)
-        self.mainlog.debug('Creating named tempfile for homologous sequences.')
-        temp_output = tempfile.NamedTemporaryFile(
-            mode='w+t',
-            prefix='BAD_Mutations_BlastSearch_',
-            suffix='_orthologues.fasta')
-        self.mainlog.debug('Created temporary file ' + temp_output.name)
-        qseq = SeqIO.read(self.query, 'fasta')
-        #    Start a new string to write the data into the file
-        towrite = '>' + qseq.name + '\n' + str(qseq.seq) + '\n'
+        hit_seqs = self.fetch_hit_seqs(self.orthologues.items())
+        return self.write_hit_seqs(self.query, self.orthologues, hit_seqs)
+
+    def fetch_hit_seqs(self, hits):
+        """Fetch the sequences of a list of (database, (seq ID, gb ID)) hits.
+        The IDs are grouped by database, and each database is read with one
+        call to blastdbcmd. Returns a dictionary of (database, seq ID) ->
+        sequence. Hits that could not be fetched are left out."""
+        by_db = OrderedDict()
+        for database, seqid in hits:
+            ids = by_db.setdefault(database, OrderedDict())
+            ids[seqid[0]] = seqid[1]
+        hit_seqs = {}
         #   Check to see if the blastdbcmd command is avilable
         blastdbcmd_path = check_modules.check_executable('blastdbcmd')
         if blastdbcmd_path:
             self.mainlog.debug('Using ' + blastdbcmd_path)
-            for database, seqid in self.orthologues.iteritems():
+            for database, ids in by_db.iteritems():
+                seq_ids = ids.keys()
                 fasta, error = sequence_fetch.blastdbcmd(
                     blastdbcmd_path,
                     database,
-                    seqid[0])
-                self.mainlog.debug('Stdout:\n' + fasta)
-                self.mainlog.debug('Stderr:\n' + error)
-                #   If the sequence has ambiguous nucleotides (WRKYSMVBDHN),
-                #   then we exclude it.
-                db_seq = ''.join(fasta.split('\n')[1:])
-                #   Then, search for the ambiguous nucleotides, skip if they are
-                #   found.
-                if re.search('S|W|R|K|Y|M|V|B|D|H|N', db_seq, re.I):
+                    seq_ids)
+                if error:
+                    self.mainlog.debug('Stderr:\n' + error)
+                records = list(SeqIO.parse(StringIO(fasta), 'fasta'))
+                #   blastdbcmd writes the sequences in the order they were
+                #   asked for. If some of them are missing, we have to match
+                #   them up by ID instead.
+                if len(records) == len(seq_ids):
+                    for seq_id, rec in zip(seq_ids, records):
+                        hit_seqs[(database, seq_id)] = str(rec.seq)
+                else:
                     self.mainlog.warning(
-                        'Removing sequence from ' +
-                        os.path.basename(database) +
-                        ' due to ambiguous nucleotides.')
-                    continue
-                #   We will use the name of the assembly as the species name
-                spname = os.path.basename(database)
-                #   Then split on . and take the first part
-                spname = '>' + spname.split('.')[0]
-                #   Then replace the weird ID with the species name
-                fasta = re.sub('>.+', spname, fasta)
-                towrite += fasta
+                        'Expected ' + str(len(seq_ids)) + ' sequences from ' +
+                        os.path.basename(database) + ', got ' +
+                        str(len(records)) + '.')
+                    for rec in records:
+                        if rec.id in ids:
+                            hit_seqs[(database, rec.id)] = str(rec.seq)
         else:
-            self.mainlog.debug('Using regex')
-            for database, seqid in self.orthologues.iteritems():
-                fasta = sequence_fetch.get_seq_by_regex(database, seqid[1])
-                #   Perform the same check here for ambiguous nucleotides.
-                db_seq = ''.join(fasta.split('\n')[1:])
-                #   Then, search for the ambiguous nucleotides, skip if they are
-                #   found.
-                if re.search('S|W|R|K|Y|M|V|B|D|H|N', db_seq, re.I):
-                    self.mainlog.warning(
-                        'Removing sequence from ' +
-                        os.path.basename(database) +
-                        ' due to ambiguous nucleotides.')
-                #   We will use the name of the assembly as the species name
-                spname = os.path.basename(database)
-                #   Then split on . and take the first part
-                spname = '>' + spname.split('.')[0]
-                #   Then replace the weird ID with the species name
-                fasta = re.sub('>.+', spname, fasta)
-                towrite += fasta
+            self.mainlog.debug('Using offset index')
+            for database, ids in by_db.iteritems():
+                index = self.load_offset_index(database)
+                seqs = sequence_fetch.get_seqs_by_offset(
+                    database,
+                    index,
+                    ids.values())
+                for seq_id, gb_id in ids.iteritems():
+                    if gb_id not in seqs:
+                        self.mainlog.warning(
+                            'Could not find ' + gb_id + ' in ' + database)
+                        continue
+                    hit_seqs[(database, seq_id)] = seqs[gb_id]
+        return hit_seqs
+
+    def load_offset_index(self, database):
+        """Read the offset index of a database FASTA file. If `fetch' did not
+        build one, or the FASTA file has changed since, build it now and try
+        to save it for the next run."""
+        index = file_funcs.read_offset_index(database, self.mainlog)
+        if index is None:
+            index = file_funcs.build_offset_index(database, self.mainlog)
+            try:
+                file_funcs.write_offset_index(database, index, self.mainlog)
+            except (OSError, IOError):
+                self.mainlog.warning(
+                    'Could not save offset index for ' + database)
+        return index
+
+    def write_hit_seqs(self, query, orthologues, hit_seqs):
+        """Write the query sequence and the sequences of its orthologues into
+        a temporary file, and return the file-like object. The sequences are
+        taken from the output of fetch_hit_seqs()."""
+        #   Create a temporary file for holding sequence information while we
+        #   collect it
+        self.mainlog.debug('Creating named tempfile for homologous sequences.')
+        temp_output = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_BlastSearch_',
+            suffix='_orthologues.fasta')
+        self.mainlog.debug('Created temporary file ' + temp_output.name)
+        qseq = SeqIO.read(query, 'fasta')
+        #    Start a new string to write the data into the file
+        towrite = '>' + qseq.name + '\n' + str(qseq.seq) + '\n'
+        for database, seqid in orthologues.iteritems():
+            db_seq = hit_seqs.get((database, seqid[0]))
+            if not db_seq:
+                continue
+            #   If the sequence has ambiguous nucleotides (WRKYSMVBDHN),
+            #   then we exclude it.
+            if re.search('S|W|R|K|Y|M|V|B|D|H|N', db_seq, re.I):
+                self.mainlog.warning(
+                    'Removing sequence from ' +
+                    os.path.basename(database) +
+                    ' due to ambiguous nucleotides.')
+                continue
+            #   We will use the name of the assembly as the species name
+            spname = os.path.basename(database)
+            #   Then split on . and take the first part
+            spname = '>' + spname.split('.')[0]
+            towrite += spname + '\n' + db_seq + '\n'
         self.mainlog.debug('Writing sequences into ' + temp_output.name)
         temp_output.write(towrite)
         #   We flush() it so that there is no data left unwritten
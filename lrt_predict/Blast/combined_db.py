@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to build and read the combined database,
+#   which holds the CDS of every species in one BLAST database so that each
+#   query only has to be searched once.
+#
+#   Each record in the combined database has a defline of the form
+#       >species_tag ordinal original_defline
+#   where species_tag is the file name of the species database, and ordinal is
+#   the position of the record in that database. BLAST gives the records of a
+#   database ordinal IDs of the form gnl|BL_ORD_ID|ordinal, so the ordinal
+#   maps a combined hit straight back to the record in the species database.
+
+import os
+import time
+
+#   Directory under the base directory that holds the combined database
+COMBINED_DIR = 'Combined'
+#   Name of the combined FASTA file. It must not end in .fa, or it would be
+#   found as a species database.
+COMBINED_NAME = 'All_Species.fasta'
+#   Name of the manifest, which lists the species in the combined database
+MANIFEST_NAME = 'All_Species_Manifest.txt'
+
+
+#   Return the path to the combined FASTA file
+def combined_path(base):
+    return os.path.join(base, COMBINED_DIR, COMBINED_NAME)
+
+
+#   Return the path to the manifest
+def manifest_path(base):
+    return os.path.join(base, COMBINED_DIR, MANIFEST_NAME)
+
+
+#   Return the tag that identifies a species database in the combined one
+def species_tag(database):
+    return os.path.basename(database)
+
+
+#   A function to write the combined FASTA file. databases is a list of
+#   species FASTA files. Returns the path to the combined file, and a list of
+#   (species tag, database path, total length) for the manifest.
+def write_combined(base, databases, l):
+    out_dir = os.path.join(base, COMBINED_DIR)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    out_name = combined_path(base)
+    l.info('Writing combined database ' + out_name + ' from ' +
+           str(len(databases)) + ' species databases.')
+    manifest = []
+    out = open(out_name, 'w')
+    for database in sorted(databases):
+        tag = species_tag(database)
+        ordinal = -1
+        length = 0
+        with open(database, 'r') as f:
+            for line in f:
+                if line.startswith('>'):
+                    ordinal += 1
+                    out.write('>' + tag + ' ' + str(ordinal) + ' ' + line[1:])
+                else:
+                    length += len(line.strip())
+                    out.write(line)
+        manifest.append((tag, os.path.abspath(database), length))
+    out.close()
+    return (out_name, manifest)
+
+
+#   A function to write the manifest. It should be written after the BLAST
+#   database has been made, so that a build that did not finish never looks
+#   valid.
+def write_manifest(base, manifest, l):
+    l.info('Writing combined database manifest ' + manifest_path(base))
+    handle = open(manifest_path(base), 'w')
+    handle.write('#built\t' + str(int(time.time())) + '\n')
+    for tag, path, length in manifest:
+        handle.write(tag + '\t' + path + '\t' + str(length) + '\n')
+    handle.close()
+    return
+
+
+#   A function to read the manifest. Returns a dictionary of species tag ->
+#   (database path, total sequence length), or None if there is no combined
+#   database, or any of the species databases have changed since it was
+#   built.
+def read_manifest(base, l):
+    m_file = manifest_path(base)
+    if not os.path.isfile(m_file):
+        l.debug('No combined database in ' + base)
+        return None
+    species = {}
+    built = 0
+    try:
+        with open(m_file, 'r') as f:
+            for line in f:
+                tmp = line.rstrip('\n').split('\t')
+                if tmp[0] == '#built':
+                    built = int(tmp[1])
+                    continue
+                species[tmp[0]] = (tmp[1], int(tmp[2]))
+    except (IOError, ValueError, IndexError):
+        l.warning('Could not read the combined database manifest ' + m_file)
+        return None
+    for tag, (path, length) in species.iteritems():
+        try:
+            mtime = int(os.path.getmtime(path))
+        except OSError:
+            l.warning('The combined database is out of date: ' + path +
+                      ' is missing.')
+            return None
+        if mtime > built:
+            l.warning('The combined database is out of date: ' + path +
+                      ' has been modified.')
+            return None
+    return species
+
+
+#   A function to split the title of a hit in the combined database into the
+#   species tag, and the title that the same hit would have had in the
+#   species database.
+def split_title(stitle):
+    tag, ordinal, rest = stitle.split(' ', 2)
+    return (tag, 'gnl|BL_ORD_ID|' + ordinal + ' ' + rest)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""A class to keep the best BLAST hits on disk, so that repeated searches of
+the same query against the same database do not have to be run again."""
+
+#   Import standard library modules here
+import os
+import hashlib
+import shutil
+import tempfile
+
+#   Import our helper scripts here
+from lrt_predict.General import file_funcs
+from lrt_predict.General import set_verbosity
+
+
+class HitCache(object):
+    """A class to store and retrieve the best BLAST hit of a query sequence
+    in a species database. The cache is a directory under the base directory,
+    with one subdirectory per database and one small file per entry. Files
+    are written atomically, so that many jobs can share the cache at once.
+
+    Each entry is keyed on a SHA1 hash of the query sequence, the checksum of
+    the database recorded by `fetch', the search program, and the E-value
+    threshold. The entry holds the title of the best hit, or records that
+    there was no hit at all.
+
+    The number of entries is kept in a count file in the cache directory, so
+    that the cache does not have to be listed to know when it is full. The
+    count is raised by each new key, and the cache is only listed and
+    evicted when the count goes over max_entries. Jobs that add entries at
+    the same time may lose a raise, so eviction writes the true count.
+
+    Contains the following class attributes:
+        CACHE_DIR (str)         Name of the cache directory under the base
+        NO_HIT (str)            Stored when a search had no hits
+        COUNT_FILE (str)        Name of the count file in the cache directory
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        cache_dir (str)         Full path to the cache directory
+        max_entries (int)       Maximum number of entries to keep
+        identities (dict)       Identity of each database, as it is found
+
+    Contains the following methods:
+        db_identity(self, database):
+            Return the checksum of a database recorded by `fetch', or its size
+            and modification time if there is no checksum. It is only read
+            once for each database.
+
+        key(self, query_seq, database, evalue, program):
+            Build the key for an entry.
+
+        get(self, query_seq, database, evalue, program):
+            Look up an entry. Returns a tuple of whether the entry was found,
+            and the hit title (None if there was no hit).
+
+        put(self, query_seq, database, evalue, program, hit):
+            Save an entry, and evict entries if the cache is full.
+
+        invalidate(self, database):
+            Remove all entries for a database.
+
+        evict(self):
+            Remove the least recently used entries when there are more than
+            max_entries.
+    """
+    CACHE_DIR = 'BLAST_Cache'
+    NO_HIT = 'NOHIT'
+    COUNT_FILE = '.entries'
+
+    def __init__(self, base, max_entries, verbose):
+        self.mainlog = set_verbosity.verbosity('BLAST_Cache', verbose)
+        self.cache_dir = os.path.join(base, self.CACHE_DIR)
+        self.max_entries = int(max_entries)
+        self.identities = {}
+        return
+
+    def db_dir(self, database):
+        """Return the cache directory for a database."""
+        return os.path.join(self.cache_dir, os.path.basename(database))
+
+    def db_identity(self, database):
+        """Return a string that identifies the current build of a database.
+        This is the checksum that `fetch' records when it builds the database.
+        Databases built outside of `fetch' fall back on the size and
+        modification time of the FASTA file. The identity is kept, so that
+        the checksum file is read once per database, not once per entry."""
+        if database in self.identities:
+            return self.identities[database]
+        checksum = file_funcs.read_checksum(database, self.mainlog)
+        if checksum:
+            identity = checksum
+        else:
+            stat = os.stat(database)
+            identity = str(stat.st_size) + '_' + str(int(stat.st_mtime))
+        self.identities[database] = identity
+        return identity
+
+    def key(self, query_seq, database, evalue, program):
+        """Build the key for an entry from the query sequence, the database
+        identity, the search program, and the E-value threshold."""
+        sha = hashlib.sha1()
+        sha.update(str(query_seq).upper())
+        sha.update('\n' + self.db_identity(database))
+        sha.update('\n' + program)
+        sha.update('\n' + repr(float(evalue)))
+        return sha.hexdigest()
+
+    def get(self, query_seq, database, evalue, program):
+        """Look up an entry. Returns (True, title) for a cached hit,
+        (True, None) for a search that is known to have no hits, and
+        (False, None) if the search has not been cached."""
+        entry = os.path.join(
+            self.db_dir(database),
+            self.key(query_seq, database, evalue, program))
+        try:
+            with open(entry, 'r') as handle:
+                hit = handle.read().strip()
+            #   Touch the entry so that eviction removes the least recently
+            #   used entries first
+            os.utime(entry, None)
+        except (OSError, IOError):
+            return (False, None)
+        self.mainlog.debug(
+            'Cached hit in ' + os.path.basename(database) + ': ' + hit)
+        if hit == self.NO_HIT:
+            return (True, None)
+        return (True, hit)
+
+    def put(self, query_seq, database, evalue, program, hit):
+        """Save an entry. The entry is written to a temporary file and then
+        renamed, so that readers never see a partial entry. Only new entries
+        are counted, not ones that replace an entry with the same key."""
+        target_dir = self.db_dir(database)
+        entry = os.path.join(
+            target_dir,
+            self.key(query_seq, database, evalue, program))
+        try:
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+        except OSError:
+            #   Another job may have made it first
+            if not os.path.isdir(target_dir):
+                self.mainlog.warning(
+                    'Could not create cache directory ' + target_dir)
+                return
+        try:
+            handle, tmpname = tempfile.mkstemp(dir=target_dir, prefix='.tmp_')
+            os.write(handle, (hit or self.NO_HIT) + '\n')
+            os.close(handle)
+            replaced = os.path.exists(entry)
+            os.rename(tmpname, entry)
+        except (OSError, IOError) as msg:
+            self.mainlog.warning('Could not write cache entry: ' + str(msg))
+            return
+        if not replaced:
+            self.count_entry()
+        return
+
+    def read_count(self):
+        """Read the number of entries from the count file. Returns None if
+        there is no count file."""
+        try:
+            with open(os.path.join(self.cache_dir, self.COUNT_FILE)) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def write_count(self, count):
+        """Write the number of entries into the count file, atomically."""
+        try:
+            handle, tmpname = tempfile.mkstemp(
+                dir=self.cache_dir,
+                prefix='.tmp_')
+            os.write(handle, str(count) + '\n')
+            os.close(handle)
+            os.rename(tmpname, os.path.join(self.cache_dir, self.COUNT_FILE))
+        except (OSError, IOError) as msg:
+            self.mainlog.warning('Could not write cache count: ' + str(msg))
+        return
+
+    def count_entry(self):
+        """Add a new entry to the count, and evict if the cache is full. A
+        cache without a count file, such as one made by an earlier version,
+        is counted once."""
+        count = self.read_count()
+        if count is None:
+            count = len(self.list_entries())
+        else:
+            count += 1
+        if count > self.max_entries:
+            self.evict()
+        else:
+            self.write_count(count)
+        return
+
+    def list_entries(self):
+        """Return the paths to all of the entries in the cache."""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for db_name in os.listdir(self.cache_dir):
+            db_path = os.path.join(self.cache_dir, db_name)
+            if not os.path.isdir(db_path):
+                continue
+            entries.extend([
+                os.path.join(db_path, e) for e in os.listdir(db_path)
+                if not e.startswith('.tmp_')])
+        return entries
+
+    def invalidate(self, database):
+        """Remove all of the entries for a database. Called when `fetch'
+        rebuilds it."""
+        target_dir = self.db_dir(database)
+        self.identities.pop(database, None)
+        if os.path.isdir(target_dir):
+            self.mainlog.info('Clearing cached BLAST hits for ' + database)
+            shutil.rmtree(target_dir, ignore_errors=True)
+            #   Count the entries again the next time one is added
+            try:
+                os.remove(os.path.join(self.cache_dir, self.COUNT_FILE))
+            except OSError:
+                pass
+        return
+
+    def evict(self):
+        """Remove the least recently used entries if there are more than
+        max_entries. We remove down to 90% of the limit, so that we do not
+        have to evict again on the very next entry. This lists every entry,
+        so it is only called when the count says the cache is full. The
+        count file is set to the number of entries that are left."""
+        entries = self.list_entries()
+        if len(entries) <= self.max_entries:
+            if os.path.isdir(self.cache_dir):
+                self.write_count(len(entries))
+            return
+        to_keep = int(self.max_entries * 0.9)
+        self.mainlog.info(
+            'BLAST cache has ' + str(len(entries)) + ' entries. Removing ' +
+            str(len(entries) - to_keep) + ' least recently used.')
+        aged = []
+        for entry in entries:
+            try:
+                aged.append((os.path.getmtime(entry), entry))
+            except OSError:
+                continue
+        aged.sort()
+        removed = 0
+        for mtime, entry in aged[:len(aged) - to_keep]:
+            try:
+                os.remove(entry)
+                removed += 1
+            except OSError:
+                continue
+        self.write_count(len(entries) - removed)
+        return
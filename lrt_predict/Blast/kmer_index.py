@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""A class to find the sequences in a species database that share the most
+amino acid k-mers with a query, so that BLAST only has to align those."""
+
+#   Import standard library modules here
+import os
+import mmap
+import struct
+from array import array
+
+#   Import our helper scripts here
+from lrt_predict.General import set_verbosity
+
+#   The amino acids that k-mers are built from. K-mers with any other residue
+#   (X, stops) are skipped.
+ALPHABET = 'ACDEFGHIKLMNPQRSTVWY'
+#   Length of the k-mers. 20^4 = 160,000 buckets
+K = 4
+#   Header of the index file: magic, version, k, sequences, buckets
+HEADER = struct.Struct('<4sIIII')
+MAGIC = 'BADK'
+VERSION = 1
+#   Byte offset and length of each record in the CDS FASTA file
+RECORD = struct.Struct('<QI')
+#   Type code of the arrays of bucket offsets and postings, which are four
+#   byte unsigned integers in the byte order of the machine
+ITEM = 'I'
+#   Number of each amino acid in the alphabet
+CODES = dict([(aa, i) for i, aa in enumerate(ALPHABET)])
+
+
+#   Return the name of the k-mer index of a CDS database
+def index_name(fname):
+    return fname + '.kmer'
+
+
+#   Return the set of k-mer codes in a protein sequence. Each k-mer is read
+#   as a number in base 20, and the code is rolled along the sequence.
+def kmer_codes(prot, k=K):
+    codes = set()
+    n = len(ALPHABET)
+    top = n ** k
+    code = 0
+    #   Number of valid residues since the last one not in the alphabet
+    run = 0
+    for aa in prot.upper():
+        num = CODES.get(aa)
+        if num is None:
+            run = 0
+            code = 0
+            continue
+        code = (code * n + num) % top
+        run += 1
+        if run >= k:
+            codes.add(code)
+    return codes
+
+
+#   A generator over the sequences of a FASTA file, without Biopython, since
+#   this is run over whole species at fetch time
+def fasta_seqs(fname):
+    seq = []
+    started = False
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if started:
+                    yield ''.join(seq)
+                seq = []
+                started = True
+            else:
+                seq.append(line.strip())
+    if started:
+        yield ''.join(seq)
+
+
+#   A function to find where each record starts in a FASTA file, in the
+#   order of the records
+def record_offsets(fname):
+    records = []
+    offset = 0
+    start = None
+    with open(fname, 'rb') as f:
+        for line in f:
+            if line.startswith('>'):
+                if start is not None:
+                    records.append((start, offset - start))
+                start = offset
+            offset += len(line)
+    if start is not None:
+        records.append((start, offset - start))
+    return records
+
+
+#   A function to build the k-mer index of a species. cds is the CDS FASTA
+#   file, and prot is its translation, with the records in the same order.
+#   The index is written next to the CDS file.
+def build_kmer_index(cds, prot, l):
+    l.info('Building k-mer index for ' + cds)
+    records = record_offsets(cds)
+    n_buckets = len(ALPHABET) ** K
+    #   First pass: count the sequences that have each k-mer
+    counts = array(ITEM, [0]) * (n_buckets + 1)
+    n_seqs = 0
+    for prot_seq in fasta_seqs(prot):
+        for code in kmer_codes(prot_seq):
+            counts[code + 1] += 1
+        n_seqs += 1
+    if n_seqs != len(records):
+        l.error(
+            'The translation of ' + cds + ' has ' + str(n_seqs) +
+            ' records, but the CDS file has ' + str(len(records)) +
+            '. Not building the k-mer index.')
+        return False
+    #   Turn the counts into the offset of each bucket in the postings
+    for i in xrange(1, n_buckets + 1):
+        counts[i] += counts[i - 1]
+    starts = counts
+    #   Second pass: fill in the postings, which are the record numbers that
+    #   have each k-mer, in order
+    postings = array(ITEM, [0]) * starts[n_buckets]
+    cursor = array(ITEM, starts)
+    for ordinal, prot_seq in enumerate(fasta_seqs(prot)):
+        for code in kmer_codes(prot_seq):
+            postings[cursor[code]] = ordinal
+            cursor[code] += 1
+    #   Write the index to a temporary file and rename it, so that a partial
+    #   index is never read
+    out_name = index_name(cds)
+    tmp_name = out_name + '.tmp' + str(os.getpid())
+    handle = open(tmp_name, 'wb')
+    handle.write(HEADER.pack(MAGIC, VERSION, K, n_seqs, n_buckets))
+    for offset, length in records:
+        handle.write(RECORD.pack(offset, length))
+    starts.tofile(handle)
+    postings.tofile(handle)
+    handle.close()
+    os.rename(tmp_name, out_name)
+    l.debug('Indexed ' + str(len(postings)) + ' k-mers in ' + str(n_seqs) +
+            ' sequences.')
+    return True
+
+
+class KmerIndex(object):
+    """A class to read the k-mer index of a species database. The index is
+    memory-mapped, so only the buckets of the k-mers in a query are read.
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        cds (str)               Path to the CDS FASTA file
+        n_seqs (int)            Number of sequences in the database
+        n_buckets (int)         Number of possible k-mers
+
+    Contains the following methods:
+        candidates(self, prot_seqs, max_candidates, min_shared):
+            Return the record numbers of the sequences that share the most
+            k-mers with any of a list of protein sequences.
+
+        record(self, ordinal):
+            Return the ID and sequence of a record in the CDS file.
+    """
+    #   Buckets with more than this share of the sequences in them are
+    #   skipped, since such common k-mers say little about homology
+    MAX_BUCKET_SHARE = 0.05
+
+    def __init__(self, cds, verbose):
+        self.mainlog = set_verbosity.verbosity('Kmer_Index', verbose)
+        self.cds = cds
+        self.handle = open(index_name(cds), 'rb')
+        self.mm = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, k, self.n_seqs, self.n_buckets = HEADER.unpack_from(
+            self.mm, 0)
+        if magic != MAGIC or version != VERSION or k != K:
+            raise ValueError('Unknown k-mer index format in ' + cds)
+        self.records_at = HEADER.size
+        self.starts_at = self.records_at + RECORD.size * self.n_seqs
+        self.postings_at = self.starts_at + 4 * (self.n_buckets + 1)
+        return
+
+    def bucket(self, code):
+        """Return the record numbers that have a k-mer."""
+        first, last = struct.unpack_from(
+            '=II',
+            self.mm,
+            self.starts_at + 4 * code)
+        postings = array(ITEM)
+        postings.fromstring(
+            self.mm[self.postings_at + 4 * first:self.postings_at + 4 * last])
+        return postings
+
+    def candidates(self, prot_seqs, max_candidates, min_shared=2):
+        """Count the k-mers that each record shares with each protein
+        sequence, and return the record numbers of the best max_candidates
+        records for each sequence, with at least min_shared k-mers."""
+        limit = max(1, int(self.n_seqs * self.MAX_BUCKET_SHARE))
+        chosen = set()
+        for prot in prot_seqs:
+            shared = {}
+            for code in kmer_codes(prot):
+                postings = self.bucket(code)
+                if len(postings) > limit:
+                    continue
+                for ordinal in postings:
+                    shared[ordinal] = shared.get(ordinal, 0) + 1
+            ranked = sorted(
+                [(count, ordinal) for ordinal, count in shared.iteritems()
+                 if count >= min_shared],
+                reverse=True)
+            chosen.update([ordinal for count, ordinal in
+                           ranked[:max_candidates]])
+        return sorted(chosen)
+
+    def record(self, ordinal):
+        """Return the first word of the defline and the sequence of a record
+        in the CDS file."""
+        offset, length = RECORD.unpack_from(
+            self.mm,
+            self.records_at + RECORD.size * ordinal)
+        with open(self.cds, 'rb') as f:
+            f.seek(offset)
+            lines = f.read(length).split('\n')
+        fields = lines[0][1:].split(None, 1)
+        return (fields[0] if fields else '', ''.join(lines[1:]).strip())
+
+    def close(self):
+        """Close the memory map."""
+        self.mm.close()
+        self.handle.close()
+        return
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""A class to store the best hit of every target species gene in every other
+species, so that `align' can look up orthologues instead of searching."""
+
+#   Import standard library modules here
+import os
+import hashlib
+
+#   Import our helper scripts here
+from lrt_predict.General import file_funcs
+from lrt_predict.General import set_verbosity
+from lrt_predict.Blast import hit_cache
+
+
+class OrthologTable(object):
+    """A class to write and read the table of orthologues that is built by
+    the `orthologs' subcommand. The table is a tab-delimited file under the
+    base directory, with one row for each target gene and species database:
+        query ID, query SHA1, database, database checksum, program, E-value
+        threshold, hit sequence ID, hit GenBank ID
+    Genes without a hit in a database have NA in the last two columns. The
+    rows of a gene are kept together, and an offset index (.idx) of the first
+    row of each gene is written alongside the table, so that looking up a gene
+    only reads its own rows. The index is keyed on the SHA1 of the sequence,
+    so that a query is found even if its ID differs from the one in the
+    target species database.
+
+    A row is only used if the query sequence, the database checksum, the
+    program, and the E-value threshold all match the current search, so that
+    an out of date table is never trusted.
+
+    Contains the following class attributes:
+        TABLE_DIR (str)         Name of the directory under the base
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        table (str)             Path to the table
+        identity (HitCache)     Used for the database checksums
+
+    Contains the following methods:
+        write(self, rows):
+            Write the table and its index. rows is an iterable of
+            (query ID, query sequence, [(database, program, E-value, title)])
+
+        lookup(self, query_seqs, databases, evalue, program):
+            Look up the hits for a set of queries. Returns a dictionary of
+            database -> (query ID -> hit title or None) for the databases in
+            which every query has a usable row.
+    """
+    TABLE_DIR = 'Orthologs'
+
+    def __init__(self, base, target, verbose):
+        self.mainlog = set_verbosity.verbosity('Ortholog_Table', verbose)
+        self.table = os.path.join(
+            base,
+            self.TABLE_DIR,
+            target + '_Orthologs.txt')
+        #   The hit cache knows how to identify a build of a database
+        self.identity = hit_cache.HitCache(base, 0, verbose)
+        return
+
+    def query_hash(self, seq):
+        """Return the SHA1 of a query sequence."""
+        return hashlib.sha1(str(seq).upper()).hexdigest()
+
+    def write(self, rows):
+        """Write the table and its offset index. The table is written to a
+        temporary file and renamed, so that `align' never reads a partial
+        table."""
+        out_dir = os.path.dirname(self.table)
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        tmp_name = self.table + '.tmp' + str(os.getpid())
+        index = {}
+        identities = {}
+        offset = 0
+        handle = open(tmp_name, 'w')
+        for qid, qseq, hits in rows:
+            start = offset
+            qhash = self.query_hash(qseq)
+            for database, program, evalue, title in hits:
+                if database not in identities:
+                    identities[database] = self.identity.db_identity(database)
+                if title:
+                    seq_id, gb_id = title.split(' ')[0:2]
+                else:
+                    seq_id, gb_id = ('NA', 'NA')
+                line = '\t'.join([
+                    qid,
+                    qhash,
+                    database,
+                    identities[database],
+                    program,
+                    repr(float(evalue)),
+                    seq_id,
+                    gb_id]) + '\n'
+                handle.write(line)
+                offset += len(line)
+            index[qhash] = (start, offset - start)
+        handle.close()
+        os.rename(tmp_name, self.table)
+        file_funcs.write_offset_index(self.table, index, self.mainlog)
+        self.mainlog.info(
+            'Wrote orthologues of ' + str(len(index)) + ' genes into ' +
+            self.table)
+        return
+
+    def lookup(self, query_seqs, databases, evalue, program):
+        """Look up the hits for a dictionary of query ID -> sequence in a list
+        of databases. Returns a dictionary of database -> (query ID -> title)
+        for the databases that every query has a usable row for. Titles are
+        None for queries with no hit in that database."""
+        if not os.path.isfile(self.table):
+            self.mainlog.debug('No ortholog table at ' + self.table)
+            return {}
+        index = file_funcs.read_offset_index(self.table, self.mainlog)
+        if index is None:
+            self.mainlog.warning(
+                'The index of ' + self.table + ' is missing or out of date. '
+                'Run `orthologs\' to rebuild it.')
+            return {}
+        evalue = repr(float(evalue))
+        databases = set(databases)
+        identities = {}
+        found = {}
+        with open(self.table, 'rb') as handle:
+            for qid, qseq in query_seqs.iteritems():
+                qhash = self.query_hash(qseq)
+                if qhash not in index:
+                    return {}
+                offset, length = index[qhash]
+                handle.seek(offset)
+                for line in handle.read(length).splitlines():
+                    tmp = line.split('\t')
+                    database = tmp[2]
+                    if database not in databases:
+                        continue
+                    if database not in identities:
+                        try:
+                            identities[database] = self.identity.db_identity(
+                                database)
+                        except OSError:
+                            identities[database] = None
+                    #   Only trust rows from the same search of the same
+                    #   build of the database
+                    if [tmp[1], tmp[3], tmp[4], tmp[5]] != [
+                            qhash, identities[database], program, evalue]:
+                        continue
+                    if tmp[6] == 'NA':
+                        title = None
+                    else:
+                        title = tmp[6] + ' ' + tmp[7]
+                    found.setdefault(database, {})[qid] = title
+        #   Only keep the databases that have a row for every query
+        return dict([
+            (database, hits) for database, hits in found.iteritems()
+            if len(hits) == len(query_seqs)])
@@ -4,58 +4,48 @@
 #   Basically just a fancy wrapper around blastdbcmd
 
 import subprocess
-import re
-import os
-
-#   create a variable to hold the path to our installation directory
-#   It is two levels above this one
-#   os.path.realpath(__file__) is the full path to this script, sequence_fetch.py
-#   rsplit() splits from the right end of the file, and the number argumetn
-#   tells how many times to split. We take the first element of the resulting list.
-LRT_PATH = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
-#   The directory that contains shell scripts
-SEQ_FETCH_SCRIPT = os.path.join(LRT_PATH, 'Shell_Scripts', 'Seq_From_BLASTdb.sh')
+import tempfile
 
 
 #   Easier way: just use the packaged blastdbcmd from NCBI
-def blastdbcmd(path, db, seqID):
-    #   The script is written in shell, so this function just calls it and
-    #   checks the output
-    #   Build the shell command. Apparently, we do no have to escape the pipe characters,
-    #   the python warpper must handle that
-    cmd = ['bash', SEQ_FETCH_SCRIPT, path, db, seqID]
-    #   Execute the script
+def blastdbcmd(path, db, seqIDs):
+    #   All of the sequence IDs are fetched with one call to blastdbcmd. They
+    #   are written one per line into a temporary file, which is passed as the
+    #   -entry_batch argument. blastdbcmd is run directly, rather than through
+    #   a shell script, so there is only one process per database.
+    id_file = tempfile.NamedTemporaryFile(
+        mode='w+t',
+        prefix='BAD_Mutations_EntryBatch_',
+        suffix='.txt')
+    id_file.write('\n'.join(seqIDs) + '\n')
+    id_file.flush()
+    cmd = [path, '-db', db, '-entry_batch', id_file.name]
+    #   Execute the command
     #   shell=False to ensure that we aren't executing commands from untrusted
     #   sources. We set out and err to subprocess.PIPE so we can save the actual
     #   output for later
     p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = p.communicate()
-    #   return the output, which is just the fasta file.
+    id_file.close()
+    #   return the output, which is a FASTA file with the sequences in the
+    #   same order as the IDs.
     return (out, err)
 
 
-#   Failing that, we can use a regular expression to get it
-#   Regular expression written by Paul Hoffman.
-#   Note that this solution is somewhat expensive, since it reads up
-#   the entire sequence into memory
-def get_seq_by_regex(db, seqID):
-    #   Open a handle to the fasta file
-    handle = open(db, 'r')
-    #   And read its contents into memory.
-    fasta = handle.read()
-    #   Then we build the regex out of the sequence id
-    #   We have to prepend a >, since that starts off the FASTA record
-    s = '>' + seqID
-    #   Then, we have to escape any dots in the name, since . is a special
-    #   regex character
-    s = s.replace('.', r'\.')
-    #   Then build the full regex
-    #   Match the start of the FASTA record, followed by any number of
-    #   characters, followed by a newline, then ATCGN, across multiple lines
-    #   Thanks to Paul Hoffman for the regex.
-    pattern = re.compile('(^' + s + '.*\n[ATCGN\n]*)', re.M)
-    #   Search the fasta for the right sequence and return it
-    target_seq = pattern.search(fasta)
-    #   Close this file handle
-    handle.close()
-    return target_seq
+#   Failing that, we can read it straight out of the FASTA file. The offset
+#   index built by `fetch' gives the byte offset and length of each record,
+#   so we only have to seek to it and read that record, rather than reading
+#   the entire file into memory.
+def get_seqs_by_offset(db, index, seqIDs):
+    seqs = {}
+    #   Open the FASTA file once for all of the sequences
+    with open(db, 'rb') as handle:
+        for seqID in seqIDs:
+            if seqID not in index:
+                continue
+            offset, length = index[seqID]
+            handle.seek(offset)
+            record = handle.read(length)
+            #   Drop the defline, and join the sequence lines back together
+            seqs[seqID] = ''.join(record.split('\n')[1:]).replace('\r', '')
+    return seqs
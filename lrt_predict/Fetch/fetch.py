@@ -2,12 +2,18 @@
 """A class that defines a general fetching class. Phytozome and Ensembl
 classes will inherit from this one."""
 
+import os
+
 #   Import our helper scripts
 from lrt_predict.General import check_modules
 from lrt_predict.General import file_funcs
 from lrt_predict.General import set_verbosity
 from lrt_predict.Fetch import format_blast
 from lrt_predict.General import dir_funcs
+from lrt_predict.General import catalog
+from lrt_predict.Blast import hit_cache
+from lrt_predict.Blast import combined_db
+from lrt_predict.Blast import kmer_index
 
 
 class Fetcher(object):
@@ -16,6 +22,7 @@ class Fetcher(object):
 
     def __init__(self, base, verbose):
         self.base = base
+        self.verbose = verbose
         self.to_convert = []
         self.mainlog = set_verbosity.verbosity(__name__, verbose)
         self.mainlog.debug('Creating new instance of Fetcher')
@@ -40,16 +47,91 @@ class Fetcher(object):
         makeblastdb_path = check_modules.check_executable('makeblastdb')
         #   Check if the list of updated CDS files is empty or not
         if not self.to_convert:
-            #   If it is empty, then populate it with all of them
-            fname_list = file_funcs.get_file_by_ext(
-                self.base,
-                '.fa.gz',
-                self.mainlog)
+            #   If it is empty, then populate it with all of them. The species
+            #   catalog lists the databases that have been built, so we only
+            #   search the base directory if it is out of date.
+            entries = catalog.read_catalog(self.base, self.mainlog)
+            if entries is not None:
+                fname_list = [
+                    path + '.gz'
+                    for path in sorted(entries)
+                    if os.path.isfile(path + '.gz')]
+            else:
+                fname_list = file_funcs.get_file_by_ext(
+                    self.base,
+                    '.fa.gz',
+                    self.mainlog)
         else:
             fname_list = self.to_convert
         #   for each one
+        #   Cached BLAST hits for a rebuilt database are no longer valid. The
+        #   size limit does not matter here, since we only remove entries.
+        cache = hit_cache.HitCache(self.base, 0, self.verbose)
+        built = []
         for fname in fname_list:
             out, error = format_blast.format_blast(makeblastdb_path, fname)
             self.mainlog.info('stdout: \n' + out)
             self.mainlog.info('stderr: \n' + error)
+            #   The database is named after the unzipped file
+            db_name = fname.replace('.gz', '')
+            #   Record the checksum of the file the database was built from,
+            #   so that searches can tell which build of the database they
+            #   were run against.
+            file_funcs.write_checksum(
+                db_name,
+                file_funcs.calculate_md5(fname, self.mainlog),
+                self.mainlog)
+            cache.invalidate(db_name)
+            #   Index where each sequence starts in the FASTA file, so that
+            #   sequences can be read without blastdbcmd
+            file_funcs.write_offset_index(
+                db_name,
+                file_funcs.build_offset_index(db_name, self.mainlog),
+                self.mainlog)
+            #   Build a translated protein database too, for searching with
+            #   blastp instead of tblastx
+            prot_name = file_funcs.protein_db_name(db_name)
+            self.mainlog.info('Translating ' + db_name + ' into ' + prot_name)
+            format_blast.translate_cds(db_name, prot_name)
+            out, error = format_blast.format_db(
+                makeblastdb_path,
+                prot_name,
+                'prot')
+            self.mainlog.info('stdout: \n' + out)
+            self.mainlog.info('stderr: \n' + error)
+            #   And index the k-mers of the translation, for picking the
+            #   candidates to search
+            kmer_index.build_kmer_index(db_name, prot_name, self.mainlog)
+            built.append(db_name)
+        #   Add the new databases to the species catalog
+        catalog.update_catalog(self.base, built, self.mainlog)
+        return
+
+    def build_combined(self):
+        """Concatenate all of the species databases into one combined
+        database, with the species name in each defline, so that a query can
+        be searched against all species at once. A translated protein version
+        is built alongside it."""
+        makeblastdb_path = check_modules.check_executable('makeblastdb')
+        databases = catalog.species_databases(self.base, self.mainlog)
+        if not databases:
+            self.mainlog.error(
+                'There are no species databases in ' + self.base + ' to '
+                'combine. Run `fetch\' first.')
+            return
+        fname, manifest = combined_db.write_combined(
+            self.base,
+            databases,
+            self.mainlog)
+        out, error = format_blast.format_db(makeblastdb_path, fname, 'nucl')
+        self.mainlog.info('stdout: \n' + out)
+        self.mainlog.info('stderr: \n' + error)
+        prot_name = file_funcs.protein_db_name(fname)
+        format_blast.translate_cds(fname, prot_name)
+        out, error = format_blast.format_db(makeblastdb_path, prot_name, 'prot')
+        self.mainlog.info('stdout: \n' + out)
+        self.mainlog.info('stderr: \n' + error)
+        combined_db.write_manifest(self.base, manifest, self.mainlog)
+        #   Searches against the old combined database are not valid
+        hit_cache.HitCache(self.base, 0, self.verbose).invalidate(fname)
         return
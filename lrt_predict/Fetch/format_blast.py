@@ -7,6 +7,9 @@ import subprocess
 #   To handle paths
 import os
 
+#   To translate the CDS
+from lrt_predict.General import translation
+
 #   create a variable to hold the path to our installation directory
 #   It is two levels above this one
 #   os.path.realpath(__file__) is the full path to this script, blast_databases.py
@@ -30,3 +33,46 @@ def format_blast(makeblastdb_path, fname):
     p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, err = p.communicate()
     return (out, err)
+
+
+#   Function to write a protein translation of a CDS FASTA file. The records
+#   are written in the same order and with the same deflines as the CDS file,
+#   so that the ordinal IDs that BLAST gives the protein database match those
+#   of the CDS database, and hits map straight back to CDS records.
+def translate_cds(fname, outname):
+    handle = open(outname, 'w')
+    defline = None
+    seq = []
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                if defline is not None:
+                    write_translation(handle, defline, ''.join(seq))
+                defline = line[1:].strip()
+                seq = []
+            else:
+                seq.append(line.strip())
+    if defline is not None:
+        write_translation(handle, defline, ''.join(seq))
+    handle.close()
+    return
+
+
+#   Function to write the translation of one CDS record. Any partial codon at
+#   the end is dropped, and the terminal stop codon is removed. Every record
+#   has to have some sequence, or makeblastdb would skip it and the ordinals
+#   would no longer line up.
+def write_translation(handle, defline, cds):
+    prot = translation.translate(cds).rstrip('*') or 'X'
+    handle.write('>' + defline + '\n' + prot + '\n')
+    return
+
+
+#   Function to make a BLAST database out of a FASTA file that does not need
+#   to be unzipped or cleaned up first, such as a translated CDS file. This
+#   one is simple enough that it calls makeblastdb directly.
+def format_db(makeblastdb_path, fname, dbtype):
+    cmd = [makeblastdb_path, '-in', fname, '-dbtype', dbtype]
+    p = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return (out, err)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to keep a catalog of the species
+#   databases in the base directory. The catalog is written by `fetch' when it
+#   builds the databases, so that searches do not have to walk the base
+#   directory to find them.
+
+import os
+import time
+
+from lrt_predict.General import file_funcs
+
+#   Name of the catalog file, in the base directory
+CATALOG_NAME = 'Species_Catalog.txt'
+#   Columns of the catalog
+FIELDS = ['path', 'sequences', 'length', 'checksum', 'built']
+
+
+#   Return the path to the catalog for a base directory
+def catalog_path(base):
+    return os.path.join(base, CATALOG_NAME)
+
+
+#   A function to summarize a single species database. Returns a dictionary
+#   with the same keys as the catalog columns.
+def describe_database(fname, l):
+    l.debug('Counting sequences in ' + fname)
+    nseq = 0
+    length = 0
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                nseq += 1
+            else:
+                length += len(line.strip())
+    return {
+        'path': os.path.abspath(fname),
+        'sequences': nseq,
+        'length': length,
+        'checksum': file_funcs.read_checksum(fname, l) or 'NA',
+        'built': int(time.time())
+        }
+
+
+#   A function to read the catalog. Returns a dictionary of database path ->
+#   entry, or None if there is no catalog or it is out of date. The catalog
+#   is out of date if any of the databases in it are missing, or have been
+#   modified since they were added to the catalog.
+def read_catalog(base, l):
+    cat_file = catalog_path(base)
+    if not os.path.isfile(cat_file):
+        l.debug('No species catalog in ' + base)
+        return None
+    entries = {}
+    try:
+        with open(cat_file, 'r') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip():
+                    continue
+                tmp = line.rstrip('\n').split('\t')
+                entry = dict(zip(FIELDS, tmp))
+                entry['sequences'] = int(entry['sequences'])
+                entry['length'] = int(entry['length'])
+                entry['built'] = int(entry['built'])
+                entries[entry['path']] = entry
+    except (IOError, ValueError, KeyError):
+        l.warning('Could not read the species catalog ' + cat_file)
+        return None
+    for path, entry in entries.iteritems():
+        try:
+            mtime = int(os.path.getmtime(path))
+        except OSError:
+            l.info('Species catalog is out of date: ' + path + ' is missing.')
+            return None
+        if mtime > entry['built']:
+            l.info('Species catalog is out of date: ' + path +
+                   ' has been modified.')
+            return None
+    return entries
+
+
+#   A function to write the catalog. It is written to a temporary file and
+#   then renamed, so that jobs reading it never see a partial catalog.
+def write_catalog(base, entries, l):
+    cat_file = catalog_path(base)
+    l.info('Writing species catalog ' + cat_file)
+    tmp_name = cat_file + '.tmp' + str(os.getpid())
+    with open(tmp_name, 'w') as f:
+        f.write('#' + '\t'.join(FIELDS) + '\n')
+        for path in sorted(entries):
+            f.write(
+                '\t'.join([str(entries[path][field]) for field in FIELDS]) +
+                '\n')
+    os.rename(tmp_name, cat_file)
+    return
+
+
+#   A function to add newly built databases to the catalog. If there is no
+#   usable catalog yet, the base directory is walked once to describe the
+#   databases that are already there.
+def update_catalog(base, fnames, l):
+    entries = read_catalog(base, l)
+    if entries is None:
+        entries = {}
+        for fname in file_funcs.get_file_by_ext(base, '.fa', l):
+            if fname:
+                entry = describe_database(fname, l)
+                entries[entry['path']] = entry
+        #   The new databases were described along with the others
+        fnames = [f for f in fnames if os.path.abspath(f) not in entries]
+    for fname in fnames:
+        entry = describe_database(fname, l)
+        entries[entry['path']] = entry
+    write_catalog(base, entries, l)
+    return entries
+
+
+#   A function to remove the catalog, for when files have been downloaded but
+#   not yet built into databases.
+def mark_stale(base, l):
+    cat_file = catalog_path(base)
+    if os.path.isfile(cat_file):
+        l.info('Removing out of date species catalog ' + cat_file)
+        os.remove(cat_file)
+    return
+
+
+#   A function to list the species databases. The catalog is used if it is up
+#   to date, and the base directory is walked otherwise.
+def species_databases(base, l):
+    entries = read_catalog(base, l)
+    if entries is not None:
+        l.debug('Reading species databases from the catalog.')
+        return sorted(entries)
+    l.debug('Searching ' + base + ' for species databases.')
+    return [f for f in file_funcs.get_file_by_ext(base, '.fa', l) if f]
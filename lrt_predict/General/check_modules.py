@@ -6,7 +6,7 @@
 from distutils import spawn
 
 
-def check_modules(setup=False, fetch=False, predict=False):
+def check_modules(setup=False, fetch=False, predict=False, native=False):
     """Function to try to import required modules, and return a list of modules
     that are not installed."""
     missing_modules = []
@@ -22,6 +22,13 @@ def check_modules(setup=False, fetch=False, predict=False):
             import Bio
         except ImportError:
             missing_modules.append('Biopython')
+    #   If predicting without HyPhy
+    if native:
+        #   NumPy
+        try:
+            import numpy
+        except ImportError:
+            missing_modules.append('NumPy')
     return missing_modules
 
 
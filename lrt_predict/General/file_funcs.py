@@ -108,3 +108,88 @@ def get_file_by_ext(basedir, suffix, l):
     file_list = raw_files.strip().split('\n')
     l.debug('Found ' + str(len(file_list)) +  ' ' + suffix + ' files in ' + basedir)
     return file_list
+
+
+#   A function to record the checksum of the file that a database was built
+#   from. It is stored next to the database, with a .md5 suffix.
+def write_checksum(fname, checksum, l):
+    l.debug('Recording checksum ' + str(checksum) + ' for ' + fname)
+    with open(fname + '.md5', 'w') as f:
+        f.write(str(checksum) + '\n')
+    return
+
+
+#   And a function to read it back. Returns None if no checksum was recorded
+def read_checksum(fname, l):
+    try:
+        with open(fname + '.md5', 'r') as f:
+            checksum = f.read().strip()
+    except IOError:
+        l.debug('No checksum recorded for ' + fname)
+        return None
+    return checksum or None
+
+
+#   A function to build an index of where each record starts in a FASTA file.
+#   Returns a dictionary of sequence ID -> (byte offset, length in bytes),
+#   where the ID is the first word of the defline, and the record runs from
+#   the '>' up to the start of the next record.
+def build_offset_index(fname, l):
+    l.info('Building offset index for ' + fname)
+    index = {}
+    offset = 0
+    current = None
+    start = 0
+    #   Read in binary mode, so that the offsets are exact byte counts
+    with open(fname, 'rb') as f:
+        for line in f:
+            if line.startswith('>'):
+                if current is not None:
+                    index[current] = (start, offset - start)
+                fields = line[1:].split(None, 1)
+                current = fields[0] if fields else ''
+                start = offset
+            offset += len(line)
+    if current is not None:
+        index[current] = (start, offset - start)
+    l.debug('Indexed ' + str(len(index)) + ' sequences in ' + fname)
+    return index
+
+
+#   A function to write the offset index next to the FASTA file, with a .idx
+#   suffix. It is written to a temporary file first, then renamed, so that a
+#   partial index is never read.
+def write_offset_index(fname, index, l):
+    idx_name = fname + '.idx'
+    l.debug('Writing offset index ' + idx_name)
+    tmp_name = idx_name + '.tmp' + str(os.getpid())
+    with open(tmp_name, 'w') as f:
+        for seq_id, (offset, length) in index.iteritems():
+            f.write(seq_id + '\t' + str(offset) + '\t' + str(length) + '\n')
+    os.rename(tmp_name, idx_name)
+    return
+
+
+#   And a function to read it back. Returns None if there is no index, or if
+#   the FASTA file has been modified since the index was written.
+def read_offset_index(fname, l):
+    idx_name = fname + '.idx'
+    try:
+        if os.path.getmtime(idx_name) < os.path.getmtime(fname):
+            l.debug('Offset index ' + idx_name + ' is out of date.')
+            return None
+        index = {}
+        with open(idx_name, 'r') as f:
+            for line in f:
+                seq_id, offset, length = line.rstrip('\n').split('\t')
+                index[seq_id] = (int(offset), int(length))
+    except (OSError, IOError, ValueError):
+        l.debug('No usable offset index for ' + fname)
+        return None
+    return index
+
+
+#   A function to give the name of the translated protein database that is
+#   built alongside a CDS database
+def protein_db_name(fname):
+    return fname + '.faa'
@@ -129,6 +129,14 @@ def parse_args():
         action='store_true',
         default=False,
         help='Do not fetch new CDS from databases, just convert to BLAST db.')
+    fetch_args.add_argument(
+        '--combined-db',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Also build one database that combines all species, for '
+            'searching with `align --combined-db\'.'))
 
     #   Create a parser for 'align'
     align_args = subparser.add_parser(
@@ -150,18 +158,225 @@ def parse_args():
         required=False,
         type=float,
         help='E-value threshold for accepting sequences into the alignment.')
-    align_args.add_argument(
+    #   Align either a single query, or a batch of them
+    queries = align_args.add_mutually_exclusive_group(required=True)
+    queries.add_argument(
         '--fasta',
         '-f',
-        required=True,
         default=None,
         help='Path to the input FASTA file.')
+    queries.add_argument(
+        '--batch',
+        '-B',
+        default=None,
+        help=(
+            'Path to a multi-record FASTA file, or a file listing one query '
+            'FASTA file per line. Each species database is searched once for '
+            'the whole batch.'))
     align_args.add_argument(
         '--output',
         '-o',
         required=False,
         default=os.getcwd(),
         help='Output directory.')
+    align_args.add_argument(
+        '--num-cpus',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of CPUs to use. Defaults to the number allocated by the '
+            'batch scheduler, or the number of CPUs on the machine.'))
+    align_args.add_argument(
+        '--blast-workers',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of species databases to search at once. The CPUs are '
+            'split evenly between them. Defaults to one per CPU.'))
+    align_args.add_argument(
+        '--search-mode',
+        required=False,
+        choices=['tblastx', 'blastp'],
+        default=None,
+        help=(
+            'Search the species databases with tblastx, or with blastp '
+            'against the translated databases built by `fetch\'. Defaults '
+            'to tblastx.'))
+    align_args.add_argument(
+        '--combined-db',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Search all species at once in the combined database built by '
+            '`fetch --combined-db\'. BLAST keeps 100 hits per species for '
+            'each query, counted over all species, so a species with many '
+            'paralogues can push out the best hit of another species.'))
+    align_args.add_argument(
+        '--prefilter',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Only search the N sequences of each species that share the most '
+            'amino acid k-mers with the query. Needs the k-mer indices built '
+            'by `fetch\'. Off by default.'))
+    align_args.add_argument(
+        '--cluster-isoforms',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'With --batch, only search the longest isoform of each gene, and '
+            'give its hits to the other isoforms. Isoforms whose hits look '
+            'doubtful are searched on their own.'))
+    align_args.add_argument(
+        '--pasta-cpus',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of CPUs for each Pasta alignment. Defaults to one per 25 '
+            'sequences.'))
+    align_args.add_argument(
+        '--pasta-heap',
+        required=False,
+        default=None,
+        help=(
+            'Java heap size for each Pasta alignment, such as 4g or 2048m. '
+            'Defaults to a size guessed from the number and length of the '
+            'sequences.'))
+    align_args.add_argument(
+        '--incremental',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Update the alignment and tree already in the output directory '
+            'with the sequences that were added, changed, or removed, instead '
+            'of realigning with Pasta.'))
+    align_args.add_argument(
+        '--max-divergence',
+        required=False,
+        type=float,
+        default=None,
+        help=(
+            'With --incremental, realign with Pasta if an added sequence has '
+            'a p-distance above this to every other sequence. Defaults to '
+            '0.4.'))
+    align_args.add_argument(
+        '--aligner',
+        required=False,
+        choices=['auto', 'pasta', 'prank'],
+        default=None,
+        help=(
+            'Aligner to use. auto uses PRANK for small gene families and '
+            'PASTA for large ones. Defaults to auto.'))
+    align_args.add_argument(
+        '--benchmark',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Run every installed aligner on each query, and write the wall '
+            'time and agreement with the first aligner into '
+            'Aligner_Benchmark.txt in the output directory.'))
+    align_args.add_argument(
+        '--species-tree',
+        required=False,
+        default=None,
+        help=(
+            'Newick tree of the species in the databases. It is pruned to the '
+            'species of each query, instead of estimating a tree from the '
+            'alignment.'))
+    align_args.add_argument(
+        '--species-tree-mode',
+        required=False,
+        choices=['guide', 'fixed'],
+        default=None,
+        help=(
+            'Use the pruned species tree as the starting tree of the aligner '
+            '(guide), or also as the output tree (fixed). Defaults to guide.'))
+
+    #   Create a parser for 'orthologs'
+    ortho_args = subparser.add_parser(
+        'orthologs',
+        help=(
+            'Find the best hit of every target species gene in every other '
+            'species, so that `align\' can skip searching.'))
+    ortho_args.add_argument(
+        '--base',
+        '-b',
+        required=False,
+        help='Base directory for species databses.')
+    ortho_args.add_argument(
+        '--config',
+        '-c',
+        required=False,
+        help='Use this configuration file.')
+    ortho_args.add_argument(
+        '--evalue',
+        '-e',
+        required=False,
+        type=float,
+        help='E-value threshold for accepting sequences into the alignment.')
+    ortho_args.add_argument(
+        '--target-cds',
+        '-t',
+        required=False,
+        default=None,
+        help=(
+            'FASTA file of target species CDS. Defaults to the target species '
+            'database in the base directory.'))
+    ortho_args.add_argument(
+        '--chunk-size',
+        required=False,
+        type=int,
+        default=500,
+        help='Number of genes to search at once. Defaults to 500.')
+    ortho_args.add_argument(
+        '--num-cpus',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of CPUs to use. Defaults to the number allocated by the '
+            'batch scheduler, or the number of CPUs on the machine.'))
+    ortho_args.add_argument(
+        '--blast-workers',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of species databases to search at once. The CPUs are '
+            'split evenly between them. Defaults to one per CPU.'))
+    ortho_args.add_argument(
+        '--search-mode',
+        required=False,
+        choices=['tblastx', 'blastp'],
+        default=None,
+        help='Search with tblastx or blastp. Defaults to tblastx.')
+    ortho_args.add_argument(
+        '--combined-db',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Search all species at once in the combined database built by '
+            '`fetch --combined-db\'. BLAST keeps 100 hits per species for '
+            'each query, counted over all species, so a species with many '
+            'paralogues can push out the best hit of another species.'))
+    ortho_args.add_argument(
+        '--prefilter',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Only search the N sequences of each species that share the most '
+            'amino acid k-mers with the query. Needs the k-mer indices built '
+            'by `fetch\'. Off by default.'))
 
     #   Create a parser for 'predict'
     predict_args = subparser.add_parser(
@@ -172,29 +387,39 @@ def parse_args():
         '-c',
         required=False,
         help='Use this configuration file.')
-    #   Give 'predict' some arguments
-    predict_args.add_argument(
+    #   Give 'predict' some arguments. Predict either one gene, or a batch
+    predict_queries = predict_args.add_mutually_exclusive_group(
+        required=True)
+    predict_queries.add_argument(
         '--fasta',
         '-f',
-        required=True,
         default=None,
         help='Path to the input FASTA file.')
+    predict_queries.add_argument(
+        '--batch',
+        '-B',
+        default=None,
+        help=(
+            'Path to a file listing the FASTA, alignment, tree, and '
+            'substitutions files of one gene per line, separated by tabs. '
+            'The genes are predicted on HyPhy processes that stay up between '
+            'genes.'))
     predict_args.add_argument(
         '--alignment',
         '-a',
-        required=True,
+        required=False,
         default=None,
         help='Path to the input multiple sequence alignment.')
     predict_args.add_argument(
         '--tree',
         '-r',
-        required=True,
+        required=False,
         default=None,
         help='Path to the phylogenetic tree.')
     predict_args.add_argument(
         '--substitutions',
         '-s',
-        required=True,
+        required=False,
         default=None,
         help='Path to the input substitutions file.')
     predict_args.add_argument(
@@ -203,6 +428,40 @@ def parse_args():
         required=False,
         default=os.getcwd(),
         help='Output directory.')
+    predict_args.add_argument(
+        '--engine',
+        required=False,
+        choices=['hyphy', 'native'],
+        default=None,
+        help=(
+            'Run the LRT with HyPhy, or with the same model in Python '
+            '(native, needs NumPy). Defaults to hyphy.'))
+    predict_args.add_argument(
+        '--full-scan',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Have HyPhy build the filters and likelihood functions of every '
+            'codon, as in earlier versions, and not only of the tested ones.'))
+    predict_args.add_argument(
+        '--refit',
+        required=False,
+        action='store_true',
+        default=False,
+        help=(
+            'Fit the background model again, even if a fit to the same '
+            'alignment and tree was saved by an earlier prediction.'))
+    predict_args.add_argument(
+        '--workers',
+        required=False,
+        type=int,
+        default=None,
+        help=(
+            'Number of HyPhy processes that test the positions of the gene '
+            'at once. The background model is fit once for all of them. With '
+            '--batch, the number of HyPhy processes that genes are sent to. '
+            'Defaults to 1.'))
 
     #   Create a parser for 'compile'
     compile_args = subparser.add_parser(
@@ -332,6 +591,27 @@ def validate_args(args, log):
             return (
                 False,
                 'Output directory is not readable/writable, or does not exist.')
+        if args['batch']:
+            if not file_funcs.file_exists(args['batch'], log):
+                return (
+                    False,
+                    'The specified batch file does not exist!')
+    #   Check the arguments passed to orthologs
+    elif args['action'] == 'orthologs':
+        if args['config']:
+            if not file_funcs.file_exists(args['config'], log):
+                return (
+                    False,
+                    'The specified configuration file does not exist!')
+        if args['target_cds']:
+            if not file_funcs.file_exists(args['target_cds'], log):
+                return (
+                    False,
+                    'The specified target CDS file does not exist!')
+        if args['chunk_size'] < 1:
+            return (
+                False,
+                'The chunk size must be at least 1.')
     #   Check arguments to predict
     elif args['action'] == 'predict':
         #   If config is suppled:
@@ -344,6 +624,19 @@ def validate_args(args, log):
             return (
                 False,
                 'Output directory is not readable/writable, or does not exist.')
+        #   The files of each gene in a batch are checked when it is read
+        if args['batch']:
+            if not file_funcs.file_exists(args['batch'], log):
+                return (
+                    False,
+                    'The specified batch file does not exist!')
+            return (args, None)
+        if not (args['alignment'] and args['tree'] and
+                args['substitutions']):
+            return (
+                False,
+                'An alignment, a tree, and a substitutions file are required '
+                'without --batch.')
         if not parse_input.valid_tree(args['tree'], log):
             return (
                 False,
@@ -5,6 +5,7 @@
 
 #   Import standard library modules here
 import re
+import os
 
 #   We need to handle sequence records, alignments, and phylogenies
 from Bio import SeqIO
@@ -77,6 +78,80 @@ def valid_fasta(f, log):
         return True
 
 
+def read_batch(f, outdir, log):
+    """Read the list of queries for a batch alignment. The file may be a
+    multi-record FASTA file, or a manifest with the path to one single-record
+    FASTA file per line. Records in a multi-record FASTA are split into
+    separate files in `outdir', named after the sequence ID. Returns a list of
+    single-record FASTA files, or False if the batch is not valid."""
+    if not file_funcs.file_exists(f, log):
+        log.error('File ' + f + ' does not exist.')
+        return False
+    with open(f, 'r') as handle:
+        first = handle.readline()
+    queries = []
+    #   A set for checking duplicates, since batches may be very large
+    seen = set()
+    if first.startswith('>'):
+        for rec in SeqIO.parse(f, 'fasta'):
+            #   Slashes are not allowed in filenames
+            qfile = os.path.join(outdir, rec.id.replace('/', '_') + '.fasta')
+            if qfile in seen:
+                log.error(
+                    'Sequence ID ' + rec.id + ' is used more than once in ' +
+                    f + '.')
+                return False
+            SeqIO.write(rec, qfile, 'fasta')
+            queries.append(qfile)
+            seen.add(qfile)
+    else:
+        with open(f, 'r') as handle:
+            for line in handle:
+                qfile = line.strip()
+                #   Skip blank lines and comments
+                if not qfile or qfile.startswith('#'):
+                    continue
+                if not valid_fasta(qfile, log):
+                    return False
+                queries.append(qfile)
+    log.info('Batch ' + f + ' contains ' + str(len(queries)) + ' queries.')
+    if not queries:
+        return False
+    return queries
+
+
+def read_predict_batch(f, log):
+    """Read the list of genes for a batch prediction. Each line has the paths
+    to the query FASTA, the alignment, the tree, and the substitutions file
+    of one gene, separated by tabs. Returns a list of (fasta, alignment,
+    tree, substitutions) tuples, or False if the batch is not valid."""
+    if not file_funcs.file_exists(f, log):
+        log.error('File ' + f + ' does not exist.')
+        return False
+    genes = []
+    with open(f, 'r') as handle:
+        for index, line in enumerate(handle):
+            #   Skip blank lines and comments
+            if not line.strip() or line.startswith('#'):
+                continue
+            tmp = line.strip().split('\t')
+            if len(tmp) != 4:
+                log.error(
+                    'Line ' + str(index+1) + ' of ' + f + ' does not have '
+                    'four tab-separated files.')
+                return False
+            fasta, msa, tree, subs = tmp
+            if not (valid_fasta(fasta, log) and valid_msa(msa, log) and
+                    valid_tree(tree, log) and parse_subs(subs, log)):
+                log.error('Line ' + str(index+1) + ' of ' + f + ' is invalid.')
+                return False
+            genes.append(tuple(tmp))
+    log.info('Batch ' + f + ' contains ' + str(len(genes)) + ' genes.')
+    if not genes:
+        return False
+    return genes
+
+
 def parse_subs(f, log):
     """Parse the input substitutions file. Returns a list of integers."""
     #   Does the file exist?
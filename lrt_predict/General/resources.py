@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to query the computing resources that
+#   are available to BAD_Mutations
+
+import os
+import multiprocessing
+
+#   Environment variables set by the batch schedulers we run under. These
+#   describe the number of cores that were actually allocated to the job,
+#   which may be far fewer than the number of cores on the node.
+SCHEDULER_CPU_VARS = [
+    'PBS_NUM_PPN',
+    'NCPUS',
+    'SLURM_CPUS_PER_TASK',
+    'NSLOTS']
+
+
+#   A function to get the number of CPUs that we are allowed to use
+def available_cpus():
+    """Return the number of CPUs allocated to this job. Checks the variables
+    set by PBS, Slurm, and SGE before falling back to the number of CPUs on
+    the machine."""
+    for var in SCHEDULER_CPU_VARS:
+        try:
+            ncpus = int(os.environ.get(var, ''))
+        except ValueError:
+            continue
+        if ncpus > 0:
+            return ncpus
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+#   Environment variables that give the memory allocated to the job, in MB
+SCHEDULER_MEM_VARS = [
+    'SLURM_MEM_PER_NODE']
+
+
+#   A function to read a memory size such as 4g, 512m, or 2048, and return
+#   it in megabytes. Plain numbers are taken to be megabytes.
+def parse_memory(value):
+    """Return a memory size string in MB. Accepts the k, m, g, and t suffixes
+    that Java and the schedulers use. Raises ValueError if the size cannot be
+    read."""
+    units = {'k': 1.0 / 1024, 'm': 1, 'g': 1024, 't': 1024 * 1024}
+    value = str(value).strip().lower().rstrip('b')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+#   A function to get the amount of memory we are allowed to use
+def available_memory():
+    """Return the memory allocated to this job in MB. Checks the variables set
+    by Slurm before falling back to the memory available on the machine.
+    Returns None if it cannot be found."""
+    for var in SCHEDULER_MEM_VARS:
+        try:
+            mem = parse_memory(os.environ.get(var, ''))
+        except ValueError:
+            continue
+        if mem > 0:
+            return mem
+    #   MemAvailable counts the page cache that can be freed, so it is better
+    #   than MemFree on a node that has been reading databases
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError, IndexError):
+        pass
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') //
+                (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return None
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+#   A script that contains a table-driven codon translator. The table is built
+#   once, when the module is imported, for every codon of IUPAC nucleotide
+#   codes, so translating a sequence is one dictionary lookup per codon. It
+#   does not need Biopython, so it can be used when fetching, searching,
+#   aligning, and predicting.
+
+#   The standard genetic code, as codon -> amino acid. Stop codons are *.
+BASES = 'TCAG'
+AMINO_ACIDS = (
+    'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG')
+CODONS = dict(zip(
+    [a + b + c for a in BASES for b in BASES for c in BASES],
+    AMINO_ACIDS))
+#   IUPAC nucleotide codes, and the bases that each one stands for
+IUPAC = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+#   Amino acid for codons that can not be translated to one amino acid. Pasta
+#   only takes X for ambiguous residues, so B, Z, and J are never used.
+UNKNOWN = 'X'
+STOP = '*'
+
+
+#   A function to translate a codon of IUPAC codes. If all of the codons that
+#   it could stand for give the same amino acid (or are all stops), that is the
+#   translation. Otherwise, it is unknown.
+def resolve_codon(codon):
+    aas = set()
+    for a in IUPAC[codon[0]]:
+        for b in IUPAC[codon[1]]:
+            for c in IUPAC[codon[2]]:
+                aas.add(CODONS[a + b + c])
+    if len(aas) == 1:
+        return aas.pop()
+    return UNKNOWN
+
+
+#   Build the lookup table of all 16^3 IUPAC codons, in upper case. Any other
+#   triplet, such as one with a gap, translates to X.
+def build_table():
+    table = {}
+    for a in IUPAC:
+        for b in IUPAC:
+            for c in IUPAC:
+                table[a + b + c] = resolve_codon(a + b + c)
+    return table
+
+TABLE = build_table()
+
+
+#   A function to translate a nucleotide sequence. Any partial codon at the end
+#   is dropped. The sequence is upper cased first, so that codons in mixed
+#   case, such as a soft-masked stop, are translated.
+def translate(seq):
+    seq = seq.upper()
+    get = TABLE.get
+    return ''.join([
+        get(seq[i:i+3], UNKNOWN) for i in xrange(0, len(seq) - 2, 3)])
+
+
+#   A function to pad a CDS with Ns to a multiple of 3, translate it, and
+#   screen it for stop codons, all in one go. Returns a tuple of
+#       (padded CDS, protein without its trailing stop codon)
+#   The protein is None if there is a stop codon anywhere before the last
+#   codon.
+def translate_cds(seq):
+    if len(seq) % 3:
+        seq += 'N' * (3 - len(seq) % 3)
+    prot = translate(seq)
+    if prot.endswith(STOP):
+        prot = prot[:-1]
+    if STOP in prot:
+        return (seq, None)
+    return (seq, prot)
@@ -8,110 +8,176 @@ import subprocess
 import os
 import time
 import re
+import hashlib
+from collections import OrderedDict
+
+#   NumPy is optional. It is used to back-translate whole alignments at once.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 #   Import Biopython modules here for sequence handling
 from Bio import SeqIO
-from Bio import SeqRecord
-from Bio.Seq import Seq
+from Bio import Phylo
+from Bio.Phylo.BaseTree import Clade
 
 #   Import our helper scripts here
 from lrt_predict.General import set_verbosity
 from lrt_predict.General import check_modules
+from lrt_predict.General import translation
+from lrt_predict.Predict import profile_align
+from lrt_predict.Predict import sanitize
+from lrt_predict.Predict import species_tree
+
+
+#   Get the base directory of the LRT package, for the shell scripts
+LRT_PATH = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
+
+
+#   A function to count the sequences in an unaligned FASTA file, and find the
+#   length of the longest, without parsing it with Biopython. This is used to
+#   pick an aligner before the sequences are prepared.
+def input_size(fname):
+    n_seqs = 0
+    lengths = [0]
+    with open(fname, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                n_seqs += 1
+                lengths.append(0)
+            else:
+                lengths[-1] += len(line.strip())
+    return (n_seqs, max(lengths))
+
+
+class Aligner(object):
+    """A base class for the aligners. It prepares the CDS sequences, hands
+    the translated sequences to the aligner program, and back-translates and
+    sanitizes the aligned sequences and the tree. Subclasses only have to run
+    their program in run_aligner(), and set aln_out and tree_out to its amino
+    acid alignment and tree. A pruned species tree can be given to the
+    aligner as a guide tree, or used as the output tree in place of the one
+    the aligner estimates.
+
+    Contains the following class attributes:
+        NAME (str)              Name of the aligner, as given to --aligner
+        LOG_NAME (str)          Name of the logger
+        OPTIONS (str)           Options that change the alignment, for
+                                keying the alignment cache
+        MULTITHREADED (bool)    Whether the aligner can use more than one CPU
+        MAX_CHANGED_SHARE (float)   Largest share of changed sequences for
+                                    an incremental update
+        MAX_DIVERGENCE (float)  Default largest p-distance for an
+                                incremental update
+
+    Contains the following methods:
+        prepare_sequences(self):
+            Translate the CDS sequences, and write them for the aligner.
+
+        settings(self):
+            Return the aligner and its settings, for the alignment cache.
+
+        use_species_tree(self, tree, target, mode):
+            Prune a species tree to the sequences, to guide the aligner, or
+            as the fixed output tree.
+
+        align(self):
+            Run the aligner with run_aligner(), which is implemented by each
+            subclass. Returns the stdout and stderr of the aligner.
+
+        back_translate(self):
+            Back-translate the amino acid alignment into a codon alignment.
 
+        incremental_update(self, old_msa, old_tree, max_divergence):
+            Update an earlier alignment and tree instead of aligning.
+
+        sanitize_outputs(self):
+            Make the names in the tree safe for HyPhy.
+    """
+    NAME = None
+    LOG_NAME = 'Aligner'
+    OPTIONS = ''
+    MULTITHREADED = True
+    #   An incremental update is only tried if no more than this share of the
+    #   sequences were added, changed, or removed
+    MAX_CHANGED_SHARE = 0.5
+    #   Default largest p-distance from an added sequence to its closest
+    #   neighbour in the alignment, before realigning everything
+    MAX_DIVERGENCE = 0.4
 
-class PastaAlign(object):
     def __init__(
             self,
-            pasta_path,
+            aligner_path,
             unaligned_sequences,
             query_sequence,
-            verbose):
-        self.mainlog = set_verbosity.verbosity('Pasta_Align', verbose)
+            verbose,
+            cpus=1,
+            heap='4g'):
+        self.mainlog = set_verbosity.verbosity(self.LOG_NAME, verbose)
         #   This is file-like object
         self.input_seq = unaligned_sequences
         #   This will be populated with sequences for back-translation
         self.input_dict = {}
         self.query = query_sequence
-        self.pasta_path = check_modules.check_executable(pasta_path)
+        self.aligner_path = check_modules.check_executable(aligner_path)
         self.protein_input = None
         self.aln_out = None
         self.tree_out = None
         self.final_aln = None
+        #   Number of CPUs and memory for the aligner. These are set by the
+        #   alignment pool for each job.
+        self.cpus = cpus
+        self.heap = heap
+        #   Number of sequences to align, and the length of the longest, which
+        #   are used to guess how much memory the aligner needs
+        self.n_seqs = 0
+        self.max_length = 0
+        #   (name, protein sequence) of each sequence given to the aligner
+        self.protein_seqs = []
+        #   Directory that the aligner writes its outputs into
+        self.work_dir = None
+        #   Species tree pruned to the sequences, how it is used (guide or
+        #   fixed), and its SHA1, for the alignment cache
+        self.start_tree = None
+        self.tree_mode = None
+        self.tree_hash = None
         return
 
     def prepare_sequences(self):
         """Prepares the CDS sequences for alignment with Pasta. Checks if any
         sequences are not multiples of 3, and appends N if not. Translates
         the nucleotide sequences to amino acids for protein alignment with
-        Pasta, then removes the trailing stop codon, if it is present."""
-        #   First, read in the sequences and check their length
-        input_seqs = list(SeqIO.parse(self.input_seq.name, 'fasta'))
+        Pasta, then removes the trailing stop codon, if it is present. Each
+        sequence is padded, translated, and screened for stop codons in one
+        pass through the codon table."""
         #   Start accumulating translated sequences to write into the
-        #   alignment input file.
+        #   alignment input file, as (name, protein) tuples
         tl_seqs = []
-        for i in input_seqs:
+        for i in SeqIO.parse(self.input_seq.name, 'fasta'):
             #   Fix the names for HyPhy. Names must be alphanumeric, with
             #   underscores
             fixed_name = re.sub('[^0-9a-zA-Z]', '_', i.id)
-            #   If the length is not a multiple of 3, then we have to add Ns to
-            #   make it so.
-            if len(i) % 3 != 0:
-                to_add = 3 - (len(i) % 3)
-                #   Tack on the original sequence, with some appended Ns so we
-                #   can recreate the nucleotide alignment later.
-                self.input_dict[fixed_name] = str(i.seq) + to_add*'N'
+            #   The padded sequence is kept, so we can recreate the nucleotide
+            #   alignment later. Pasta chokes on ambiguous amino acids that
+            #   aren't X, and the codon table only gives X for those.
+            cds, prot = translation.translate_cds(str(i.seq))
+            if len(cds) != len(i):
                 self.mainlog.debug(
                     'Length of sequence ' + i.id + ' is not a mulitple of 3. ' +
-                    'Adding ' + str(to_add) + ' Ns to the end.'
+                    'Adding ' + str(len(cds) - len(i)) + ' Ns to the end.'
                     )
-                #   Create the new sequence. Pasta chokes on ambiguous
-                #   amino acids that aren't X, so we replace them all with X.
-                fixed_seq = Seq(str(i.seq) + to_add*'N').translate()
-                sub_seq = Seq(
-                    re.sub(
-                        'B|Z|J|O|U',
-                        'X',
-                        str(fixed_seq),
-                        re.I))
-                new_seq = SeqRecord.SeqRecord(
-                    sub_seq,
-                    id=i.id,
-                    description='')
-            else:
-                self.input_dict[fixed_name] = str(i.seq)
-                sub_seq = Seq(
-                    re.sub(
-                        'B|Z|J|O|U',
-                        'X',
-                        str(i.seq.translate()),
-                        re.I))
-                new_seq = SeqRecord.SeqRecord(
-                    sub_seq,
-                    id=fixed_name,
-                    description='')
-            self.mainlog.debug(new_seq.id + '\t' + str(new_seq.seq))
-            tl_seqs.append(new_seq)
-        self.mainlog.debug('Number of species aligned: ' + str(len(tl_seqs)))
-        #   Then, we have to iterate through the translated sequences and
-        #   check for sequences ending in stop codons. Pasta hates these, so
-        #   we will prune them. We also check for those with internal stop
-        #   codons, and skip those.
-        fixed_tl_seqs = []
-        for i in tl_seqs:
-            #   If we find an internal stop codon
-            if re.match(r'.+\*[^$]', str(i.seq)):
+            #   Pasta hates stop codons. The trailing one has already been
+            #   removed, and we skip sequences with internal stop codons.
+            if prot is None:
                 self.mainlog.debug(
                     'Sequence ' + i.id + ' has internal stop. Skipping.'
                     )
                 continue
-            else:
-                #   Otherwise, just strip the stop codon off the end and save
-                if i.seq.endswith('*'):
-                    fixed_tl_seqs.append(
-                        SeqRecord.SeqRecord(i.seq[:-1], id=i.id, description='')
-                        )
-                else:
-                    fixed_tl_seqs.append(i)
+            self.input_dict[fixed_name] = cds
+            self.mainlog.debug(fixed_name + '\t' + prot)
+            tl_seqs.append((fixed_name, prot))
+        self.mainlog.debug('Number of species aligned: ' + str(len(tl_seqs)))
         #   Then, we open another temporary file to hold our amino acid
         #   sequences.
         self.protein_input = tempfile.NamedTemporaryFile(
@@ -119,68 +185,280 @@ class PastaAlign(object):
             prefix='BAD_Mutations_PastaInput_',
             suffix='.fasta')
         #   And write the protein sequences into it
-        SeqIO.write(fixed_tl_seqs, self.protein_input, 'fasta')
+        self.protein_input.write(''.join([
+            '>' + name + '\n' + prot + '\n' for name, prot in tl_seqs]))
         self.protein_input.flush()
+        self.protein_seqs = tl_seqs
+        self.n_seqs = len(tl_seqs)
+        self.max_length = max([len(prot) for name, prot in tl_seqs] or [0])
         return
 
+    def settings(self):
+        """Return a string of the aligner and the settings that change its
+        output, for keying the alignment cache."""
+        fields = [
+            self.NAME,
+            os.path.realpath(self.aligner_path or ''),
+            self.OPTIONS]
+        if self.start_tree:
+            fields.append('tree=' + self.tree_mode + ':' + self.tree_hash)
+        return ' '.join(fields)
+
+    def use_species_tree(self, tree, target, mode):
+        """Prune a species tree to the species of the prepared sequences. In
+        guide mode, it replaces the first tree estimate of the aligner. In
+        fixed mode, it is also written as the output tree. Returns False if
+        any sequence has no leaf in the tree, so the aligner has to estimate
+        the tree itself."""
+        query_id = re.sub(
+            '[^0-9a-zA-Z]',
+            '_',
+            SeqIO.read(self.query, 'fasta').id)
+        names = [name for name, prot in self.protein_seqs]
+        mapping, unmatched = species_tree.match_leaves(
+            tree,
+            names,
+            query_id,
+            target)
+        if unmatched:
+            self.mainlog.info(
+                'No leaf of the species tree for ' + ', '.join(unmatched) +
+                '. Estimating the tree instead.')
+            return False
+        if len(mapping) < 3:
+            return False
+        self.work_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Align_')
+        self.start_tree = os.path.join(self.work_dir, 'species.tre')
+        species_tree.write_tree(
+            species_tree.prune_tree(tree, mapping),
+            self.start_tree)
+        self.tree_mode = mode
+        with open(self.start_tree, 'r') as f:
+            self.tree_hash = hashlib.sha1(f.read()).hexdigest()
+        self.mainlog.debug(
+            'Using the species tree pruned to ' + str(len(mapping)) +
+            ' species as the ' + mode + ' tree.')
+        return True
+
+    def align(self):
+        """Run the aligner on the prepared sequences. In fixed mode, the
+        pruned species tree replaces the tree of the aligner. Returns its
+        stdout and stderr."""
+        out, err = self.run_aligner()
+        if self.tree_mode == 'fixed':
+            self.tree_out = self.start_tree
+        return (out, err)
+
+    def run_aligner(self):
+        """Run the aligner program. Implemented by each subclass."""
+        raise NotImplementedError
+
     def back_translate(self):
         """Back-translates from amino acid to nucleotide, using the original
         input sequences as a guide to avoid ambiguity. Assumes that a non-gap
         character in the amino acid alignment will be faithfully represented
         by a triplet in the source sequence, and will not check identity of
-        translated codons."""
-        #   Iterate through the aligned protein file, and start rebuilding the
-        #   original nucleotide sequence.
-        aln_prot = SeqIO.parse(self.aln_out, 'fasta')
-        bt_seqs = []
-        for rec in aln_prot:
-            #   Check if we have name mismatch. This *shouldn't* happen, but
-            #   this should stop some errors
+        translated codons. The whole alignment is rebuilt at once with NumPy
+        if it is installed, and codon by codon otherwise."""
+        #   Read the aligned protein sequences, and skip any that we do not
+        #   have the nucleotide sequence for. This *shouldn't* happen, but
+        #   this should stop some errors
+        names = []
+        prot_seqs = []
+        for rec in SeqIO.parse(self.aln_out, 'fasta'):
             if rec.id in self.input_dict:
-                in_seq = self.input_dict[rec.id]
-                rebuilt_seq = ''
-                pos = 0
-                #   Now, iterate through the amino acid sequence and rebuild
-                #   the nucleotide sequence.
-                for aa in rec.seq:
-                    #   If we have a gap, put in three gaps
-                    if aa == '-':
-                        rebuilt_seq += '---'
-                    else:
-                        rebuilt_seq += in_seq[pos:pos+3]
-                        pos += 3
+                names.append(rec.id)
+                prot_seqs.append(str(rec.seq))
+        nuc_seqs = [self.input_dict[name] for name in names]
+        #   The rows of an alignment are all the same length, which the
+        #   vectorized version depends on
+        if numpy is not None and len(set([len(p) for p in prot_seqs])) == 1:
+            rebuilt = self.back_translate_array(prot_seqs, nuc_seqs)
+        else:
+            rebuilt = [
+                self.back_translate_seq(p, n)
+                for p, n in zip(prot_seqs, nuc_seqs)]
+        #   And create a new temporary file for them, written all at once with
+        #   HyPhy-safe names
+        final_seqs = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_BackTranslated_',
+            suffix='.fasta',
+            delete=False)
+        final_seqs.write(''.join([
+            '>' + sanitize.hyphy_name(name) + '\n' + seq + '\n'
+            for name, seq in zip(names, rebuilt)]))
+        final_seqs.flush()
+        self.final_aln = final_seqs.name
+        return
+
+    def back_translate_seq(self, prot_seq, nuc_seq):
+        """Rebuild one nucleotide sequence from its aligned amino acid
+        sequence: three gaps for a gap, and the next codon otherwise."""
+        codons = []
+        pos = 0
+        for aa in prot_seq:
+            if aa == '-':
+                codons.append('---')
             else:
-                continue
-            #   Then, put in a new SeqRecord with the sequence and the name, so
-            #   we can write a fasta file.
-            bt_seqs.append(
-                SeqRecord.SeqRecord(
-                    Seq(rebuilt_seq),
-                    id=rec.id,
-                    description='')
-                )
-        #   And create a new temporary file for them
+                codons.append(nuc_seq[pos:pos+3])
+                pos += 3
+        return ''.join(codons)
+
+    def back_translate_array(self, prot_seqs, nuc_seqs):
+        """Rebuild all nucleotide sequences at once. The aligned amino acids
+        are a matrix of bytes, and the rank of each non-gap residue in its row
+        picks its codon out of a matrix of codons."""
+        n_rows = len(prot_seqs)
+        n_cols = len(prot_seqs[0])
+        prot = numpy.fromstring(''.join(prot_seqs), dtype=numpy.uint8)
+        prot = prot.reshape(n_rows, n_cols)
+        residues = prot != ord('-')
+        #   The codon of each residue is the number of residues before it in
+        #   the row
+        rank = numpy.cumsum(residues, axis=1) - 1
+        #   Each row of codons has room for one codon per column. Rows are
+        #   cut or padded to fit, which does not change any codon that is
+        #   used, since a row has no more residues than columns.
+        width = 3 * n_cols
+        codons = numpy.fromstring(
+            ''.join([n[:width].ljust(width, 'N') for n in nuc_seqs]),
+            dtype=numpy.uint8)
+        codons = codons.reshape(n_rows, n_cols, 3)
+        out = numpy.empty((n_rows, n_cols, 3), dtype=numpy.uint8)
+        out.fill(ord('-'))
+        rows, cols = numpy.nonzero(residues)
+        out[rows, cols] = codons[rows, rank[rows, cols]]
+        #   Codons past the end of a short sequence were padding, and are
+        #   dropped, as slicing the sequence would have done
+        lengths = [min(len(n), width) for n in nuc_seqs]
+        seqs = []
+        for i, row in enumerate(out.reshape(n_rows, width)):
+            seq = row.tostring()
+            used = 3 * int(residues[i].sum())
+            if lengths[i] < used:
+                seq = self.back_translate_seq(prot_seqs[i], nuc_seqs[i])
+            seqs.append(seq)
+        return seqs
+
+    def incremental_update(self, old_msa, old_tree, max_divergence=None):
+        """Update an alignment and tree made for an earlier set of sequences,
+        instead of running Pasta. Sequences that were removed or changed are
+        taken out of the alignment and pruned from the tree. Sequences that
+        were added or changed are aligned to the amino acid profile of the
+        alignment, and placed in the tree next to their closest neighbour,
+        with half the p-distance to it on each branch. HyPhy fits the branch
+        lengths again when predicting. Returns False, without writing
+        anything, if too much has changed or an added sequence is more than
+        max_divergence from all others, so that Pasta should realign
+        everything."""
+        if max_divergence is None:
+            max_divergence = self.MAX_DIVERGENCE
+        old = profile_align.read_alignment(old_msa)
+        removed = [name for name in old if name not in self.input_dict]
+        #   The trailing stop codon of a CDS is not in the alignment, so only
+        #   the codons of the translated protein are compared
+        changed = [
+            name for name, prot in self.protein_seqs
+            if name in old and
+            old[name].replace('-', '').upper() !=
+            self.input_dict[name][:3 * len(prot)].upper()]
+        added = [name for name, prot in self.protein_seqs if name not in old]
+        n_changes = len(removed) + len(changed) + len(added)
+        if n_changes > self.MAX_CHANGED_SHARE * max(len(self.protein_seqs), 1):
+            self.mainlog.info(
+                str(n_changes) + ' of ' + str(len(self.protein_seqs)) +
+                ' sequences have changed. Realigning.')
+            return False
+        kept = profile_align.remove_sequences(old, removed + changed)
+        if len(kept) < 3:
+            self.mainlog.info(
+                'Too few sequences are left to update the alignment. '
+                'Realigning.')
+            return False
+        to_add = [
+            (name, self.input_dict[name], prot)
+            for name, prot in self.protein_seqs
+            if name in changed or name in added]
+        aligned, nearest = profile_align.add_sequences(kept, to_add)
+        for name, cds, prot in to_add:
+            near, dist = nearest[name]
+            if near is None or dist > max_divergence:
+                self.mainlog.info(
+                    name + ' is too far from the other sequences to be added '
+                    'to the alignment. Realigning.')
+                return False
+        self.mainlog.info(
+            'Updated alignment: ' + str(len(removed)) + ' removed, ' +
+            str(len(changed)) + ' changed, ' + str(len(added)) + ' added.')
+        #   Write them where the aligner outputs would have gone
+        if not self.work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Align_')
+        if self.tree_mode == 'fixed':
+            self.tree_out = self.start_tree
+        else:
+            #   Fix up the old tree
+            tree = Phylo.read(old_tree, 'newick')
+            for name in removed + changed:
+                tree.prune(name)
+            for name, cds, prot in to_add:
+                near, dist = nearest[name]
+                sister = tree.find_any(name=near)
+                sister.clades = [
+                    Clade(branch_length=dist / 2, name=near),
+                    Clade(branch_length=dist / 2, name=name)]
+                sister.name = None
+            self.tree_out = os.path.join(self.work_dir, 'incremental.tre')
+            Phylo.write(tree, self.tree_out, 'newick')
         final_seqs = tempfile.NamedTemporaryFile(
             mode='w+t',
             prefix='BAD_Mutations_BackTranslated_',
             suffix='.fasta',
             delete=False)
-        SeqIO.write(bt_seqs, final_seqs, 'fasta')
+        final_seqs.write(''.join([
+            '>' + sanitize.hyphy_name(name) + '\n' + seq + '\n'
+            for name, seq in aligned.iteritems()]))
         final_seqs.flush()
         self.final_aln = final_seqs.name
+        self.sanitize_outputs()
+        return True
+
+    def sanitize_outputs(self):
+        """Remove troublesome characters from the PASTA tree that cause HyPhy
+        to crash, or the Biopython Newick parser to fail. The alignment is
+        already written with HyPhy-safe names, so only the tree is rewritten,
+        in one pass."""
+        self.mainlog.debug('Sanitizing tree in ' + self.tree_out)
+        sanitize.sanitize_tree(self.tree_out)
         return
 
-    def pasta_align(self):
-        """Align the amino acid sequences with Pasta."""
-        #   Get the base directory of the LRT package
-        lrt_path = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
-        #   Then build the path to the pasta script
+
+class PastaAlign(Aligner):
+    """Align the sequences with PASTA, through Shell_Scripts/Pasta_Align.sh.
+    PASTA scales to large gene families, but starting Java and running its
+    iterations takes a while even for small ones."""
+    NAME = 'pasta'
+    LOG_NAME = 'Pasta_Align'
+    #   Options that Pasta_Align.sh always gives Pasta. These change the
+    #   alignment, unlike the number of CPUs and the heap size.
+    OPTIONS = '-d protein --iter-limit=5'
+    #   Iterations to run when starting from the species tree
+    GUIDED_ITER_LIMIT = 1
+
+    def run_aligner(self):
+        """Align the amino acid sequences with Pasta. With a species tree,
+        Pasta starts from it instead of estimating a first tree, and only
+        runs one iteration."""
+        #   Build the path to the pasta script
         pasta_script = os.path.join(
-            lrt_path,
+            LRT_PATH,
             'Shell_Scripts',
             'Pasta_Align.sh')
-        #   Pasta expects a directory for output. We use the system temp dir
-        pasta_out = tempfile.gettempdir()
+        #   Pasta expects a directory for output. Each job gets its own, so
+        #   that jobs running at once never see each other's files.
+        if not self.work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Pasta_')
+        pasta_out = self.work_dir
         #   We make a job name from the time in microseconds
         #   This should be good enough...
         pasta_job = 'pastajob_' + '%.6f' % time.time()
@@ -188,10 +466,14 @@ class PastaAlign(object):
         cmd = [
             'bash',
             pasta_script,
-            self.pasta_path,
+            self.aligner_path,
             self.protein_input.name,
             pasta_out,
-            pasta_job]
+            pasta_job,
+            str(self.cpus),
+            str(self.heap)]
+        if self.start_tree:
+            cmd += [self.start_tree, str(self.GUIDED_ITER_LIMIT)]
         self.mainlog.debug(' '.join(cmd))
         #   Then, we'll execute it
         p = subprocess.Popen(
@@ -221,29 +503,70 @@ class PastaAlign(object):
         self.tree_out = tree_out
         return (out, err)
 
-    def sanitize_outputs(self):
-        """Remove troublesome characters from the PASTA output files that
-        cause HyPhy to crash, or the Biopython Newick parser to fail."""
-        #   Get the base directory of the LRT package
-        lrt_path = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
-        #   Then build the path to the pasta script
-        santize_script = os.path.join(
-            lrt_path,
+
+class PrankAlign(Aligner):
+    """Align the sequences with PRANK, through Shell_Scripts/Prank_Align.sh.
+    PRANK starts quickly and is accurate for small gene families, but it is
+    single threaded, and slow for large ones."""
+    NAME = 'prank'
+    LOG_NAME = 'Prank_Align'
+    OPTIONS = '-protein -F -showtree'
+    MULTITHREADED = False
+
+    def run_aligner(self):
+        """Align the amino acid sequences with PRANK, with the species tree as
+        the guide tree if there is one."""
+        prank_script = os.path.join(
+            LRT_PATH,
             'Shell_Scripts',
-            'Prepare_HyPhy.sh')
-        #   Create the command line
+            'Prank_Align.sh')
+        if not self.work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='BAD_Mutations_Prank_')
+        prank_out = os.path.join(self.work_dir, 'prankjob')
         cmd = [
             'bash',
-            santize_script,
-            self.final_aln,
-            self.tree_out]
-        #   Run it
-        self.mainlog.debug('Sanitizing alignment in ' + self.final_aln)
-        self.mainlog.debug('Sanitizing tree in ' + self.tree_out)
+            prank_script,
+            self.aligner_path,
+            self.protein_input.name,
+            prank_out,
+            'protein']
+        if self.start_tree:
+            cmd.append(self.start_tree)
+        self.mainlog.debug(' '.join(cmd))
         p = subprocess.Popen(
             cmd,
             shell=False,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
         out, err = p.communicate()
-        return(out, err)
+        #   Newer versions of PRANK name the outputs .best.fas and .best.dnd,
+        #   and older ones name them after the last iteration, as .2.fas
+        self.aln_out = prank_out + '.best.fas'
+        self.tree_out = prank_out + '.best.dnd'
+        if not os.path.isfile(self.aln_out):
+            self.aln_out = prank_out + '.2.fas'
+            self.tree_out = prank_out + '.2.dnd'
+        return (out, err)
+
+
+#   The aligners that can be given to --aligner
+ALIGNERS = OrderedDict([
+    (PastaAlign.NAME, PastaAlign),
+    (PrankAlign.NAME, PrankAlign)])
+#   Largest number of sequences, and longest CDS, that are aligned with PRANK
+#   when the aligner is picked automatically. PASTA's start up time dominates
+#   below these, and PRANK's run time above them.
+PRANK_MAX_SEQS = 30
+PRANK_MAX_LENGTH = 4500
+
+
+#   A function to pick an aligner for a gene family from the number of
+#   sequences and the length of the longest CDS. available is a list of the
+#   names of the aligners that are installed.
+def choose_aligner(n_seqs, max_length, available):
+    if 'prank' in available and n_seqs <= PRANK_MAX_SEQS and \
+            max_length <= PRANK_MAX_LENGTH:
+        return 'prank'
+    if 'pasta' in available:
+        return 'pasta'
+    return available[0]
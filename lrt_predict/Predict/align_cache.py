@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""A class to keep finished alignments and trees on disk, so that aligning
+the same set of homologous sequences again does not have to run Pasta."""
+
+#   Import standard library modules here
+import os
+import hashlib
+import shutil
+import tempfile
+
+#   Import our helper scripts here
+from lrt_predict.General import set_verbosity
+
+
+class AlignCache(object):
+    """A class to store and retrieve the back-translated alignment and tree
+    that Pasta made for a set of sequences. The cache is a directory under the
+    base directory, with one subdirectory per two-character key prefix, and an
+    alignment (.fasta) and tree (.tree) for each entry. Files are written
+    atomically, and the tree is written before the alignment, so an entry is
+    only ever found once both are complete.
+
+    Each entry is keyed on a SHA1 hash of the sorted names, CDS, and protein
+    sequences given to Pasta, and the settings of the aligner. The order that
+    the sequences were found in does not change the key.
+
+    Contains the following class attributes:
+        CACHE_DIR (str)         Name of the cache directory under the base
+        VERSION (str)           Changed when the layout of the outputs changes
+        CACHE_SIZE (int)        Default maximum number of entries
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        cache_dir (str)         Full path to the cache directory
+        max_entries (int)       Maximum number of entries to keep
+
+    Contains the following methods:
+        key(self, aln):
+            Build the key for a PastaAlign job whose sequences are prepared.
+
+        get(self, aln):
+            Look up an entry. Returns a tuple of the cached alignment and tree
+            paths, or None if the job has not been cached.
+
+        put(self, aln):
+            Save the alignment and tree of a finished job.
+
+        evict(self):
+            Remove the least recently used entries when there are more than
+            max_entries.
+    """
+    CACHE_DIR = 'Align_Cache'
+    VERSION = '1'
+    CACHE_SIZE = 1000
+
+    def __init__(self, base, max_entries, verbose):
+        self.mainlog = set_verbosity.verbosity('Align_Cache', verbose)
+        self.cache_dir = os.path.join(base, self.CACHE_DIR)
+        if max_entries is None:
+            max_entries = self.CACHE_SIZE
+        self.max_entries = int(max_entries)
+        return
+
+    def key(self, aln):
+        """Build the key for an entry from the aligner settings and the
+        sorted input sequences."""
+        sha = hashlib.sha1()
+        sha.update(self.VERSION + '\n' + aln.settings() + '\n')
+        for name, prot in sorted(aln.protein_seqs):
+            sha.update(
+                name + '\t' + aln.input_dict[name].upper() + '\t' + prot +
+                '\n')
+        return sha.hexdigest()
+
+    def entry_paths(self, key):
+        """Return the paths to the alignment and tree of an entry."""
+        entry = os.path.join(self.cache_dir, key[:2], key)
+        return (entry + '.fasta', entry + '.tree')
+
+    def get(self, aln):
+        """Look up an entry. Returns (alignment, tree) if it is cached, and
+        None otherwise."""
+        msa, tree = self.entry_paths(self.key(aln))
+        if not (os.path.isfile(msa) and os.path.isfile(tree)):
+            return None
+        #   Touch the entry so that eviction removes the least recently used
+        #   entries first
+        try:
+            os.utime(msa, None)
+        except OSError:
+            pass
+        self.mainlog.info('Found cached alignment ' + msa)
+        return (msa, tree)
+
+    def put(self, aln):
+        """Save the alignment and tree of a finished job. Each file is copied
+        to a temporary file and then renamed, so that readers never see a
+        partial entry."""
+        msa, tree = self.entry_paths(self.key(aln))
+        target_dir = os.path.dirname(msa)
+        try:
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+        except OSError:
+            #   Another job may have made it first
+            if not os.path.isdir(target_dir):
+                self.mainlog.warning(
+                    'Could not create cache directory ' + target_dir)
+                return
+        try:
+            for source, dest in [(aln.tree_out, tree), (aln.final_aln, msa)]:
+                handle, tmpname = tempfile.mkstemp(
+                    dir=target_dir,
+                    prefix='.tmp_')
+                os.close(handle)
+                shutil.copyfile(source, tmpname)
+                os.rename(tmpname, dest)
+        except (OSError, IOError) as msg:
+            self.mainlog.warning('Could not write cached alignment: ' +
+                                 str(msg))
+        return
+
+    def evict(self):
+        """Remove the least recently used entries if there are more than
+        max_entries. We remove down to 90% of the limit, so that we do not
+        have to evict again on the very next run."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_path = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_path):
+                continue
+            entries.extend([
+                os.path.join(prefix_path, e) for e in os.listdir(prefix_path)
+                if e.endswith('.fasta')])
+        if len(entries) <= self.max_entries:
+            return
+        to_keep = int(self.max_entries * 0.9)
+        self.mainlog.info(
+            'Alignment cache has ' + str(len(entries)) + ' entries. Removing ' +
+            str(len(entries) - to_keep) + ' least recently used.')
+        aged = []
+        for entry in entries:
+            try:
+                aged.append((os.path.getmtime(entry), entry))
+            except OSError:
+                continue
+        aged.sort()
+        for mtime, entry in aged[:len(aged) - to_keep]:
+            #   Remove the alignment first, so that the entry is never found
+            #   without its tree
+            for fname in [entry, entry[:-len('.fasta')] + '.tree']:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    continue
+        return
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""A class to run several alignments at once on one machine, giving
+each one a share of the CPUs and memory that fits its size."""
+
+#   Import standard library modules here
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+#   Import our helper scripts here
+from lrt_predict.General import set_verbosity
+from lrt_predict.General import resources
+
+
+class AlignmentPool(object):
+    """A class to run a list of Aligner jobs at once. Each job is given a
+    number of CPUs and a Java heap size, either fixed, or guessed from the
+    number and length of its sequences. Aligners that are single threaded
+    always get one CPU. Jobs are started, largest first,
+    whenever there are enough CPUs and memory left over for them, so that
+    many small alignments can run next to each other without the node running
+    out of memory.
+
+    Contains the following class attributes:
+        SEQS_PER_CPU (int)      Sequences per Pasta CPU, when guessing
+        MIN_HEAP (int)          Smallest heap given to a job, in MB
+        HEAP_PER_RESIDUE (float)    MB of heap per residue of input
+        DEFAULT_MEMORY (int)    Memory to assume if it cannot be found, in MB
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        cpus (int)              CPUs to share between the jobs
+        memory (int)            Memory to share between the jobs, in MB
+        job_cpus (int)          CPUs for every job, or None to guess
+        job_heap (int)          Heap for every job in MB, or None to guess
+        used_cpus (int)         CPUs given to the jobs that are running
+        used_memory (int)       Memory given to the jobs that are running
+        running (int)           Number of jobs that are running
+        free (Condition)        Notified when a job gives back its share
+
+    Contains the following methods:
+        job_size(self, aln):
+            Return the number of CPUs and the heap size in MB for a job.
+
+        run_job(self, aln):
+            Align, back-translate, and sanitize one job. Returns the
+            (stdout, stderr) of the aligner, or None if the job failed.
+
+        align_all(self, jobs):
+            Align, back-translate, and sanitize a list of Aligner jobs
+            whose sequences have been prepared. Returns a list of (stdout,
+            stderr) of the aligners, or None for the jobs that failed, in the
+            order of the jobs.
+    """
+    SEQS_PER_CPU = 25
+    MIN_HEAP = 1024
+    HEAP_PER_RESIDUE = 0.01
+    DEFAULT_MEMORY = 4096
+
+    def __init__(self, cpus, job_cpus, job_heap, verbose):
+        self.mainlog = set_verbosity.verbosity('Alignment_Pool', verbose)
+        self.cpus = int(cpus) if cpus else resources.available_cpus()
+        self.memory = resources.available_memory() or self.DEFAULT_MEMORY
+        self.job_cpus = int(job_cpus) if job_cpus else None
+        if job_heap:
+            try:
+                self.job_heap = resources.parse_memory(job_heap)
+            except ValueError:
+                self.mainlog.error(
+                    'Could not read the Pasta heap size ' + str(job_heap) +
+                    '. Use a size such as 4g or 2048m.')
+                exit(1)
+        else:
+            self.job_heap = None
+        self.used_cpus = 0
+        self.used_memory = 0
+        self.running = 0
+        self.free = threading.Condition()
+        self.mainlog.debug(
+            'Sharing ' + str(self.cpus) + ' CPUs and ' + str(self.memory) +
+            ' MB between alignments.')
+        return
+
+    def job_size(self, aln):
+        """Return the number of CPUs and the Java heap in MB for a job. Pasta
+        splits large alignments into subproblems that it runs in parallel, so
+        more sequences get more CPUs. Its memory use grows with the size of
+        the alignment."""
+        if not aln.MULTITHREADED:
+            cpus = 1
+        elif self.job_cpus:
+            cpus = self.job_cpus
+        else:
+            cpus = (aln.n_seqs + self.SEQS_PER_CPU - 1) // self.SEQS_PER_CPU
+            cpus = max(1, min(cpus, self.cpus))
+        if self.job_heap:
+            heap = self.job_heap
+        else:
+            residues = aln.n_seqs * aln.max_length
+            heap = self.MIN_HEAP + int(residues * self.HEAP_PER_RESIDUE)
+            heap = min(heap, self.memory)
+        return (cpus, heap)
+
+    def reserve(self, cpus, heap):
+        """Wait until there are enough CPUs and memory for a job, and take
+        them. A job always starts if nothing else is running, so that a job
+        larger than the machine still runs."""
+        with self.free:
+            while self.running and (
+                    self.used_cpus + cpus > self.cpus or
+                    self.used_memory + heap > self.memory):
+                self.free.wait()
+            self.used_cpus += cpus
+            self.used_memory += heap
+            self.running += 1
+        return
+
+    def release(self, cpus, heap):
+        """Give back the CPUs and memory of a job that has finished."""
+        with self.free:
+            self.used_cpus -= cpus
+            self.used_memory -= heap
+            self.running -= 1
+            self.free.notify_all()
+        return
+
+    def run_job(self, aln):
+        """Run the aligner of one job, then back-translate and sanitize the
+        output. If any step fails, the error is logged and None is returned,
+        so that one gene does not stop the other jobs."""
+        cpus, heap = self.job_size(aln)
+        self.reserve(cpus, heap)
+        out, err = ('', '')
+        try:
+            aln.cpus = cpus
+            aln.heap = str(heap) + 'm'
+            self.mainlog.info(
+                'Aligning ' + str(aln.n_seqs) + ' sequences with ' +
+                str(cpus) + ' CPUs and ' + aln.heap + ' of heap.')
+            out, err = aln.align()
+            self.mainlog.debug('stdout: \n' + out)
+            self.mainlog.debug('stderr: \n' + err)
+            aln.back_translate()
+            aln.sanitize_outputs()
+        except Exception as e:
+            self.mainlog.error(
+                'Could not align ' + os.path.basename(aln.query) + ': ' +
+                str(e) + '\nAligner stderr:\n' + err)
+            return None
+        finally:
+            self.release(cpus, heap)
+        return (out, err)
+
+    def align_all(self, jobs):
+        """Run all of the jobs, largest first. Returns a list of the aligner
+        (stdout, stderr) for each job, or None for a job that failed, in the
+        order they were given."""
+        if not jobs:
+            return []
+        order = sorted(
+            range(len(jobs)),
+            key=lambda i: jobs[i].n_seqs * jobs[i].max_length,
+            reverse=True)
+        #   No more jobs can run at once than there are CPUs to give them
+        workers = max(1, min(len(jobs), self.cpus))
+        if workers == 1:
+            results = [self.run_job(jobs[i]) for i in order]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(
+                    self.run_job,
+                    [jobs[i] for i in order],
+                    chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        outputs = [None] * len(jobs)
+        for i, result in zip(order, results):
+            outputs[i] = result
+        return outputs
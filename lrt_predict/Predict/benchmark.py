@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to compare the aligners on our own gene
+#   families. Every installed aligner is run on each family, and the wall time
+#   and the agreement of its alignment with that of the first aligner are
+#   written into a report. Agreement is the share of the pairs of residues
+#   that the first aligner puts in the same column that the other aligner
+#   also puts in the same column (the sum-of-pairs score).
+
+import os
+import time
+import shutil
+
+from lrt_predict.Predict import profile_align
+
+#   Columns of the benchmark report
+FIELDS = ['Query', 'Aligner', 'Sequences', 'Max_Length', 'Seconds',
+          'Agreement']
+REPORT_NAME = 'Aligner_Benchmark.txt'
+
+
+#   A function to list the pairs of residues that an alignment puts in the
+#   same column. Residues are named by their sequence and their position in
+#   it, and each pair is sorted, so pairs from two alignments can be compared.
+def aligned_pairs(msa):
+    aligned = profile_align.read_alignment(msa)
+    names = sorted(aligned)
+    rows = [profile_align.codon_row(aligned[name]) for name in names]
+    positions = [0] * len(names)
+    pairs = set()
+    for column in zip(*rows):
+        residues = []
+        for i, aa in enumerate(column):
+            if aa != '-':
+                residues.append((names[i], positions[i]))
+                positions[i] += 1
+        for a in xrange(len(residues)):
+            for b in xrange(a + 1, len(residues)):
+                pairs.add((residues[a], residues[b]))
+    return pairs
+
+
+#   A function to score an alignment against a reference alignment of the
+#   same sequences. Returns the share of reference pairs that are also in the
+#   test alignment, or None if the reference has no pairs.
+def agreement(test_msa, ref_msa):
+    ref = aligned_pairs(ref_msa)
+    if not ref:
+        return None
+    return float(len(ref & aligned_pairs(test_msa))) / len(ref)
+
+
+#   A function to run every aligner on each gene family. make_aligner is a
+#   function of (aligner name, unaligned sequences, query file) that returns
+#   an aligner with its sequences prepared, pool is an AlignmentPool, and
+#   choose is a function of the query file and unaligned sequences that
+#   returns the name of the aligner whose outputs should be kept. Aligners
+#   are run one at a time, so that the wall times are comparable. An aligner
+#   that fails is left out of the scores of the family. Returns the kept
+#   aligner of each family, and a list of report rows.
+def run_benchmark(queries, names, make_aligner, choose, pool, log):
+    kept = []
+    rows = []
+    for query_file, unaligned in queries:
+        results = []
+        for name in names:
+            aln = make_aligner(name, unaligned, query_file)
+            start = time.time()
+            if pool.align_all([aln])[0] is None:
+                log.error(name + ' failed to align ' +
+                          os.path.basename(query_file) + '.')
+                continue
+            seconds = time.time() - start
+            log.info(name + ' aligned ' + os.path.basename(query_file) +
+                     ' in ' + '%.2f' % seconds + ' seconds.')
+            results.append((name, aln, seconds))
+        if not results:
+            continue
+        ref = results[0][1].final_aln
+        for name, aln, seconds in results:
+            score = agreement(aln.final_aln, ref)
+            rows.append([
+                os.path.basename(query_file),
+                name,
+                str(aln.n_seqs),
+                str(aln.max_length),
+                '%.2f' % seconds,
+                'NA' if score is None else '%.4f' % score])
+        keep = choose(query_file, unaligned)
+        for name, aln, seconds in results:
+            if name == keep:
+                kept.append(aln)
+            else:
+                os.remove(aln.final_aln)
+                shutil.rmtree(aln.work_dir, ignore_errors=True)
+    return (kept, rows)
+
+
+#   A function to write the benchmark report into the output directory
+def write_report(output, rows, log):
+    report = os.path.join(output, REPORT_NAME)
+    with open(report, 'w') as f:
+        f.write('#' + '\t'.join(FIELDS) + '\n')
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+    log.info('Aligner benchmark written to ' + report)
+    return
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to save the fit of the background codon
+#   model next to the alignment, so that predictions for new substitutions in
+#   a gene that was already predicted can skip it. The fit is keyed on the
+#   contents of the alignment and the tree, and on the engine that made it.
+#   The file is plain text, so that LRT.hyphy can read and write it with
+#   fscanf and fprintf:
+#       key
+#       number of branches
+#       AC AT CG CT GT
+#       synRate nsClass1        (one line for each branch)
+#   The branches are in the order the engine lists them. The nucleotide
+#   frequencies are not saved, as they are counted again in one pass over
+#   the alignment.
+
+import os
+import hashlib
+
+#   Appended to the name of the alignment to name the saved fit
+FIT_SUFFIX = '.bgfit'
+#   Number of exchangeabilities in the model
+N_RATES = 5
+
+
+#   A function to build the key of a fit from the engine name and the
+#   contents of the alignment and tree files
+def fit_key(engine, msa, tree):
+    digest = hashlib.sha1()
+    digest.update(engine + '\n')
+    for fname in [msa, tree]:
+        with open(fname, 'rb') as f:
+            digest.update(f.read())
+        digest.update('\n')
+    return digest.hexdigest()
+
+
+#   A function to name the saved fit of an alignment
+def fit_path(msa):
+    return os.path.abspath(msa) + FIT_SUFFIX
+
+
+#   A function to read a saved fit. Returns the exchangeabilities, and a list
+#   of (synonymous rate, nonsynonymous multiplier) for each branch, or None if
+#   the file is missing, has another key, or is cut short.
+def read_fit(fname, key):
+    try:
+        with open(fname, 'r') as f:
+            if f.readline().strip() != key:
+                return None
+            values = [float(v) for v in f.read().split()]
+    except (IOError, ValueError):
+        return None
+    if not values or values[0] != int(values[0]):
+        return None
+    n_branches = int(values[0])
+    if len(values) != 1 + N_RATES + 2 * n_branches:
+        return None
+    rates = values[1:1 + N_RATES]
+    rest = values[1 + N_RATES:]
+    branches = zip(rest[0::2], rest[1::2])
+    return (rates, branches)
+
+
+#   A function to write a fit. It is written to a temporary file that
+#   replaces the saved fit, so that a prediction that reads it at the same
+#   time never sees half of it.
+def write_fit(fname, key, rates, branches):
+    tmp_name = fname + '.tmp' + str(os.getpid())
+    with open(tmp_name, 'w') as f:
+        f.write(key + '\n')
+        f.write(str(len(branches)) + '\n')
+        f.write(' '.join([repr(float(r)) for r in rates]) + '\n')
+        for syn, ns in branches:
+            f.write(repr(float(syn)) + ' ' + repr(float(ns)) + '\n')
+    os.rename(tmp_name, fname)
+    return
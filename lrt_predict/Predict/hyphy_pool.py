@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""A class to keep HyPhy processes running between predictions, so that
+LRT.hyphy sets up the genetic code and the codon model terms once for each
+process, instead of once for each gene."""
+
+#   Import standard library modules here
+import os
+import Queue
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+#   Import our helper scripts here
+from lrt_predict.General import set_verbosity
+from lrt_predict.General import check_modules
+
+
+class HyPhyWorkerPool(object):
+    """A class to run prediction jobs on HyPhy processes that stay up. Each
+    worker runs LRT.hyphy in server mode: it is sent the path to the input
+    file of a job on stdin, and writes the report of the job to stdout,
+    followed by a sentinel line. HyPhy buffers its output when it is not
+    written to a terminal, so workers are run through stdbuf to write each
+    line as it is made; otherwise the sentinel could sit in the buffer while
+    HyPhy waits for the next job. Workers are started again if they die, and
+    after MAX_JOBS jobs, so that memory HyPhy keeps between jobs is given
+    back. The stderr of each worker goes to a temporary file, which is
+    logged when a job fails.
+
+    Contains the following class attributes:
+        SENTINEL (str)          Line that LRT.hyphy writes after each report
+        MAX_JOBS (int)          Jobs a worker runs before it is restarted
+
+    Contains the following instance attributes:
+        mainlog (logger)        Logging messages formatter and handler
+        hyphy_path (str)        Path to the HyPhy executable
+        stdbuf (str)            Path to stdbuf
+        script (str)            Path to LRT.hyphy
+        n_workers (int)         Number of HyPhy processes
+        idle (Queue)            Workers that are waiting for a job
+
+    Contains the following methods:
+        run_job(self, job):
+            Run one (input file, output file) job on an idle worker. Returns
+            True if the worker finished the report.
+
+        run_all(self, jobs):
+            Run a list of jobs on all of the workers. Returns a list of
+            whether each job finished, in the order of the jobs.
+
+        close(self):
+            Stop all of the workers.
+    """
+    SENTINEL = 'BAD_Mutations_HyPhy_Job_Done'
+    MAX_JOBS = 500
+
+    def __init__(self, hyphy_path, n_workers, verbose):
+        self.mainlog = set_verbosity.verbosity('HyPhy_Pool', verbose)
+        self.hyphy_path = check_modules.check_executable(hyphy_path)
+        self.stdbuf = check_modules.check_executable('stdbuf')
+        if not self.stdbuf:
+            self.mainlog.error(
+                'stdbuf (from GNU coreutils) is needed to keep HyPhy running '
+                'between genes, but it was not found.')
+            exit(1)
+        lrt_path = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
+        self.script = os.path.join(lrt_path, 'Shell_Scripts', 'LRT.hyphy')
+        self.n_workers = max(1, int(n_workers))
+        self.idle = Queue.Queue()
+        for i in xrange(self.n_workers):
+            self.idle.put(self.start_worker())
+        return
+
+    def start_worker(self):
+        """Start a HyPhy process in server mode, with line buffered output.
+        Returns a list of the process, the number of jobs it has run, and the
+        temporary file that holds its stderr."""
+        cmd = [self.stdbuf, '-oL', self.hyphy_path, self.script]
+        self.mainlog.debug(' '.join(cmd))
+        errfile = tempfile.TemporaryFile(prefix='BAD_Mutations_HyPhy_Err_')
+        proc = subprocess.Popen(
+            cmd,
+            shell=False,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=errfile)
+        proc.stdin.write('SERVER\n')
+        proc.stdin.flush()
+        return [proc, 0, errfile]
+
+    def stop_worker(self, worker):
+        """Ask a worker to exit, and wait for it."""
+        proc = worker[0]
+        if proc.poll() is None:
+            try:
+                proc.stdin.write('EXIT\n')
+                proc.stdin.close()
+            except IOError:
+                pass
+        proc.wait()
+        worker[2].close()
+        return
+
+    def worker_errors(self, worker):
+        """Return what a worker has written to stderr."""
+        worker[2].flush()
+        worker[2].seek(0)
+        return worker[2].read()
+
+    def run_job(self, job):
+        """Send a job to an idle worker, and copy its report into the output
+        file of the job, up to the sentinel line. If the worker dies first,
+        it is replaced, and the job is not finished."""
+        infile, outfile = job
+        worker = self.idle.get()
+        proc = worker[0]
+        finished = False
+        try:
+            proc.stdin.write(infile.name + '\n')
+            proc.stdin.flush()
+            with open(outfile.name, 'w') as out:
+                for line in iter(proc.stdout.readline, ''):
+                    if line.rstrip('\r\n') == self.SENTINEL:
+                        finished = True
+                        break
+                    out.write(line)
+        except IOError:
+            pass
+        worker[1] += 1
+        if not finished:
+            #   The worker closed its output, so let it exit, so that all it
+            #   wrote to stderr is in the file
+            proc.wait()
+            self.mainlog.error(
+                'HyPhy stopped before finishing the report for ' +
+                infile.name + '. HyPhy stderr:\n' + self.worker_errors(worker))
+        if not finished or worker[1] >= self.MAX_JOBS:
+            self.stop_worker(worker)
+            worker = self.start_worker()
+        self.idle.put(worker)
+        return finished
+
+    def run_all(self, jobs):
+        """Run all of the jobs, as many at once as there are workers. Returns
+        a list of whether each job finished."""
+        if not jobs:
+            return []
+        pool = ThreadPool(min(len(jobs), self.n_workers))
+        try:
+            results = pool.map(self.run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def close(self):
+        """Stop all of the workers."""
+        for i in xrange(self.n_workers):
+            self.stop_worker(self.idle.get())
+        return
@@ -0,0 +1,864 @@
+#!/usr/bin/env python
+"""Run the LRT of Shell_Scripts/LRT.hyphy in Python, without HyPhy. The codon
+model is the MG94 model of LRT.hyphy: rates between codons that differ at one
+position, scaled by a nucleotide exchangeability (AG fixed to 1) and the
+frequency of the target nucleotide at that codon position, with a synonymous
+rate and a nonsynonymous multiplier on every branch. Likelihoods are computed
+with Felsenstein pruning over all 61 sense codons at once with NumPy, and the
+report has the same lines and columns as the HyPhy report."""
+
+#   Import standard library modules here
+import re
+import math
+import time
+import tempfile
+
+#   Import NumPy and Biopython
+import numpy
+from Bio import Phylo
+
+#   Import our helper scripts here
+from lrt_predict.General import set_verbosity
+from lrt_predict.General import translation
+from lrt_predict.Predict import fit_cache
+from lrt_predict.Predict.predict import LRTPredict
+
+#   Nucleotides, in the order HyPhy uses
+NUCS = 'ACGT'
+#   The sense codons, in the order of the HyPhy codon model
+SENSE = [
+    a + b + c
+    for a in NUCS for b in NUCS for c in NUCS
+    if translation.CODONS[a + b + c] != translation.STOP]
+CODON_INDEX = dict([(c, i) for i, c in enumerate(SENSE)])
+#   Nucleotide pairs, in the order of the exchangeabilities. AG is fixed to 1,
+#   and the others are fit, as in LRT.hyphy.
+PAIRS = ['AC', 'AG', 'AT', 'CG', 'CT', 'GT']
+RATE_NAMES = ['AC', 'AT', 'CG', 'CT', 'GT']
+#   Bounds of the parameters. HyPhy bounds them at 0 and 10000; we fit them on
+#   a log scale, so the lower bound is just above 0.
+LOWER = 1e-10
+UPPER = 10000.0
+#   Synonymous rates are capped before the site tests, and the constraint
+#   starts from 0.2, as in LRT.hyphy
+MAX_SYN_RATE = 3.0
+START_CONSTRAINT = 0.2
+#   Stop fitting the background when a round gains less log likelihood
+PRECISION = 0.001
+MAX_ROUNDS = 50
+#   Width of the window searched for each parameter in a round, in log units
+WINDOW = 2.0
+GOLDEN = 0.3819660112501051
+
+
+#   A function to build the arrays that describe the codon model. For every
+#   pair of sense codons that differ at one position, gives the index of the
+#   nucleotide pair in PAIRS, the codon position, the target nucleotide, and
+#   whether the change is nonsynonymous. Other pairs have a pair index of -1.
+def codon_graph():
+    n = len(SENSE)
+    pair = numpy.zeros((n, n), dtype=int) - 1
+    position = numpy.zeros((n, n), dtype=int)
+    target = numpy.zeros((n, n), dtype=int)
+    nonsyn = numpy.zeros((n, n), dtype=bool)
+    for i, a in enumerate(SENSE):
+        for j, b in enumerate(SENSE):
+            diffs = [p for p in xrange(3) if a[p] != b[p]]
+            if len(diffs) != 1:
+                continue
+            p = diffs[0]
+            pair[i, j] = PAIRS.index(''.join(sorted(a[p] + b[p])))
+            position[i, j] = p
+            target[i, j] = NUCS.index(b[p])
+            nonsyn[i, j] = translation.CODONS[a] != translation.CODONS[b]
+    return (pair, position, target, nonsyn)
+
+PAIR, POSITION, TARGET, NONSYN = codon_graph()
+
+
+#   A function to count the synonymous and nonsynonymous sites of each sense
+#   codon, as _S_NS_POSITIONS_ in LRT.hyphy: at each position, the share of
+#   the three changes that are synonymous, or nonsynonymous. Changes to a stop
+#   codon are neither.
+def site_counts():
+    syn = numpy.zeros(len(SENSE))
+    nonsyn = numpy.zeros(len(SENSE))
+    for i, codon in enumerate(SENSE):
+        aa = translation.CODONS[codon]
+        for p in xrange(3):
+            for n in NUCS:
+                if n == codon[p]:
+                    continue
+                new_aa = translation.CODONS[codon[:p] + n + codon[p+1:]]
+                if new_aa == translation.STOP:
+                    continue
+                if new_aa == aa:
+                    syn[i] += 1.0 / 3
+                else:
+                    nonsyn[i] += 1.0 / 3
+    return (syn, nonsyn)
+
+SYN_SITES, NONSYN_SITES = site_counts()
+
+
+#   A function to list the sense codons that a codon of IUPAC codes could be.
+#   Returns a vector with 1 for each of them. Gaps, stops, and anything that
+#   can not be read could be any codon.
+def codon_states(codon, cache={}):
+    if codon in cache:
+        return cache[codon]
+    states = numpy.zeros(len(SENSE))
+    bases = [translation.IUPAC.get(c, '') for c in codon]
+    if len(codon) == 3 and all(bases):
+        for a in bases[0]:
+            for b in bases[1]:
+                for c in bases[2]:
+                    if a + b + c in CODON_INDEX:
+                        states[CODON_INDEX[a + b + c]] = 1.0
+    if not states.any():
+        states[:] = 1.0
+    cache[codon] = states
+    return states
+
+
+#   A function to calculate the p-value of a likelihood ratio test with one
+#   degree of freedom. This is 1-CChi2(x, 1) in HyPhy.
+def chi2_pvalue(x):
+    if x <= 0:
+        return 1.0
+    return math.erfc(math.sqrt(x / 2.0))
+
+
+#   A function to find the maximum of a function of one variable between lo
+#   and hi, with Brent's method. Returns (x, f(x)).
+def maximize(func, lo, hi, tol=1e-4, max_iter=100):
+    a, b = lo, hi
+    x = w = v = a + GOLDEN * (b - a)
+    fx = fw = fv = -func(x)
+    d = e = 0.0
+    for i in xrange(max_iter):
+        m = 0.5 * (a + b)
+        tol1 = tol * abs(x) + 1e-10
+        tol2 = 2.0 * tol1
+        if abs(x - m) <= tol2 - 0.5 * (b - a):
+            break
+        golden = True
+        if abs(e) > tol1:
+            #   Try a parabolic step through x, w, and v
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2.0 * (q - r)
+            if q > 0:
+                p = -p
+            q = abs(q)
+            if abs(p) < abs(0.5 * q * e) and q * (a - x) < p < q * (b - x):
+                e = d
+                d = p / q
+                u = x + d
+                if u - a < tol2 or b - u < tol2:
+                    d = tol1 if m > x else -tol1
+                golden = False
+        if golden:
+            e = (a - x) if x >= m else (b - x)
+            d = GOLDEN * e
+        if abs(d) >= tol1:
+            u = x + d
+        else:
+            u = x + (tol1 if d > 0 else -tol1)
+        fu = -func(u)
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, w, x = w, x, u
+            fv, fw, fx = fw, fx, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, w = w, u
+                fv, fw = fw, fu
+            elif fu <= fv or v == x or v == w:
+                v = u
+                fv = fu
+    return (x, -fx)
+
+
+#   A function to maximize a positive parameter on a log scale, in a window
+#   around its current value. Keeps the current value if nothing better is
+#   found.
+def maximize_positive(func, current, window=WINDOW):
+    x0 = math.log(max(current, LOWER))
+    f0 = func(math.exp(x0))
+    lo = max(math.log(LOWER), x0 - window)
+    hi = min(math.log(UPPER), x0 + window)
+    x, fx = maximize(lambda x: func(math.exp(x)), lo, hi)
+    if fx > f0:
+        return (math.exp(x), fx)
+    return (math.exp(x0), f0)
+
+
+#   A function to rescale the rows of a matrix of partial likelihoods so that
+#   the largest entry in each is 1. The logs of the factors are added to the
+#   scale vector, so that long trees do not underflow.
+def rescale(partial, scale):
+    factor = partial.max(axis=1)
+    factor[factor <= 0] = 1.0
+    return (partial / factor[:, None], scale + numpy.log(factor))
+
+
+class CodonModel(object):
+    """A class for the MG94 codon model of LRT.hyphy, with nucleotide
+    frequencies for each codon position (F3x4) and five nucleotide
+    exchangeabilities. The model is reversible, so transition probabilities
+    come from the eigenvectors of a symmetric matrix.
+
+    Contains no class attributes.
+
+    Contains the following instance attributes:
+        nuc_freqs (array)       4x3 nucleotide frequencies by codon position
+        codon_freqs (array)     Equilibrium frequencies of the sense codons
+        rates (array)           The five exchangeabilities, in RATE_NAMES
+        syn_base (array)        Synonymous rates, before branch scaling
+        nonsyn_base (array)     Nonsynonymous rates, before branch scaling
+
+    Contains the following methods:
+        set_rates(self, rates):
+            Set the exchangeabilities, and rebuild the base rate matrices.
+
+        transition_matrices(self, syn, nonsyn):
+            Return the transition probability matrices of branches, given
+            their synonymous and nonsynonymous rates.
+    """
+
+    def __init__(self, nuc_freqs, rates=None):
+        #   No nucleotide can have a frequency of exactly 0, or the matrix
+        #   can not be symmetrized
+        self.nuc_freqs = numpy.maximum(nuc_freqs, LOWER)
+        self.nuc_freqs /= self.nuc_freqs.sum(axis=0)
+        freqs = numpy.array([
+            self.nuc_freqs[NUCS.index(c[0]), 0] *
+            self.nuc_freqs[NUCS.index(c[1]), 1] *
+            self.nuc_freqs[NUCS.index(c[2]), 2]
+            for c in SENSE])
+        self.codon_freqs = freqs / freqs.sum()
+        self.sqrt_freqs = numpy.sqrt(self.codon_freqs)
+        #   Frequency of the target nucleotide of each change
+        self.target_freqs = numpy.where(
+            PAIR >= 0,
+            self.nuc_freqs[TARGET, POSITION],
+            0.0)
+        self.set_rates(numpy.ones(len(RATE_NAMES)) if rates is None else rates)
+        return
+
+    def set_rates(self, rates):
+        """Set the five exchangeabilities, and rebuild the synonymous and
+        nonsynonymous rate matrices."""
+        self.rates = numpy.array(rates, dtype=float)
+        exch = numpy.insert(self.rates, PAIRS.index('AG'), 1.0)
+        base = numpy.where(PAIR >= 0, exch[PAIR] * self.target_freqs, 0.0)
+        self.syn_base = numpy.where(NONSYN, 0.0, base)
+        self.nonsyn_base = numpy.where(NONSYN, base, 0.0)
+        return
+
+    def transition_matrices(self, syn, nonsyn):
+        """Return the transition probability matrices of a list of branches,
+        as an array of (branch, from codon, to codon). syn and nonsyn are the
+        synonymous and nonsynonymous rates of each branch, which already
+        include the branch length."""
+        syn = numpy.asarray(syn, dtype=float)
+        nonsyn = numpy.asarray(nonsyn, dtype=float)
+        q = (syn[:, None, None] * self.syn_base +
+             nonsyn[:, None, None] * self.nonsyn_base)
+        diag = numpy.arange(len(SENSE))
+        q[:, diag, diag] = -q.sum(axis=2)
+        sym = q * self.sqrt_freqs[None, :, None] / self.sqrt_freqs[None, None, :]
+        sym = 0.5 * (sym + sym.transpose(0, 2, 1))
+        vals, vecs = numpy.linalg.eigh(sym)
+        p = numpy.einsum('bik,bk,bjk->bij', vecs, numpy.exp(vals), vecs)
+        p *= self.sqrt_freqs[None, None, :] / self.sqrt_freqs[None, :, None]
+        return numpy.maximum(p, 0.0)
+
+
+class Topology(object):
+    """A class for the tree, in the form the pruning algorithm walks it. A
+    root with two children is merged into one with three, as HyPhy does, since
+    the model is reversible.
+
+    Contains no class attributes.
+
+    Contains the following instance attributes:
+        names (list)            Name of each node, in postorder
+        children (list)         Indices of the children of each node
+        lengths (list)          Branch length of each node, or 0.0
+        root (int)              Index of the root, which is the last node
+        leaves (dict)           Leaf name -> node index
+
+    Contains the following methods:
+        newick(self, values):
+            Write the tree in Newick format, with values as branch lengths.
+    """
+
+    def __init__(self, fname):
+        tree = Phylo.read(fname, 'newick')
+        root = tree.root
+        if len(root.clades) == 2:
+            for i, clade in enumerate(root.clades):
+                if clade.clades:
+                    root.clades = (
+                        root.clades[:i] + clade.clades + root.clades[i+1:])
+                    break
+        clades = list(tree.find_clades(order='postorder'))
+        index = dict([(id(c), i) for i, c in enumerate(clades)])
+        self.names = [
+            c.name if c.is_terminal() else 'Node' + str(i)
+            for i, c in enumerate(clades)]
+        self.children = [[index[id(k)] for k in c.clades] for c in clades]
+        self.lengths = [c.branch_length or 0.0 for c in clades]
+        self.root = len(clades) - 1
+        self.leaves = dict([
+            (self.names[i], i) for i, c in enumerate(clades)
+            if c.is_terminal()])
+        return
+
+    def newick(self, values):
+        """Write the tree in Newick format, with values[i] as the length of
+        the branch above node i."""
+        def subtree(i):
+            if not self.children[i]:
+                return self.names[i] + ':' + repr(values[i])
+            inner = ','.join([subtree(k) for k in self.children[i]])
+            if i == self.root:
+                return '(' + inner + ')'
+            return '(' + inner + ')' + self.names[i] + ':' + repr(values[i])
+        return subtree(self.root) + ';'
+
+
+class CodonLikelihood(object):
+    """A class to compute and maximize the likelihood of codon site patterns
+    on a tree. Every branch has a synonymous rate (synRate in LRT.hyphy) and
+    a nonsynonymous multiplier (nsClass1), so its nonsynonymous rate is their
+    product.
+
+    Contains no class attributes.
+
+    Contains the following instance attributes:
+        topo (Topology)         The tree
+        model (CodonModel)      The codon model
+        leaves (dict)           Node index -> partial likelihoods of a leaf
+        weights (array)         Number of codons with each pattern
+        syn (array)             Synonymous rate of each branch
+        ns (array)              Nonsynonymous multiplier of each branch
+        p (array)               Transition probabilities of each branch
+        inside (list)           Partial likelihoods and scales below each node
+        below (list)            The same, carried up each branch
+
+    Contains the following methods:
+        update_matrices(self):
+            Recompute the transition probabilities of every branch.
+
+        log_likelihood(self):
+            Return the log likelihood of the patterns.
+
+        fit(self):
+            Maximize the log likelihood over the exchangeabilities and the
+            rates of every branch.
+    """
+
+    def __init__(self, topo, model, leaves, weights, syn=None, ns=None):
+        self.topo = topo
+        self.model = model
+        self.leaves = leaves
+        self.weights = numpy.asarray(weights, dtype=float)
+        n_nodes = len(topo.names)
+        self.syn = numpy.array(
+            syn if syn is not None else [max(l, 0.01) for l in topo.lengths],
+            dtype=float)
+        self.ns = numpy.array(
+            ns if ns is not None else [0.2] * n_nodes,
+            dtype=float)
+        self.p = None
+        self.inside = [None] * n_nodes
+        self.below = [None] * n_nodes
+        return
+
+    def update_matrices(self):
+        """Recompute the transition probabilities of every branch."""
+        self.p = self.model.transition_matrices(self.syn, self.syn * self.ns)
+        return
+
+    def carry_up(self, node):
+        """Carry the partial likelihoods of a node up its branch."""
+        partial, scale = self.inside[node]
+        self.below[node] = rescale(partial.dot(self.p[node].T), scale)
+        return
+
+    def combine(self, node):
+        """Multiply the partial likelihoods carried up from the children of a
+        node."""
+        n_patterns = len(self.weights)
+        partial = numpy.ones((n_patterns, len(SENSE)))
+        scale = numpy.zeros(n_patterns)
+        for child in self.topo.children[node]:
+            partial = partial * self.below[child][0]
+            scale = scale + self.below[child][1]
+        self.inside[node] = rescale(partial, scale)
+        return
+
+    def log_likelihood(self):
+        """Return the log likelihood of the patterns, with a full pass of the
+        pruning algorithm."""
+        if self.p is None:
+            self.update_matrices()
+        for node in xrange(len(self.topo.names)):
+            if node in self.leaves:
+                self.inside[node] = (
+                    self.leaves[node],
+                    numpy.zeros(len(self.weights)))
+            else:
+                self.combine(node)
+            if node != self.topo.root:
+                self.carry_up(node)
+        partial, scale = self.inside[self.topo.root]
+        #   Parameters at their bounds can make a pattern impossible
+        with numpy.errstate(divide='ignore'):
+            site = numpy.log(partial.dot(self.model.codon_freqs)) + scale
+        return self.weights.dot(site)
+
+    def optimize_rates(self):
+        """Maximize the log likelihood over each exchangeability in turn."""
+        rates = self.model.rates.copy()
+        for k in xrange(len(rates)):
+            def func(value):
+                rates[k] = value
+                self.model.set_rates(rates)
+                self.update_matrices()
+                return self.log_likelihood()
+            rates[k], lnl = maximize_positive(func, rates[k])
+            self.model.set_rates(rates)
+        self.update_matrices()
+        return
+
+    def optimize_branch(self, node, outside):
+        """Maximize the log likelihood over the rates of one branch, given the
+        partial likelihoods outside of it. Then do the same for the branches
+        below it, and carry the new partial likelihoods up the branch."""
+        out_partial, out_scale = outside
+        in_partial, in_scale = self.inside[node]
+        scale = self.weights.dot(out_scale + in_scale)
+
+        def branch_lnl(syn, nonsyn):
+            p = self.model.transition_matrices([syn], [nonsyn])[0]
+            site = (out_partial * in_partial.dot(p.T)).sum(axis=1)
+            with numpy.errstate(divide='ignore'):
+                return self.weights.dot(numpy.log(site)) + scale
+        #   The synonymous and nonsynonymous rates are fit, rather than the
+        #   synonymous rate and the multiplier, because they are less
+        #   correlated
+        nonsyn = self.syn[node] * self.ns[node]
+        self.syn[node], lnl = maximize_positive(
+            lambda x: branch_lnl(x, nonsyn),
+            self.syn[node])
+        nonsyn, lnl = maximize_positive(
+            lambda x: branch_lnl(self.syn[node], x),
+            nonsyn)
+        #   The multiplier has the same upper bound as in HyPhy
+        self.ns[node] = min(nonsyn / self.syn[node], UPPER)
+        self.p[node] = self.model.transition_matrices(
+            [self.syn[node]],
+            [self.syn[node] * self.ns[node]])[0]
+        if self.topo.children[node]:
+            #   Carry the outside partial likelihoods down the branch
+            top = rescale(out_partial.dot(self.p[node]), out_scale)
+            self.optimize_children(node, top)
+            self.combine(node)
+        self.carry_up(node)
+        return
+
+    def optimize_children(self, node, top):
+        """Optimize the branches below a node, given the partial likelihoods
+        of the rest of the tree at the node."""
+        children = self.topo.children[node]
+        for child in children:
+            partial, scale = top
+            for other in children:
+                if other != child:
+                    partial = partial * self.below[other][0]
+                    scale = scale + self.below[other][1]
+            self.optimize_branch(child, rescale(partial, scale))
+        return
+
+    def optimize_branches(self):
+        """Maximize the log likelihood over the rates of each branch in turn,
+        from the root down. Partial likelihoods outside each branch are
+        carried down the tree, so each branch only needs its own transition
+        matrix to be recomputed."""
+        n_patterns = len(self.weights)
+        self.log_likelihood()
+        self.optimize_children(
+            self.topo.root,
+            (numpy.tile(self.model.codon_freqs, (n_patterns, 1)),
+             numpy.zeros(n_patterns)))
+        return
+
+    def parameters(self):
+        """Return the logs of the exchangeabilities, and of the synonymous
+        and nonsynonymous rates of each branch, as one vector."""
+        branches = [n for n in xrange(len(self.syn)) if n != self.topo.root]
+        syn = self.syn[branches]
+        return numpy.log(numpy.maximum(numpy.concatenate(
+            [self.model.rates, syn, syn * self.ns[branches]]), LOWER))
+
+    def set_parameters(self, values):
+        """Set the parameters from a vector made by parameters()."""
+        values = numpy.exp(numpy.clip(
+            values,
+            math.log(LOWER),
+            math.log(UPPER)))
+        branches = [n for n in xrange(len(self.syn)) if n != self.topo.root]
+        n_rates = len(RATE_NAMES)
+        self.model.set_rates(values[:n_rates])
+        self.syn[branches] = values[n_rates:n_rates + len(branches)]
+        self.ns[branches] = numpy.minimum(
+            values[n_rates + len(branches):] / self.syn[branches],
+            UPPER)
+        self.update_matrices()
+        return
+
+    def extrapolate(self, old, lnl):
+        """Search along the change made by the last round, from the current
+        parameters. One parameter at a time creeps along ridges in the
+        likelihood, and this steps along them."""
+        new = self.parameters()
+        step = new - old
+
+        def func(a):
+            self.set_parameters(new + a * step)
+            return self.log_likelihood()
+        a, new_lnl = maximize(func, 0.0, 4.0, tol=1e-3)
+        if new_lnl > lnl:
+            self.set_parameters(new + a * step)
+            return new_lnl
+        self.set_parameters(new)
+        return lnl
+
+    def fit(self):
+        """Maximize the log likelihood, one parameter at a time, until a round
+        over all of them gains less than PRECISION. Returns the log
+        likelihood."""
+        self.update_matrices()
+        lnl = self.log_likelihood()
+        for i in xrange(MAX_ROUNDS):
+            old = self.parameters()
+            self.optimize_rates()
+            self.optimize_branches()
+            new_lnl = self.extrapolate(old, self.log_likelihood())
+            if new_lnl - lnl < PRECISION:
+                lnl = max(lnl, new_lnl)
+                break
+            lnl = new_lnl
+        return lnl
+
+
+class NativeLRT(LRTPredict):
+    """A class to run the LRT in Python instead of HyPhy. The query position
+    and aligned positions are found as for HyPhy. The background model is fit
+    to every codon of the alignment, and then each tested codon is fit with
+    all branches constrained to the background, with and without a constraint
+    on the nonsynonymous rate, and again with the query masked. The report
+    has the same format as the one written by LRT.hyphy.
+
+    Contains the following class attributes:
+        ENGINE (str)            Name of the engine, in the key of saved fits
+
+    Contains the following instance attributes:
+        names (list)            Names of the sequences in the alignment
+        codons (list)           The codons of each sequence
+        reference (str)         Name of the query in the alignment
+        topo (Topology)         The tree
+        background (CodonLikelihood)    The fit of the background model
+
+    Contains the following methods:
+        fit_background(self):
+            Fit the background model to every codon of the alignment, or
+            load a saved fit of it.
+
+        test_site(self, column, masked):
+            Test one codon column. Returns (L0, L1, constraint).
+
+        total_dn_ds(self):
+            Return the total dN and dS over the branches of the background
+            fit, as LRT.hyphy sums its dN and dS trees.
+
+        predict_codons(self):
+            Run the LRT on the aligned positions, and return a temporary
+            file with the report.
+    """
+
+    ENGINE = 'native'
+
+    def __init__(
+            self,
+            nuc_aln,
+            treefile,
+            query,
+            substitutions,
+            verbose,
+            refit=False):
+        super(NativeLRT, self).__init__(
+            None,
+            nuc_aln,
+            treefile,
+            query,
+            substitutions,
+            verbose,
+            refit=refit)
+        self.mainlog = set_verbosity.verbosity('Native_LRT', verbose)
+        self.reference = self.safe_query_name()
+        self.topo = Topology(treefile)
+        seqs = dict([(rec.id, str(rec.seq).upper()) for rec in self.nmsa])
+        missing = [n for n in seqs if n not in self.topo.leaves]
+        if missing or len(self.topo.leaves) != len(seqs):
+            self.mainlog.error(
+                'The tree and the alignment do not have the same sequences. '
+                'Not in the tree: ' + ', '.join(missing))
+            exit(1)
+        #   HyPhy orders the sequences as the leaves of the tree
+        self.names = sorted(seqs, key=lambda n: self.topo.leaves[n])
+        self.codons = [
+            [seqs[n][i:i+3] for i in xrange(0, len(seqs[n]) - 2, 3)]
+            for n in self.names]
+        self.background = None
+        self.site_syn = None
+        self.null_p = None
+        return
+
+    def nucleotide_frequencies(self):
+        """Count the nucleotides at each codon position of the alignment, as
+        HarvestFrequencies does in LRT.hyphy. An ambiguous base, or a gap,
+        counts equally towards each base it could be."""
+        counts = numpy.zeros((4, 3))
+        for seq in self.codons:
+            for codon in seq:
+                for p in xrange(3):
+                    bases = translation.IUPAC.get(codon[p], NUCS)
+                    for base in bases:
+                        counts[NUCS.index(base), p] += 1.0 / len(bases)
+        return counts / numpy.maximum(counts.sum(axis=0), 1.0)
+
+    def leaf_partials(self, columns, masked=False):
+        """Build the partial likelihoods of the leaves for a list of codon
+        columns. If masked, the query could be any codon."""
+        leaves = {}
+        for s, name in enumerate(self.names):
+            if masked and name == self.reference:
+                partial = numpy.ones((len(columns), len(SENSE)))
+            else:
+                partial = numpy.array([codon_states(c[s]) for c in columns])
+            leaves[self.topo.leaves[name]] = partial
+        return leaves
+
+    def fit_background(self):
+        """Fit the background model to every codon of the alignment. Columns
+        with the same codons are only computed once. If there is a saved fit
+        of the same alignment and tree, its parameters are used instead, and
+        a new fit is saved."""
+        patterns = {}
+        for column in zip(*self.codons):
+            patterns[column] = patterns.get(column, 0) + 1
+        columns = patterns.keys()
+        model = CodonModel(self.nucleotide_frequencies())
+        self.background = CodonLikelihood(
+            self.topo,
+            model,
+            self.leaf_partials(columns),
+            [patterns[c] for c in columns])
+        branches = [
+            n for n in xrange(len(self.topo.names)) if n != self.topo.root]
+        if self.saved_fit and len(self.saved_fit[1]) == len(branches):
+            rates, saved = self.saved_fit
+            model.set_rates(rates)
+            for node, (syn, ns) in zip(branches, saved):
+                self.background.syn[node] = syn
+                self.background.ns[node] = ns
+            self.background.update_matrices()
+            lnl = self.background.log_likelihood()
+        else:
+            lnl = self.background.fit()
+            try:
+                fit_cache.write_fit(
+                    self.fit_file,
+                    self.fit_key,
+                    model.rates,
+                    [(self.background.syn[n], self.background.ns[n])
+                     for n in branches])
+            except (IOError, OSError):
+                self.mainlog.warning(
+                    'Could not save the background fit to ' + self.fit_file)
+        self.mainlog.debug('Background log likelihood: ' + repr(lnl))
+        #   The sites use the background synonymous rates, capped at 3. The
+        #   nonsynonymous multiplier of each branch is set to its synonymous
+        #   rate under the null, and scaled by the constraint otherwise.
+        self.site_syn = numpy.minimum(self.background.syn, MAX_SYN_RATE)
+        self.null_p = model.transition_matrices(
+            self.site_syn,
+            self.site_syn * self.site_syn)
+        return lnl
+
+    def test_site(self, column, masked=False):
+        """Test one codon column. Returns the log likelihoods of the null and
+        the alternative, and the constraint that maximizes the
+        alternative."""
+        site = CodonLikelihood(
+            self.topo,
+            self.background.model,
+            self.leaf_partials([column], masked),
+            [1.0],
+            self.site_syn)
+        site.p = self.null_p
+        null_lnl = site.log_likelihood()
+
+        def alt_lnl(constraint):
+            site.ns = constraint * self.site_syn
+            site.update_matrices()
+            return site.log_likelihood()
+        #   The constraint is often at its lower bound of 0. If the likelihood
+        #   is flat, such as when only one sequence has a codon, the starting
+        #   value is kept.
+        best = (START_CONSTRAINT, alt_lnl(START_CONSTRAINT))
+        x, lnl = maximize(
+            lambda x: alt_lnl(math.exp(x)),
+            math.log(LOWER),
+            math.log(UPPER))
+        for constraint, lnl in [(math.exp(x), lnl), (0.0, alt_lnl(0.0))]:
+            if lnl > best[1] + 1e-8:
+                best = (constraint, lnl)
+        return (null_lnl, best[1], best[0])
+
+    def total_dn_ds(self):
+        """Return the total dN and dS of the background fit, summed over the
+        branches. As in the dS and dN trees of LRT.hyphy, the dS of a branch
+        is its expected number of synonymous substitutions per codon, over
+        the expected number of synonymous sites per codon, and the same for
+        dN. Every branch has the same rate matrix up to its synonymous rate
+        and nonsynonymous multiplier, so the substitutions per unit of each
+        are only computed once."""
+        model = self.background.model
+        freqs = model.codon_freqs
+        syn_scale = (
+            (freqs[:, None] * model.syn_base).sum() /
+            (freqs * SYN_SITES).sum())
+        nonsyn_scale = (
+            (freqs[:, None] * model.nonsyn_base).sum() /
+            (freqs * NONSYN_SITES).sum())
+        ds = 0.0
+        dn = 0.0
+        for node in xrange(len(self.topo.names)):
+            if node == self.topo.root:
+                continue
+            syn = self.background.syn[node]
+            ds += syn * syn_scale
+            dn += syn * self.background.ns[node] * nonsyn_scale
+        return (dn, ds)
+
+    def translate_column(self, column):
+        """Translate a codon column the way LRT.hyphy does: gaps are -, and
+        anything that is not one codon of A, C, G, and T is ?."""
+        aas = []
+        for codon in column:
+            if codon in CODON_INDEX:
+                aas.append(translation.CODONS[codon])
+            elif codon == '---':
+                aas.append('-')
+            else:
+                aas.append('?')
+        return ''.join(aas)
+
+    def safe_query_name(self):
+        """Return the name of the query, as it is written in the HyPhy
+        input file."""
+        return re.sub('[:\.\+-]', '_', self.query.id)
+
+    def predict_codons(self):
+        """Fit the background model, test the aligned positions, and write
+        the report into a temporary file, which is returned."""
+        out = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_Native_Out_',
+            suffix='.txt')
+        n_codons = len(self.codons[0]) if self.codons else 0
+        out.write('Sites: ' + str(n_codons) + '\n')
+        out.write('Species: ' + str(len(self.names)) + '\n')
+        timer1 = time.time()
+        self.fit_background()
+        timer2 = time.time()
+        out.write(
+            'CPU time taken for dS: ' + repr(timer2 - timer1) +
+            ' seconds.\n')
+        dn, ds = self.total_dn_ds()
+        out.write('Total dN: ' + repr(dn) + '\n')
+        out.write('Total dS: ' + repr(ds) + '\n')
+        out.write('Total dN/dS: ' + repr(dn / ds if ds else 0.0) + '\n\n')
+        #   The fitted parameters, as HyPhy prints them
+        for name, rate in zip(RATE_NAMES, self.background.model.rates):
+            out.write('global ' + name + '=' + repr(rate) + ';\n')
+        for node in xrange(len(self.topo.names)):
+            if node == self.topo.root:
+                continue
+            prefix = 'givenTree.' + self.topo.names[node]
+            out.write(
+                prefix + '.synRate=' + repr(self.background.syn[node]) + ';\n')
+            out.write(
+                prefix + '.nsClass1=' + repr(self.background.ns[node]) +
+                ';\n')
+        out.write(
+            'Tree givenTree=' + self.topo.newick(self.background.syn) + '\n')
+        out.write(
+            'Position\tL0\tL1\tConstraint\tChisquared\tP-value\tSeqCount\t'
+            'Alignment\tReferenceAA\tMaskedConstraint\tMaskedP-value\n')
+        #   The aligned positions are the last base of each codon, counted
+        #   from 1
+        tested = set([p - 3 for p in self.aligned_pos])
+        ref_row = (
+            self.names.index(self.reference)
+            if self.reference in self.names else None)
+        for c in xrange(n_codons):
+            pos = 3 * c
+            column = [seq[c] for seq in self.codons]
+            aln = self.translate_column(column)
+            refaa = aln[ref_row] if ref_row is not None else 'NA'
+            if pos not in tested:
+                out.write('\t'.join([str(pos), aln, refaa, 'NOSNP']) + '\n')
+                continue
+            null_lnl, alt_lnl, constraint = self.test_site(column)
+            m_null, m_alt, m_constraint = self.test_site(column, True)
+            chisq = -2 * (null_lnl - alt_lnl)
+            m_chisq = -2 * (m_null - m_alt)
+            #   Sequences with a base at the first position of the codon
+            seq_count = len([s for s in column if s[0] in NUCS])
+            out.write('\t'.join([
+                str(pos),
+                repr(null_lnl),
+                repr(alt_lnl),
+                repr(constraint),
+                repr(chisq),
+                repr(chi2_pvalue(chisq)),
+                str(seq_count),
+                aln,
+                refaa,
+                repr(m_constraint),
+                repr(chi2_pvalue(m_chisq))]) + '\n')
+        out.write('Alignment order: ' + ','.join(self.names) + '\n')
+        out.write('Species masked: ')
+        if ref_row is not None:
+            out.write(self.reference + '\n')
+        out.write(
+            'CPU time taken for sites: ' + repr(time.time() - timer2) +
+            ' seconds.\n')
+        out.flush()
+        self.hyphy_output = out
+        return out
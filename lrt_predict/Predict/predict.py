@@ -7,6 +7,7 @@ import subprocess
 import os
 import tempfile
 import re
+from multiprocessing.pool import ThreadPool
 
 #   Import Biopython library
 from Bio import AlignIO
@@ -16,9 +17,13 @@ from Bio import SeqIO
 from ..General import parse_input
 from ..General import set_verbosity
 from ..General import check_modules
+from . import fit_cache
 
 
 class LRTPredict(object):
+    #   Name of the engine, which is part of the key of a saved fit
+    ENGINE = 'hyphy'
+
     def __init__(
             self,
             hyphy_path,
@@ -26,9 +31,15 @@ class LRTPredict(object):
             treefile,
             query,
             substitutions,
-            verbose):
+            verbose,
+            full_scan=False,
+            refit=False):
         self.mainlog = set_verbosity.verbosity('LRT_Prediction', verbose)
-        self.hyphy_path = check_modules.check_executable(hyphy_path)
+        #   The native engine has no HyPhy executable
+        if hyphy_path:
+            self.hyphy_path = check_modules.check_executable(hyphy_path)
+        else:
+            self.hyphy_path = None
         self.nmsa = AlignIO.read(open(nuc_aln, 'r'), 'fasta')
         self.nmsa_path = os.path.abspath(nuc_aln)
         self.phylogenetic = treefile
@@ -38,6 +49,32 @@ class LRTPredict(object):
         self.aligned_pos = None
         self.hyphy_input = None
         self.hyphy_output = None
+        #   Targeted scans only do the per-codon work of HyPhy at the tested
+        #   positions. Full scans do it at every codon.
+        self.full_scan = full_scan
+        #   A saved fit of the background model to the same alignment and
+        #   tree is used instead of fitting it again, unless refit is set
+        self.refit = refit
+        self.fit_file = fit_cache.fit_path(nuc_aln)
+        self.fit_tmp = None
+        self.load_saved_fit()
+        return
+
+    def load_saved_fit(self):
+        """Look for a saved fit of the background model to the alignment and
+        tree. Sets saved_fit to the saved parameters, or to None if there is
+        no fit, it is for other files, or refit was asked for."""
+        self.fit_key = fit_cache.fit_key(
+            self.ENGINE,
+            self.nmsa_path,
+            self.phylogenetic)
+        if self.refit:
+            self.saved_fit = None
+        else:
+            self.saved_fit = fit_cache.read_fit(self.fit_file, self.fit_key)
+        if self.saved_fit:
+            self.mainlog.info(
+                'Using the saved background fit in ' + self.fit_file)
         return
 
     def get_query_position(self):
@@ -75,24 +112,33 @@ class LRTPredict(object):
             'Aligned Pos: ' + ', '.join([str(i) for i in self.aligned_pos]))
         return
 
-    def write_aligned_subs(self):
-        """Write the aligned positions into a temporary file."""
+    def write_aligned_subs(self, positions=None):
+        """Write the aligned positions into a temporary file. Writes all of
+        them, unless a list of positions is given."""
+        if positions is None:
+            positions = self.aligned_pos
         subsfile = tempfile.NamedTemporaryFile(
             mode='w+t',
             prefix='BAD_Mutations_HYPHY_Subs_',
             suffix='.txt',
             delete=False
             )
-        subsfile.write('\n'.join([str(i) for i in self.aligned_pos]))
+        subsfile.write('\n'.join([str(i) for i in positions]))
         return subsfile
 
-    def prepare_hyphy_inputs(self):
+    def prepare_hyphy_inputs(self, positions=None, scan=None):
         """Prepare the input files for the HYPHY prediction script. Writes the
-        paths of the MSA, tree, and substitutions file into a plain text file.
+        paths of the MSA, tree, and substitutions file, the query name, the
+        scan mode, and where to load or save the background fit into a plain
+        text file.
         Also builds the name of the temporary output file to hold the
-        predictions."""
+        predictions. The positions and the scan mode default to all aligned
+        positions, and to the mode asked for by the user. Returns the input
+        and output files."""
         #   Write the substitutions file
-        alignedsubs = self.write_aligned_subs()
+        alignedsubs = self.write_aligned_subs(positions)
+        if not scan:
+            scan = 'full' if self.full_scan else 'targeted'
         infile = tempfile.NamedTemporaryFile(
             mode='w+t',
             prefix='BAD_Mutations_HYHPY_In_',
@@ -107,7 +153,19 @@ class LRTPredict(object):
         #   Remove all non-allowed characters in sequence name, and replace them
         #   with underscores
         safe_name = re.sub('[:\.\+-]', '_', self.query.id)
-        infile.write(safe_name)
+        infile.write(safe_name + '\n')
+        #   And whether HyPhy should visit every codon, only tested ones, or
+        #   stop after fitting the background model
+        infile.write(scan + '\n')
+        #   Then whether HyPhy should load the background fit, or fit it and
+        #   save it. It is saved to a temporary file, which replaces the saved
+        #   fit once HyPhy is done.
+        if self.saved_fit:
+            infile.write('load\n' + self.fit_file + '\n')
+        else:
+            self.fit_tmp = self.fit_file + '.tmp' + str(os.getpid())
+            infile.write('save\n' + self.fit_tmp + '\n')
+        infile.write(self.fit_key)
         infile.flush()
         #   Print out the HyPhy input to debug
         infile.seek(0)
@@ -120,10 +178,11 @@ class LRTPredict(object):
             )
         self.hyphy_input = infile
         self.hyphy_output = outfile
-        return
+        return (infile, outfile)
 
-    def predict_codons(self):
-        """Run the HYPHY script to predict the codons."""
+    def run_hyphy(self, infile, outfile):
+        """Run the HYPHY script on one input file, writing into one output
+        file."""
         #   Get the base directory of the LRT package
         lrt_path = os.path.realpath(__file__).rsplit(os.path.sep, 3)[0]
         #   Then build the path to the hyphy script
@@ -142,8 +201,8 @@ class LRTPredict(object):
             hyphy_script,
             self.hyphy_path,
             prediction_script,
-            self.hyphy_input.name,
-            self.hyphy_output.name
+            infile.name,
+            outfile.name
             ]
         self.mainlog.debug(' '.join(cmd))
         #   Then run the command
@@ -155,5 +214,111 @@ class LRTPredict(object):
         out, err = p.communicate()
         self.mainlog.debug('stdout:\n' + out)
         self.mainlog.debug('stderr:\n' + err)
+        return
+
+    def predict_codons(self):
+        """Run the HYPHY script to predict the codons."""
+        self.run_hyphy(self.hyphy_input, self.hyphy_output)
+        self.keep_fit()
         #   Return the output file
         return self.hyphy_output
+
+    def fit_background(self):
+        """Run HyPhy to fit the background model and save the fit, without
+        testing any positions. Returns True if the fit was saved."""
+        self.prepare_hyphy_inputs([], 'fit')
+        self.run_hyphy(self.hyphy_input, self.hyphy_output)
+        self.keep_fit()
+        self.load_saved_fit()
+        return bool(self.saved_fit)
+
+    def predict_sharded(self, workers):
+        """Split the aligned positions into shards, and test them with up to
+        workers HyPhy processes at once. The background model is fit once
+        and saved before the shards start, so that every shard loads it.
+        Positions are dealt out in turn, so that each shard gets positions
+        from along the whole gene. Returns a temporary file with the merged
+        report."""
+        positions = sorted(set(self.aligned_pos))
+        n_shards = min(workers, len(positions))
+        if n_shards < 2:
+            self.prepare_hyphy_inputs()
+            return self.predict_codons()
+        if not self.saved_fit:
+            self.mainlog.info('Fitting the background model for the shards.')
+            if not self.fit_background():
+                self.mainlog.warning(
+                    'Could not save the background fit to ' + self.fit_file +
+                    '. Testing all positions in one HyPhy process.')
+                self.prepare_hyphy_inputs()
+                return self.predict_codons()
+        jobs = [
+            self.prepare_hyphy_inputs(positions[i::n_shards])
+            for i in xrange(n_shards)]
+        self.mainlog.info(
+            'Testing ' + str(len(positions)) + ' positions in ' +
+            str(n_shards) + ' shards.')
+        pool = ThreadPool(n_shards)
+        try:
+            pool.map(lambda job: self.run_hyphy(*job), jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.hyphy_output = self.merge_shards([out for inp, out in jobs])
+        return self.hyphy_output
+
+    def merge_shards(self, outputs):
+        """Merge the reports of the shards into one report. Every shard has a
+        line for every codon, and the line of a codon is taken from the
+        shard that tested it. The first and last sections are those of the
+        first shard, with the CPU time for the sites summed over shards."""
+        reports = []
+        for shard in outputs:
+            shard.seek(0)
+            lines = shard.read().splitlines()
+            header = [
+                i for i, l in enumerate(lines) if l.startswith('Position')]
+            trailer = [
+                i for i, l in enumerate(lines) if l.startswith('Alignment')]
+            if not header or not trailer:
+                self.mainlog.error(
+                    'HyPhy did not finish the report in ' + shard.name + '.')
+                exit(1)
+            reports.append((lines, header[0], trailer[0]))
+        lines, head, tail = reports[0]
+        rows = lines[head+1:tail]
+        for other, o_head, o_tail in reports[1:]:
+            tested = dict([
+                (l.split('\t')[0], l) for l in other[o_head+1:o_tail]
+                if 'NOSNP' not in l])
+            rows = [tested.get(l.split('\t')[0], l) for l in rows]
+        seconds = 0.0
+        for other, o_head, o_tail in reports:
+            for l in other[o_tail:]:
+                if l.startswith('CPU time taken for sites:'):
+                    seconds += float(l.split()[5])
+        trailer = [
+            'CPU time taken for sites: ' + repr(seconds) + ' seconds.'
+            if l.startswith('CPU time taken for sites:') else l
+            for l in lines[tail:]]
+        merged = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            prefix='BAD_Mutations_HYPHY_Out_',
+            suffix='.txt'
+            )
+        merged.write('\n'.join(lines[:head+1] + rows + trailer) + '\n')
+        merged.flush()
+        return merged
+
+    def keep_fit(self):
+        """Replace the saved fit with the one HyPhy wrote, if HyPhy wrote all
+        of it. Otherwise, remove what it wrote."""
+        if not self.fit_tmp or not os.path.isfile(self.fit_tmp):
+            return
+        if fit_cache.read_fit(self.fit_tmp, self.fit_key):
+            os.rename(self.fit_tmp, self.fit_file)
+            self.mainlog.debug('Saved the background fit to ' + self.fit_file)
+        else:
+            os.remove(self.fit_tmp)
+        self.fit_tmp = None
+        return
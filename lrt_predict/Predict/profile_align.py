@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to add sequences to an existing codon
+#   alignment without realigning it. Each new sequence is translated and
+#   aligned to the amino acid profile of the alignment with a global dynamic
+#   programming alignment. Columns of the profile may be skipped (a gap in the
+#   new sequence), and residues of the new sequence may be inserted as new
+#   columns (gaps in all other sequences).
+
+from collections import OrderedDict
+
+from lrt_predict.General import translation
+
+#   Score of a residue against a column is MATCH times the share of the
+#   residues in the column that are the same, minus MISMATCH. A column where
+#   every residue matches scores 2, and one where none do scores -1.
+MATCH = 3.0
+MISMATCH = 1.0
+#   Penalty for a gap in the new sequence. It is scaled down by the share of
+#   gaps already in the column, so new gaps go where the others already are.
+SKIP = 2.0
+#   Penalty for a residue that makes a new column
+INSERT = 2.0
+#   Traceback moves
+DIAG, UP, LEFT = 0, 1, 2
+
+
+#   A function to read an aligned FASTA file. Returns an ordered dictionary of
+#   name -> aligned sequence.
+def read_alignment(fname):
+    seqs = OrderedDict()
+    name = None
+    with open(fname, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                name = line[1:].split()[0]
+                seqs[name] = []
+            elif name is not None:
+                seqs[name].append(line)
+    return OrderedDict([(n, ''.join(s)) for n, s in seqs.iteritems()])
+
+
+#   A function to translate an aligned codon sequence into an aligned amino
+#   acid sequence, one residue per codon column
+def codon_row(nuc):
+    get = translation.TABLE.get
+    return ''.join([
+        '-' if nuc[i:i+3] == '---' else get(nuc[i:i+3], translation.UNKNOWN)
+        for i in xrange(0, len(nuc) - 2, 3)])
+
+
+#   A function to summarize each column of an amino acid alignment. Returns a
+#   list of (residue -> share of non-gap residues, share of gaps) per column.
+def profile(prot_rows):
+    n_rows = float(len(prot_rows))
+    columns = []
+    for column in zip(*prot_rows):
+        counts = {}
+        gaps = 0
+        for aa in column:
+            if aa == '-':
+                gaps += 1
+            else:
+                counts[aa] = counts.get(aa, 0) + 1
+        residues = float(len(column) - gaps) or 1.0
+        columns.append((
+            dict([(aa, c / residues) for aa, c in counts.iteritems()]),
+            gaps / n_rows))
+    return columns
+
+
+#   A function to align a protein sequence to a profile. Returns a list of
+#   moves, from the start of the alignment: DIAG puts the next residue in the
+#   next column, UP puts the next residue in a new column, and LEFT leaves
+#   the next column as a gap.
+def align_to_profile(prot, columns):
+    n = len(prot)
+    m = len(columns)
+    skip = [SKIP * (1.0 - gap) for freqs, gap in columns]
+    #   Scores of the previous row of the matrix, and a traceback for every
+    #   cell, one bytearray per row
+    prev = [0.0] * (m + 1)
+    for j in xrange(1, m + 1):
+        prev[j] = prev[j - 1] - skip[j - 1]
+    trace = [bytearray([LEFT]) * (m + 1)]
+    for i in xrange(1, n + 1):
+        aa = prot[i - 1]
+        cur = [prev[0] - INSERT] + [0.0] * m
+        moves = bytearray(m + 1)
+        moves[0] = UP
+        for j in xrange(1, m + 1):
+            freqs = columns[j - 1][0]
+            diag = prev[j - 1] + MATCH * freqs.get(aa, 0.0) - MISMATCH
+            up = prev[j] - INSERT
+            left = cur[j - 1] - skip[j - 1]
+            if diag >= up and diag >= left:
+                cur[j] = diag
+                moves[j] = DIAG
+            elif up >= left:
+                cur[j] = up
+                moves[j] = UP
+            else:
+                cur[j] = left
+                moves[j] = LEFT
+        trace.append(moves)
+        prev = cur
+    #   Walk back from the end
+    path = []
+    i, j = n, m
+    while i > 0 or j > 0:
+        move = trace[i][j]
+        path.append(move)
+        if move == DIAG:
+            i -= 1
+            j -= 1
+        elif move == UP:
+            i -= 1
+        else:
+            j -= 1
+    path.reverse()
+    return path
+
+
+#   A function to add sequences to a codon alignment. aligned is an ordered
+#   dictionary of name -> aligned CDS, and new is a list of (name, CDS,
+#   protein) to add. Returns the new alignment, and a dictionary of each new
+#   name -> (nearest existing name, p-distance to it). p-distances are the
+#   share of differing residues where both sequences have one.
+def add_sequences(aligned, new):
+    names = aligned.keys()
+    #   Keep the alignment as lists of codons, so that columns can be added
+    rows = dict([
+        (name, [seq[i:i+3] for i in xrange(0, len(seq) - 2, 3)])
+        for name, seq in aligned.iteritems()])
+    prot_rows = dict([(name, codon_row(seq))
+                      for name, seq in aligned.iteritems()])
+    nearest = {}
+    for new_name, cds, prot in new:
+        columns = profile([prot_rows[name] for name in names])
+        path = align_to_profile(prot, columns)
+        #   Rebuild every row along the path
+        new_rows = dict([(name, []) for name in names])
+        new_prot_rows = dict([(name, []) for name in names])
+        new_codons = []
+        new_prot = []
+        col = 0
+        pos = 0
+        for move in path:
+            if move == UP:
+                for name in names:
+                    new_rows[name].append('---')
+                    new_prot_rows[name].append('-')
+            else:
+                for name in names:
+                    new_rows[name].append(rows[name][col])
+                    new_prot_rows[name].append(prot_rows[name][col])
+                col += 1
+            if move == LEFT:
+                new_codons.append('---')
+                new_prot.append('-')
+            else:
+                new_codons.append(cds[3*pos:3*pos+3])
+                new_prot.append(prot[pos])
+                pos += 1
+        rows = new_rows
+        rows[new_name] = new_codons
+        prot_rows = dict([
+            (name, ''.join(aas)) for name, aas in new_prot_rows.iteritems()])
+        prot_rows[new_name] = ''.join(new_prot)
+        nearest[new_name] = closest(prot_rows[new_name], prot_rows, names)
+        names.append(new_name)
+    return (
+        OrderedDict([(name, ''.join(rows[name])) for name in names]),
+        nearest)
+
+
+#   A function to find the sequence that is closest to an aligned protein.
+#   Returns (name, p-distance), or (None, 1.0) if it overlaps no sequence.
+def closest(prot, prot_rows, names):
+    best = (None, 1.0)
+    for name in names:
+        same = 0
+        both = 0
+        for a, b in zip(prot, prot_rows[name]):
+            if a != '-' and b != '-':
+                both += 1
+                if a == b:
+                    same += 1
+        if not both:
+            continue
+        dist = 1.0 - float(same) / both
+        if best[0] is None or dist < best[1]:
+            best = (name, dist)
+    return best
+
+
+#   A function to remove sequences from a codon alignment, and any columns
+#   that are left with only gaps
+def remove_sequences(aligned, names):
+    kept = OrderedDict([
+        (name, seq) for name, seq in aligned.iteritems() if name not in names])
+    if not kept:
+        return kept
+    length = len(kept.values()[0])
+    used = [
+        i for i in xrange(0, length, 3)
+        if any([seq[i:i+3] != '---' for seq in kept.itervalues()])]
+    return OrderedDict([
+        (name, ''.join([seq[i:i+3] for i in used]))
+        for name, seq in kept.iteritems()])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to make the names in alignments and
+#   trees safe for HyPhy, and for the Biopython Newick parser. These used to
+#   be a set of sed passes in Shell_Scripts/Prepare_HyPhy.sh, from Justin C.
+#   Fay. The alignment is now written with safe names in the first place, and
+#   the tree is rewritten in one pass through a Newick tokenizer.
+
+import os
+import re
+
+#   Biopython adds this to records that have no description
+UNKNOWN_DESCRIPTION = '<unknown description>'
+#   Characters that end an unquoted Newick label
+NEWICK_PUNCTUATION = '(),:;'
+#   A number, such as a bootstrap value on an internal node
+NUMBER = re.compile(r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+
+
+#   A function to make a sequence name safe for HyPhy. Removes the Biopython
+#   placeholder description, quotes, and plus signs, and replaces periods with
+#   underscores.
+def hyphy_name(name):
+    name = name.replace(UNKNOWN_DESCRIPTION, '').strip()
+    name = name.replace("'", '').replace('+', '')
+    return name.replace('.', '_')
+
+
+#   A generator over the tokens of a Newick string. Yields (kind, text) tuples,
+#   where kind is 'punct' for one of the characters in NEWICK_PUNCTUATION, and
+#   'label' for a name or number. Quotes are removed from quoted labels.
+def newick_tokens(text):
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c in NEWICK_PUNCTUATION:
+            yield ('punct', c)
+            i += 1
+        elif c.isspace():
+            i += 1
+        elif c == "'":
+            #   Two quotes in a row stand for one quote in the label
+            label = []
+            i += 1
+            while i < n:
+                if text[i] == "'":
+                    if i + 1 < n and text[i + 1] == "'":
+                        label.append("'")
+                        i += 2
+                        continue
+                    i += 1
+                    break
+                label.append(text[i])
+                i += 1
+            yield ('label', ''.join(label))
+        else:
+            j = i
+            while j < n and text[j] not in NEWICK_PUNCTUATION and \
+                    text[j] != "'":
+                j += 1
+            yield ('label', text[i:j].strip())
+            i = j
+    return
+
+
+#   A function to rewrite a Newick string for HyPhy. Leaf and internal node
+#   names are made safe with hyphy_name(), numbers on internal nodes (support
+#   values) are removed, and branch lengths are kept as they are.
+def sanitize_newick(text):
+    out = []
+    prev = None
+    for kind, token in newick_tokens(text):
+        if kind == 'label':
+            if prev == ':':
+                out.append(token)
+            elif prev == ')' and NUMBER.match(token):
+                pass
+            else:
+                out.append(hyphy_name(token))
+            prev = None
+        else:
+            out.append(token)
+            prev = token
+    return ''.join(out)
+
+
+#   A function to sanitize a tree file in place. The tree is read once and
+#   written to a temporary file that replaces it.
+def sanitize_tree(fname):
+    with open(fname, 'r') as f:
+        text = f.read()
+    tmp_name = fname + '.tmp' + str(os.getpid())
+    with open(tmp_name, 'w') as f:
+        f.write(sanitize_newick(text) + '\n')
+    os.rename(tmp_name, fname)
+    return
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+#   A script that contains functions to prune a reference species tree to the
+#   species in a gene family. The sequences of a gene family are named after
+#   the species database they came from (such as Athaliana_167_TAIR10), and
+#   the query is named after its gene. A leaf of the species tree matches a
+#   sequence if the sequence name is the leaf name, or starts with the leaf
+#   name and an underscore, ignoring case. The query matches the leaf of the
+#   target species in the same way.
+
+import copy
+
+from Bio import Phylo
+
+from lrt_predict.Predict import sanitize
+
+
+#   A function to read the species tree
+def read_tree(fname):
+    return Phylo.read(fname, 'newick')
+
+
+#   A function to check if a sequence or species name matches a leaf name
+def leaf_matches(leaf, name):
+    leaf = sanitize.hyphy_name(leaf).lower()
+    name = name.lower()
+    return name == leaf or name.startswith(leaf + '_')
+
+
+#   A function to match the sequences of a gene family to the leaves of the
+#   species tree. names is a list of sequence names, query is the name of the
+#   query sequence, and target is the name of the target species. Returns a
+#   dictionary of leaf name -> sequence name, and a list of the sequence names
+#   that did not match any leaf. If more than one leaf matches a sequence, the
+#   longest leaf name is used.
+def match_leaves(tree, names, query, target):
+    leaves = [leaf.name for leaf in tree.get_terminals() if leaf.name]
+    mapping = {}
+    unmatched = []
+    for name in names:
+        species = target if name == query else name
+        hits = [leaf for leaf in leaves if leaf_matches(leaf, species)]
+        if not hits:
+            unmatched.append(name)
+            continue
+        leaf = max(hits, key=len)
+        if leaf in mapping:
+            #   Two sequences from one species can not share a leaf
+            unmatched.append(name)
+            continue
+        mapping[leaf] = name
+    return (mapping, unmatched)
+
+
+#   A function to prune a copy of the species tree to the leaves in mapping,
+#   and rename each leaf after its sequence. Returns the pruned tree.
+def prune_tree(tree, mapping):
+    pruned = copy.deepcopy(tree)
+    for leaf in pruned.get_terminals():
+        if leaf.name not in mapping:
+            pruned.prune(leaf)
+    for leaf in pruned.get_terminals():
+        leaf.name = mapping[leaf.name]
+    #   Support values on the species tree mean nothing for the gene family
+    for clade in pruned.get_nonterminals():
+        clade.confidence = None
+        clade.name = None
+    return pruned
+
+
+#   A function to write a tree in Newick format
+def write_tree(tree, fname):
+    Phylo.write(tree, fname, 'newick')
+    return
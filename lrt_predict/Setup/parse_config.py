@@ -21,9 +21,38 @@ class ConfigHandler(object):
                 'GZIP': 'gzip_path',
                 'SUM': 'sum_path',
                 'TBLASTX': 'tblastx_path',
+                'BLASTP': 'blastp_path',
                 'PASTA': 'pasta_path',
-                'HYPHY': 'hyphy_path'
+                'PRANK': 'prank_path',
+                'HYPHY': 'hyphy_path',
+                'NUM_CPUS': 'num_cpus',
+                'BLAST_WORKERS': 'blast_workers',
+                'BLAST_CACHE_SIZE': 'blast_cache_size',
+                'SEARCH_MODE': 'search_mode',
+                'PREFILTER': 'prefilter',
+                'PASTA_CPUS': 'pasta_cpus',
+                'PASTA_HEAP': 'pasta_heap',
+                'ALIGN_CACHE_SIZE': 'align_cache_size',
+                'MAX_DIVERGENCE': 'max_divergence',
+                'ALIGNER': 'aligner',
+                'SPECIES_TREE': 'species_tree',
+                'SPECIES_TREE_MODE': 'species_tree_mode',
+                'ENGINE': 'engine',
+                'PREDICT_WORKERS': 'workers'
                 }
+    #   Values in the configuration file are read as strings. These are the
+    #   variables that have to be cast to another type before they are used,
+    #   keyed on the internal variable names.
+    TYPES = {'evalue': float,
+             'num_cpus': int,
+             'blast_workers': int,
+             'blast_cache_size': int,
+             'prefilter': int,
+             'pasta_cpus': int,
+             'align_cache_size': int,
+             'max_divergence': float,
+             'workers': int
+             }
     #   Here is the string that prefixes a variable delcaration
     DECLR = '#define'
 
@@ -85,7 +114,14 @@ class ConfigHandler(object):
                             k +
                             ' to ' +
                             value)
-                        conf_dict[self.KEYWORDS[k]] = value
+                        var = self.KEYWORDS[k]
+                        try:
+                            conf_dict[var] = self.TYPES.get(var, str)(value)
+                        except ValueError:
+                            self.mainlog.error(
+                                'Variable ' + k + ' has an invalid value: ' +
+                                value)
+                            exit(1)
                     else:
                         self.mainlog.warning('Unknown variable ' + k)
         self.config_vars = conf_dict
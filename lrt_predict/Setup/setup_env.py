@@ -27,8 +27,28 @@ class SetupEnv(object):
         GZIP (str)                Path to gzip.
         SUM (str)                 Path to sum.
         TBLASTX (str)             Path to tblastx.
+        BLASTP (str)              Path to blastp. Optional, and only
+                                  written if blastp is found.
         PASTA (str)               Path to pasta.
+        PRANK (str)               Path to prank. Optional, and only written
+                                  if prank is found.
         HYPHY (str)               Path to HyPhy
+    and the following optional KEYWORDs, which are not written by `setup':
+        NUM_CPUS (int)            CPUs to use. Defaults to all allocated.
+        BLAST_WORKERS (int)       Species databases to search at once.
+        BLAST_CACHE_SIZE (int)    Number of BLAST hits to cache. 0 disables.
+        SEARCH_MODE (str)         tblastx (default) or blastp.
+        PREFILTER (int)           Candidates per query to search. 0 disables.
+        PASTA_CPUS (int)          CPUs for each Pasta alignment.
+        PASTA_HEAP (str)          Java heap for each Pasta alignment, e.g. 4g.
+        ALIGN_CACHE_SIZE (int)    Number of alignments to cache. 0 disables.
+        MAX_DIVERGENCE (float)    Largest p-distance to add a sequence to an
+                                  earlier alignment without realigning.
+        ALIGNER (str)             auto (default), pasta, or prank.
+        SPECIES_TREE (str)        Newick tree of the species, for alignments.
+        SPECIES_TREE_MODE (str)   guide (default) or fixed.
+        ENGINE (str)              LRT engine: hyphy (default) or native.
+        PREDICT_WORKERS (int)     HyPhy processes to test one gene with.
 
     Contains no class attributes.
 
@@ -71,7 +91,9 @@ class SetupEnv(object):
         self.gzip_path = spawn.find_executable('gzip') or ''
         self.sum_path = spawn.find_executable('sum') or ''
         self.tblastx_path = spawn.find_executable('tblastx') or ''
+        self.blastp_path = spawn.find_executable('blastp') or ''
         self.pasta_path = spawn.find_executable('run_pasta.py') or ''
+        self.prank_path = spawn.find_executable('prank') or ''
         self.hyphy_path = spawn.find_executable('HYPHYMP') or spawn.find_executable('hyphymp') or ''
         self.mainlog.debug(
             'Setting executable path variables:\n' +
@@ -79,7 +101,9 @@ class SetupEnv(object):
             '#define GZIP ' + self.gzip_path + '\n' +
             '#define SUM ' + self.sum_path + '\n' +
             '#define TBLASTX ' + self.tblastx_path + '\n' +
+            '#define BLASTP ' + self.blastp_path + '\n' +
             '#define PASTA ' + self.pasta_path + '\n' +
+            '#define PRANK ' + self.prank_path + '\n' +
             '#define HYPHY ' + self.hyphy_path)
         #   Print out some warnings if executables are not found
         if self.bash_path == '':
@@ -97,6 +121,11 @@ class SetupEnv(object):
         if self.hyphy_path == '':
             self.mainlog.warning('Cannot find HyPhy! Will download')
             self.missing_progs.append('HyPhy')
+        if self.blastp_path == '':
+            self.mainlog.info(
+                'Cannot find blastp. Only tblastx searches will be run.')
+        if self.prank_path == '':
+            self.mainlog.info('Cannot find PRANK. Only PASTA will be used.')
         return
 
     def get_deps(self):
@@ -124,7 +153,15 @@ class SetupEnv(object):
         handle.write('#define GZIP ' + self.gzip_path + '\n')
         handle.write('#define SUM ' + self.sum_path + '\n')
         handle.write('#define TBLASTX ' + self.tblastx_path + '\n')
+        #   blastp is optional, and is left out if it was not found, as
+        #   PRANK is below
+        if self.blastp_path:
+            handle.write('#define BLASTP ' + self.blastp_path + '\n')
         handle.write('#define PASTA ' + self.pasta_path + '\n')
+        #   PRANK is optional. A line without a value is not valid, so we
+        #   leave it out, and PRANK is not used, if it was not found.
+        if self.prank_path:
+            handle.write('#define PRANK ' + self.prank_path + '\n')
         handle.write('#define HYPHY ' + self.hyphy_path + '\n')
         handle.flush()
         handle.close()
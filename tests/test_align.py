@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Check how the aligner for a gene family is picked when it is not given."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.Predict import align
+
+
+class TestInputSize(unittest.TestCase):
+    """Counting the sequences of an unaligned FASTA file."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmp, 'family.fasta')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, text):
+        with open(self.fasta, 'w') as f:
+            f.write(text)
+
+    def test_wrapped_sequences(self):
+        self.write('>a\nATGAAA\nCCC\n>b\nATG\n>c\nATGAAACCCGGG\nTT\n')
+        self.assertEqual(align.input_size(self.fasta), (3, 14))
+
+    def test_empty_file(self):
+        self.write('')
+        self.assertEqual(align.input_size(self.fasta), (0, 0))
+
+
+class TestChooseAligner(unittest.TestCase):
+    """PRANK for small families, PASTA for the rest."""
+
+    def test_small_family(self):
+        self.assertEqual(
+            align.choose_aligner(5, 900, ['pasta', 'prank']), 'prank')
+
+    def test_limits(self):
+        n = align.PRANK_MAX_SEQS
+        length = align.PRANK_MAX_LENGTH
+        both = ['pasta', 'prank']
+        self.assertEqual(align.choose_aligner(n, length, both), 'prank')
+        self.assertEqual(align.choose_aligner(n + 1, length, both), 'pasta')
+        self.assertEqual(align.choose_aligner(n, length + 1, both), 'pasta')
+
+    def test_only_one_installed(self):
+        self.assertEqual(align.choose_aligner(5, 900, ['pasta']), 'pasta')
+        self.assertEqual(align.choose_aligner(500, 9000, ['prank']), 'prank')
+
+    def test_every_name_is_an_aligner(self):
+        for name in align.ALIGNERS:
+            self.assertEqual(align.choose_aligner(500, 9000, [name]), name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Check that the alignment pool runs every job, and that a job that fails
+does not stop the others."""
+
+import unittest
+
+from lrt_predict.Predict import align_pool
+
+
+class FakeAligner(object):
+    """Stands in for an Aligner, and records the steps that were run."""
+    MULTITHREADED = False
+
+    def __init__(self, name, n_seqs, fail=False):
+        self.query = '/tmp/' + name + '.fasta'
+        self.n_seqs = n_seqs
+        self.max_length = 300
+        self.fail = fail
+        self.steps = []
+
+    def align(self):
+        self.steps.append('align')
+        return ('out ' + self.query, 'err ' + self.query)
+
+    def back_translate(self):
+        if self.fail:
+            raise IOError('No such file: aligned output of ' + self.query)
+        self.steps.append('back_translate')
+
+    def sanitize_outputs(self):
+        self.steps.append('sanitize_outputs')
+
+
+class TestAlignmentPool(unittest.TestCase):
+    """Run fake jobs through the pool."""
+
+    def setUp(self):
+        self.pool = align_pool.AlignmentPool(2, None, '1g', 'CRITICAL')
+
+    def test_results_in_job_order(self):
+        jobs = [FakeAligner('small', 3), FakeAligner('large', 50)]
+        results = self.pool.align_all(jobs)
+        self.assertEqual(results, [
+            ('out /tmp/small.fasta', 'err /tmp/small.fasta'),
+            ('out /tmp/large.fasta', 'err /tmp/large.fasta')])
+        for job in jobs:
+            self.assertEqual(
+                job.steps, ['align', 'back_translate', 'sanitize_outputs'])
+
+    def test_failed_job_does_not_stop_others(self):
+        jobs = [
+            FakeAligner('first', 10),
+            FakeAligner('broken', 20, fail=True),
+            FakeAligner('last', 5)]
+        results = self.pool.align_all(jobs)
+        self.assertIsNone(results[1])
+        self.assertIsNotNone(results[0])
+        self.assertIsNotNone(results[2])
+        self.assertEqual(jobs[2].steps[-1], 'sanitize_outputs')
+        #   All of the CPUs and memory are given back
+        self.assertEqual(self.pool.running, 0)
+        self.assertEqual(self.pool.used_cpus, 0)
+        self.assertEqual(self.pool.used_memory, 0)
+
+    def test_failed_job_one_worker(self):
+        pool = align_pool.AlignmentPool(1, None, '1g', 'CRITICAL')
+        jobs = [FakeAligner('broken', 20, fail=True), FakeAligner('ok', 5)]
+        results = pool.align_all(jobs)
+        self.assertIsNone(results[0])
+        self.assertIsNotNone(results[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
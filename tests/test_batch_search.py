@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Check that batch searches cluster isoforms, and share the hits of each
+representative only when they can be trusted."""
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from lrt_predict.Blast import batch_search
+
+SEQ = 'ATGAAACCCGGGTTTAAACCCGGGTTTAAACCCGGGTTTAAACCCGGGTTT'
+QUERIES = [
+    ('Gene1.1', SEQ + 'AAACCCGGG'),
+    ('Gene1.2', SEQ + 'AAACCCGGA'),
+    ('Gene1.3', SEQ[:30]),
+    ('Gene2_T01', SEQ + 'TTT'),
+    ('Other', SEQ + 'TTT'),
+    ('Gene3-RA', SEQ)]
+
+
+class TestBatchSearch(unittest.TestCase):
+    """Cluster the queries of a batch, and share the hits of the
+    representatives."""
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        files = []
+        for qid, seq in QUERIES:
+            fname = os.path.join(self.base, qid + '.fasta')
+            with open(fname, 'w') as f:
+                f.write('>' + qid + '\n' + seq + '\n')
+            files.append(fname)
+        self.search = batch_search.BatchBlastSearch(
+            self.base,
+            'Target',
+            files,
+            0.05,
+            'CRITICAL',
+            cpus=1,
+            cache_size=0,
+            orthologs=False,
+            cluster_isoforms=True)
+        #   Searching again records the queries, and gives each its own hit
+        self.searched_again = []
+        searched_again = self.searched_again
+
+        def fake_blast_all(search):
+            searched_again.extend(search.query_files.keys())
+            for qid in search.query_files:
+                search.orthologues[qid] = OrderedDict(
+                    [('db1', ('own_' + qid, 'gb'))])
+        self.real_blast_all = batch_search.BatchBlastSearch.blast_all
+        batch_search.BatchBlastSearch.blast_all = fake_blast_all
+
+    def tearDown(self):
+        batch_search.BatchBlastSearch.blast_all = self.real_blast_all
+        self.search.batch_query.close()
+        shutil.rmtree(self.base)
+
+    def test_clusters(self):
+        self.assertEqual(self.search.members, OrderedDict([
+            ('Gene1.1', ['Gene1.2', 'Gene1.3']),
+            ('Gene2_T01', ['Other']),
+            ('Gene3-RA', [])]))
+
+    def give_hits(self, evalues):
+        """Give each representative a hit in db1, with the given E-value, or
+        no E-value if it is None."""
+        for rep in self.search.members:
+            self.search.orthologues[rep]['db1'] = ('hit_' + rep, 'gb')
+            if evalues.get(rep) is not None:
+                self.search.hit_evalues[(rep, 'db1')] = evalues[rep]
+
+    def test_strong_hits_are_shared(self):
+        self.give_hits({'Gene1.1': 1e-30, 'Gene2_T01': 1e-30})
+        self.search.share_hits()
+        #   Gene1.3 is much shorter than its representative
+        self.assertEqual(self.searched_again, ['Gene1.3'])
+        self.assertEqual(
+            self.search.orthologues['Gene1.2']['db1'][0], 'hit_Gene1.1')
+        self.assertEqual(
+            self.search.orthologues['Other']['db1'][0], 'hit_Gene2_T01')
+        self.assertEqual(
+            self.search.orthologues['Gene1.3']['db1'][0], 'own_Gene1.3')
+
+    def test_weak_hits_are_searched_again(self):
+        self.give_hits({'Gene1.1': 1e-30, 'Gene2_T01': 0.01})
+        self.search.share_hits()
+        self.assertEqual(sorted(self.searched_again), ['Gene1.3', 'Other'])
+        self.assertEqual(
+            self.search.orthologues['Other']['db1'][0], 'own_Other')
+
+    def test_hits_without_evalue_are_searched_again(self):
+        #   As for hits from the hit cache or the ortholog table
+        self.give_hits({'Gene1.1': 1e-30, 'Gene2_T01': None})
+        self.search.share_hits()
+        self.assertEqual(sorted(self.searched_again), ['Gene1.3', 'Other'])
+
+
+if __name__ == '__main__':
+    unittest.main()
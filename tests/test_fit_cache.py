@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Check the keys, reading, and writing of saved background fits."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.Predict import fit_cache
+
+RATES = [0.5, 1.25, 0.75, 2.0, 1.0]
+BRANCHES = [(0.1, 0.5), (0.002, 13.5), (0.3, 0.0)]
+
+
+class TestFitKey(unittest.TestCase):
+    """Keys and names of the saved fits."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        self.msa = os.path.join(self.tmp, 'gene_MSA.fasta')
+        self.tree = os.path.join(self.tmp, 'gene.tree')
+        with open(self.msa, 'w') as f:
+            f.write('>a\nATG\n>b\nATA\n')
+        with open(self.tree, 'w') as f:
+            f.write('(a:0.1,b:0.2);\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_key_parts(self):
+        key = fit_cache.fit_key('hyphy', self.msa, self.tree)
+        self.assertEqual(key, fit_cache.fit_key('hyphy', self.msa, self.tree))
+        self.assertNotEqual(
+            key, fit_cache.fit_key('native', self.msa, self.tree))
+        with open(self.tree, 'w') as f:
+            f.write('(a:0.1,b:0.3);\n')
+        self.assertNotEqual(
+            key, fit_cache.fit_key('hyphy', self.msa, self.tree))
+
+    def test_fit_path(self):
+        os.chdir(self.tmp)
+        self.assertEqual(
+            fit_cache.fit_path('gene_MSA.fasta'), self.msa + '.bgfit')
+
+
+class TestReadWrite(unittest.TestCase):
+    """Fits written to, and read from, a temporary directory."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fit = os.path.join(self.tmp, 'gene_MSA.fasta.bgfit')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip(self):
+        fit_cache.write_fit(self.fit, 'abc', RATES, BRANCHES)
+        self.assertEqual(
+            fit_cache.read_fit(self.fit, 'abc'), (RATES, BRANCHES))
+        #   Only the fit is left behind
+        self.assertEqual(os.listdir(self.tmp), ['gene_MSA.fasta.bgfit'])
+
+    def test_replaces_old_fit(self):
+        fit_cache.write_fit(self.fit, 'abc', RATES, BRANCHES)
+        fit_cache.write_fit(self.fit, 'def', RATES, BRANCHES[:1])
+        self.assertIsNone(fit_cache.read_fit(self.fit, 'abc'))
+        self.assertEqual(
+            fit_cache.read_fit(self.fit, 'def'), (RATES, BRANCHES[:1]))
+
+    def test_other_key(self):
+        fit_cache.write_fit(self.fit, 'abc', RATES, BRANCHES)
+        self.assertIsNone(fit_cache.read_fit(self.fit, 'abd'))
+
+    def test_missing_file(self):
+        self.assertIsNone(fit_cache.read_fit(self.fit, 'abc'))
+
+    def test_cut_short(self):
+        fit_cache.write_fit(self.fit, 'abc', RATES, BRANCHES)
+        with open(self.fit, 'r') as f:
+            lines = f.readlines()
+        for n in range(1, len(lines)):
+            with open(self.fit, 'w') as f:
+                f.writelines(lines[:n])
+            self.assertIsNone(fit_cache.read_fit(self.fit, 'abc'))
+
+    def test_bad_values(self):
+        for text in [
+                'abc\n1.5\n0 0 0 0 0\n1 1\n',
+                'abc\n1\n0 0 0 0 0\n1 x\n',
+                'abc\n1\n0 0 0 0 0\n1 1\n1 1\n']:
+            with open(self.fit, 'w') as f:
+                f.write(text)
+            self.assertIsNone(fit_cache.read_fit(self.fit, 'abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Check the keys, counting, and eviction of the BLAST hit cache."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.Blast import hit_cache
+from lrt_predict.Blast import blast_search
+from lrt_predict.Blast import kmer_index
+
+QUERY = 'ATGAAACCCGGGTTTTAA'
+
+
+class TestHitCache(unittest.TestCase):
+    """Entries in a cache in a temporary base directory."""
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.db = os.path.join(self.base, 'Species_A.fa')
+        with open(self.db, 'w') as f:
+            f.write('>a1\n' + QUERY + '\n')
+        self.cache = hit_cache.HitCache(self.base, 10, 'CRITICAL')
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def count_file(self):
+        return self.cache.read_count()
+
+    def test_get_and_put(self):
+        self.assertEqual(
+            self.cache.get(QUERY, self.db, 0.05, 'tblastx'), (False, None))
+        self.cache.put(QUERY, self.db, 0.05, 'tblastx', 'a1 Species A')
+        self.assertEqual(
+            self.cache.get(QUERY, self.db, 0.05, 'tblastx'),
+            (True, 'a1 Species A'))
+        #   The query is keyed without regard to case
+        self.assertEqual(
+            self.cache.get(QUERY.lower(), self.db, 0.05, 'tblastx'),
+            (True, 'a1 Species A'))
+
+    def test_no_hit(self):
+        self.cache.put(QUERY, self.db, 0.05, 'tblastx', None)
+        self.assertEqual(
+            self.cache.get(QUERY, self.db, 0.05, 'tblastx'), (True, None))
+
+    def test_key_parts(self):
+        key = self.cache.key(QUERY, self.db, 0.05, 'tblastx')
+        self.assertNotEqual(
+            key, self.cache.key(QUERY, self.db, 0.05, 'blastp'))
+        self.assertNotEqual(
+            key, self.cache.key(QUERY, self.db, 0.01, 'tblastx'))
+        self.assertNotEqual(
+            key, self.cache.key(QUERY + 'A', self.db, 0.05, 'tblastx'))
+        #   A rebuilt database has another identity
+        with open(self.db, 'a') as f:
+            f.write('>a2\nATG\n')
+        self.cache.invalidate(self.db)
+        self.assertNotEqual(
+            key, self.cache.key(QUERY, self.db, 0.05, 'tblastx'))
+
+    def test_replaced_entry_is_not_counted(self):
+        self.cache.put(QUERY, self.db, 0.05, 'tblastx', 'a1 Species A')
+        self.assertEqual(self.count_file(), 1)
+        for i in range(5):
+            self.cache.put(QUERY, self.db, 0.05, 'tblastx', 'a1 Species A')
+        self.assertEqual(self.count_file(), 1)
+        self.cache.put(QUERY, self.db, 0.05, 'blastp', 'a1 Species A')
+        self.assertEqual(self.count_file(), 2)
+
+    def test_eviction(self):
+        for i in range(25):
+            self.cache.put(QUERY + 'A' * i, self.db, 0.05, 'tblastx', 'a1')
+        entries = self.cache.list_entries()
+        self.assertTrue(len(entries) <= 10)
+        self.assertEqual(self.count_file(), len(entries))
+        #   The last entry is the most recently used, so it is kept
+        self.assertEqual(
+            self.cache.get(QUERY + 'A' * 24, self.db, 0.05, 'tblastx'),
+            (True, 'a1'))
+
+    def test_invalidate(self):
+        self.cache.put(QUERY, self.db, 0.05, 'tblastx', 'a1')
+        self.cache.invalidate(self.db)
+        self.assertEqual(self.cache.list_entries(), [])
+        self.assertIsNone(self.count_file())
+        self.assertEqual(
+            self.cache.get(QUERY, self.db, 0.05, 'tblastx'), (False, None))
+
+
+class TestCacheKey(unittest.TestCase):
+    """The program names that BlastSearch keys cached hits on."""
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.db = os.path.join(self.base, 'Species_A.fa')
+        self.query = os.path.join(self.base, 'query.fasta')
+        with open(self.db, 'w') as f:
+            f.write('>a1\n' + QUERY + '\n')
+        with open(self.query, 'w') as f:
+            f.write('>q1\n' + QUERY + '\n')
+        #   An index that is newer than the database
+        with open(kmer_index.index_name(self.db), 'w') as f:
+            f.write('')
+        mtime = os.path.getmtime(self.db)
+        os.utime(kmer_index.index_name(self.db), (mtime + 10, mtime + 10))
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def search(self, prefilter):
+        return blast_search.BlastSearch(
+            self.base,
+            'Target',
+            self.query,
+            0.05,
+            'CRITICAL',
+            cpus=1,
+            cache_size=0,
+            orthologs=False,
+            prefilter=prefilter)
+
+    def test_without_prefilter(self):
+        self.assertEqual(
+            self.search(None).cache_key(self.db, 'tblastx'), 'tblastx')
+
+    def test_prefilter_size_in_key(self):
+        key_50 = self.search(50).cache_key(self.db, 'tblastx')
+        key_200 = self.search(200).cache_key(self.db, 'tblastx')
+        self.assertNotEqual(key_50, 'tblastx')
+        self.assertNotEqual(key_50, key_200)
+        self.assertEqual(key_50, self.search(50).cache_key(self.db, 'tblastx'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Check that LRT.hyphy in server mode writes the same reports as separate
+runs of it. Needs HyPhy, named by the HYPHY environment variable or found as
+HYPHYMP, HYPHYSP, or hyphy, and stdbuf."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.General import check_modules
+from lrt_predict.Predict import predict
+from lrt_predict.Predict import hyphy_pool
+
+TEST_DATA = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'Test_Data')
+GENES = ['CBF3', 'STK']
+
+
+def find_hyphy():
+    for name in [os.environ.get('HYPHY'), 'HYPHYMP', 'HYPHYSP', 'hyphy']:
+        if name and check_modules.check_executable(name):
+            return check_modules.check_executable(name)
+    return None
+
+
+#   Lines that differ between runs of the same gene
+def report_lines(fname):
+    with open(fname, 'r') as f:
+        return [
+            l.rstrip() for l in f
+            if l.strip() and not l.startswith('CPU time taken')]
+
+
+@unittest.skipUnless(
+    find_hyphy() and check_modules.check_executable('stdbuf'),
+    'HyPhy or stdbuf not found')
+class TestHyPhyServer(unittest.TestCase):
+    """Two genes through one server process, against one process each."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.hyphy = find_hyphy()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def prepare(self, gene):
+        """Copy a gene, so that its saved fit does not go into Test_Data,
+        and write its HyPhy input. The background model is fit in both
+        runs."""
+        msa = os.path.join(self.tmp, gene + '_MSA.fasta')
+        tree = os.path.join(self.tmp, gene + '.tree')
+        shutil.copy(os.path.join(TEST_DATA, 'MSA', gene + '_MSA.fasta'), msa)
+        shutil.copy(os.path.join(TEST_DATA, 'Tree', gene + '.tree'), tree)
+        lrt = predict.LRTPredict(
+            self.hyphy,
+            msa,
+            tree,
+            os.path.join(TEST_DATA, gene + '.fasta'),
+            os.path.join(TEST_DATA, gene + '.subs'),
+            'WARNING',
+            refit=True)
+        lrt.get_query_position()
+        lrt.get_aligned_positions()
+        lrt.prepare_hyphy_inputs()
+        return lrt
+
+    def test_server_matches_separate_runs(self):
+        separate = []
+        for gene in GENES:
+            lrt = self.prepare(gene)
+            lrt.run_hyphy(lrt.hyphy_input, lrt.hyphy_output)
+            separate.append(report_lines(lrt.hyphy_output.name))
+        lrts = [self.prepare(gene) for gene in GENES]
+        pool = hyphy_pool.HyPhyWorkerPool(self.hyphy, 1, 'WARNING')
+        try:
+            finished = pool.run_all(
+                [(lrt.hyphy_input, lrt.hyphy_output) for lrt in lrts])
+        finally:
+            pool.close()
+        self.assertEqual(finished, [True, True])
+        for lrt, lines in zip(lrts, separate):
+            self.assertEqual(report_lines(lrt.hyphy_output.name), lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Tests for Aligner.incremental_update."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.Predict import align
+from lrt_predict.Predict import profile_align
+
+#   Coding sequences of a small gene family, each with a trailing stop codon
+CDS = [
+    ('SpeciesA', 'ATGGCTAAAGGTCTGGAACGTTTCATTGACCCGTGGTAA'),
+    ('SpeciesB', 'ATGGCTAAAGGTCTGGAACGTTTTATTGACCCGTGGTAA'),
+    ('SpeciesC', 'ATGGCCAAAGGTCTGGAGCGTTTCATTGACCCATGGTGA'),
+    ]
+ADDED = ('SpeciesD', 'ATGGCTAAAGGCCTGGAACGTTTCATTGATCCGTGGTAG')
+TREE = '(SpeciesA:0.1,SpeciesB:0.1,SpeciesC:0.2);\n'
+
+
+class TestIncrementalUpdate(unittest.TestCase):
+    """Update an alignment made without the stop codons, as
+    back-translation writes it."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.old_msa = os.path.join(self.tmp, 'old.fasta')
+        with open(self.old_msa, 'w') as f:
+            for name, cds in CDS:
+                f.write('>' + name + '\n' + cds[:-3] + '\n')
+        self.old_tree = os.path.join(self.tmp, 'old.tre')
+        with open(self.old_tree, 'w') as f:
+            f.write(TREE)
+        self.added = []
+        self.unaligned = None
+        self.add_sequences = profile_align.add_sequences
+
+        def record(aligned, new):
+            self.added.extend([name for name, cds, prot in new])
+            return self.add_sequences(aligned, new)
+        profile_align.add_sequences = record
+
+    def tearDown(self):
+        profile_align.add_sequences = self.add_sequences
+        if self.unaligned:
+            self.unaligned.close()
+        shutil.rmtree(self.tmp)
+
+    def aligner(self, seqs):
+        unaligned = tempfile.NamedTemporaryFile(
+            mode='w+t',
+            suffix='.fasta',
+            dir=self.tmp)
+        unaligned.write(''.join(['>' + n + '\n' + s + '\n' for n, s in seqs]))
+        unaligned.flush()
+        aln = align.PastaAlign('pasta', unaligned, None, 'WARNING')
+        aln.prepare_sequences()
+        self.unaligned = unaligned
+        return aln
+
+    def test_unchanged_family_is_not_realigned(self):
+        aln = self.aligner(CDS)
+        self.assertTrue(aln.incremental_update(self.old_msa, self.old_tree))
+        self.assertEqual(self.added, [])
+        updated = profile_align.read_alignment(aln.final_aln)
+        for name, cds in CDS:
+            self.assertEqual(updated[name], cds[:-3])
+        os.remove(aln.final_aln)
+        shutil.rmtree(aln.work_dir)
+
+    def test_added_sequence_is_profile_aligned(self):
+        aln = self.aligner(CDS + [ADDED])
+        self.assertTrue(aln.incremental_update(self.old_msa, self.old_tree))
+        self.assertEqual(self.added, [ADDED[0]])
+        updated = profile_align.read_alignment(aln.final_aln)
+        self.assertEqual(updated[ADDED[0]], ADDED[1][:-3])
+        os.remove(aln.final_aln)
+        shutil.rmtree(aln.work_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
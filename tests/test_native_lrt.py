@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Check the total dN and dS of the native engine against a report written by
+LRT.hyphy."""
+
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from lrt_predict.Predict import native_lrt
+
+TEST_DATA = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'Test_Data')
+
+
+class TestSiteCounts(unittest.TestCase):
+    """Synonymous and nonsynonymous sites of single codons."""
+
+    def sites(self, codon):
+        i = native_lrt.CODON_INDEX[codon]
+        return (native_lrt.SYN_SITES[i], native_lrt.NONSYN_SITES[i])
+
+    def test_no_synonymous_sites(self):
+        self.assertEqual(self.sites('ATG'), (0.0, 3.0))
+
+    def test_fourfold_and_first_position(self):
+        #   CTN is leucine, and so is TTG
+        syn, nonsyn = self.sites('CTG')
+        self.assertAlmostEqual(syn, 4.0 / 3)
+        self.assertAlmostEqual(nonsyn, 5.0 / 3)
+
+    def test_changes_to_stops(self):
+        #   TGG to TAG and TGA are stops, and count as neither
+        syn, nonsyn = self.sites('TGG')
+        self.assertAlmostEqual(syn, 0.0)
+        self.assertAlmostEqual(nonsyn, 7.0 / 3)
+
+
+class TestTotalDnDs(unittest.TestCase):
+    """With the parameters that HyPhy fit to CBF3, the totals are the ones
+    in the HyPhy report."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        msa = os.path.join(self.tmp, 'CBF3_MSA.fasta')
+        tree = os.path.join(self.tmp, 'CBF3.tree')
+        shutil.copy(os.path.join(TEST_DATA, 'MSA', 'CBF3_MSA.fasta'), msa)
+        shutil.copy(os.path.join(TEST_DATA, 'Tree', 'CBF3.tree'), tree)
+        self.lrt = native_lrt.NativeLRT(
+            msa,
+            tree,
+            os.path.join(TEST_DATA, 'CBF3.fasta'),
+            os.path.join(TEST_DATA, 'CBF3.subs'),
+            'CRITICAL')
+        with open(os.path.join(
+                TEST_DATA, 'Reports', 'CBF3_Predictions.txt')) as f:
+            self.report = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def value(self, name):
+        return float(re.search(
+            re.escape(name) + r'[=:] ?([^;\n]+)', self.report).group(1))
+
+    def test_totals_match_hyphy(self):
+        rates = [self.value('global ' + r) for r in native_lrt.RATE_NAMES]
+        model = native_lrt.CodonModel(self.lrt.nucleotide_frequencies(), rates)
+        n_nodes = len(self.lrt.topo.names)
+        syn = numpy.zeros(n_nodes)
+        ns = numpy.zeros(n_nodes)
+        for node, name in enumerate(self.lrt.topo.names):
+            if node == self.lrt.topo.root:
+                continue
+            syn[node] = self.value('givenTree.' + name + '.synRate')
+            ns[node] = self.value('givenTree.' + name + '.nsClass1')
+        self.lrt.background = native_lrt.CodonLikelihood(
+            self.lrt.topo, model, {}, [], syn, ns)
+        dn, ds = self.lrt.total_dn_ds()
+        self.assertAlmostEqual(dn, self.value('Total dN'), places=10)
+        self.assertAlmostEqual(ds, self.value('Total dS'), places=10)
+        self.assertAlmostEqual(
+            dn / ds, self.value('Total dN/dS'), places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""Check that the reports of the HyPhy shards are merged into the report that
+one HyPhy process would have written."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lrt_predict.Predict import predict
+
+TEST_DATA = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+    'Test_Data')
+
+
+class TestMergeShards(unittest.TestCase):
+    """Split the CBF3 report into shards, and merge them again."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        msa = os.path.join(self.tmp, 'CBF3_MSA.fasta')
+        shutil.copy(os.path.join(TEST_DATA, 'MSA', 'CBF3_MSA.fasta'), msa)
+        self.lrt = predict.LRTPredict(
+            None,
+            msa,
+            os.path.join(TEST_DATA, 'Tree', 'CBF3.tree'),
+            os.path.join(TEST_DATA, 'CBF3.fasta'),
+            os.path.join(TEST_DATA, 'CBF3.subs'),
+            'CRITICAL')
+        with open(os.path.join(
+                TEST_DATA, 'Reports', 'CBF3_Predictions.txt')) as f:
+            self.report = f.read().splitlines()
+        self.head = [
+            i for i, l in enumerate(self.report)
+            if l.startswith('Position')][0]
+        self.tail = [
+            i for i, l in enumerate(self.report)
+            if l.startswith('Alignment')][0]
+        self.shards = []
+
+    def tearDown(self):
+        for shard in self.shards:
+            shard.close()
+        shutil.rmtree(self.tmp)
+
+    def shard(self, tested, seconds):
+        """Write the report of a shard that only tested the positions in
+        tested. The other positions get NOSNP lines."""
+        lines = []
+        for l in self.report[self.head+1:self.tail]:
+            fields = l.split('\t')
+            if fields[0] in tested or 'NOSNP' in l:
+                lines.append(l)
+            else:
+                lines.append('\t'.join(fields[:1] + fields[7:9] + ['NOSNP']))
+        trailer = [
+            'CPU time taken for sites: ' + seconds + ' seconds.'
+            if l.startswith('CPU time taken for sites:') else l
+            for l in self.report[self.tail:]]
+        shard = tempfile.NamedTemporaryFile(mode='w+t', dir=self.tmp)
+        shard.write('\n'.join(
+            self.report[:self.head+1] + lines + trailer) + '\n')
+        shard.flush()
+        self.shards.append(shard)
+        return shard
+
+    def test_merged_report(self):
+        tested = [
+            l.split('\t')[0] for l in self.report[self.head+1:self.tail]
+            if 'NOSNP' not in l]
+        self.assertTrue(len(tested) > 1)
+        outputs = [
+            self.shard(tested[0::2], '4.25'),
+            self.shard(tested[1::2], '6.0')]
+        merged = self.lrt.merge_shards(outputs)
+        merged.seek(0)
+        lines = merged.read().splitlines()
+        merged.close()
+        expected = [
+            'CPU time taken for sites: 10.25 seconds.'
+            if l.startswith('CPU time taken for sites:') else l
+            for l in self.report]
+        self.assertEqual(lines, expected)
+
+    def test_unfinished_shard(self):
+        shard = tempfile.NamedTemporaryFile(mode='w+t', dir=self.tmp)
+        shard.write('\n'.join(self.report[:self.head+5]) + '\n')
+        shard.flush()
+        self.shards.append(shard)
+        with self.assertRaises(SystemExit):
+            self.lrt.merge_shards([self.shard([], '1.0'), shard])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Check that `setup' writes a configuration file that can be read when the
+optional programs are not installed."""
+
+import os
+import tempfile
+import unittest
+
+from lrt_predict.Setup import setup_env
+from lrt_predict.Setup import parse_config
+
+
+class TestSetupEnv(unittest.TestCase):
+    """Write a configuration without blastp and PRANK, and read it back."""
+
+    def setUp(self):
+        handle, self.cfg = tempfile.mkstemp(suffix='.txt')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.cfg)
+
+    def write(self, blastp, prank):
+        env = setup_env.SetupEnv(
+            '/tmp', '/tmp', 'Hordeum_vulgare', 0.05, self.cfg, 'CRITICAL')
+        #   The required programs may not be installed where the tests run
+        for prog in ['bash', 'gzip', 'sum', 'tblastx', 'pasta', 'hyphy']:
+            setattr(env, prog + '_path', '/usr/bin/' + prog)
+        env.blastp_path = blastp
+        env.prank_path = prank
+        env.write_config()
+        handler = parse_config.ConfigHandler(self.cfg, {}, 'CRITICAL')
+        self.assertTrue(handler.is_valid())
+        handler.read_vars()
+        return handler.config_vars
+
+    def test_optional_programs_missing(self):
+        config = self.write('', '')
+        self.assertNotIn('blastp_path', config)
+        self.assertNotIn('prank_path', config)
+
+    def test_optional_programs_found(self):
+        config = self.write('/usr/bin/blastp', '/usr/bin/prank')
+        self.assertEqual(config['blastp_path'], '/usr/bin/blastp')
+        self.assertEqual(config['prank_path'], '/usr/bin/prank')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Check the table-driven codon translator against the edge cases of the
+sequences that come out of the species databases."""
+
+import unittest
+
+from lrt_predict.General import translation
+
+
+class TestTranslate(unittest.TestCase):
+    """Translation of single codons and whole sequences."""
+
+    def test_case(self):
+        self.assertEqual(translation.translate('ATGAAA'), 'MK')
+        self.assertEqual(translation.translate('atgaaa'), 'MK')
+        self.assertEqual(translation.translate('AtGaAa'), 'MK')
+
+    def test_ambiguous_codons(self):
+        #   Every codon that GCN stands for is alanine, and TAR is always a
+        #   stop, but ATN could be isoleucine or methionine
+        self.assertEqual(translation.translate('GCN'), 'A')
+        self.assertEqual(translation.translate('TAR'), '*')
+        self.assertEqual(translation.translate('ATN'), 'X')
+        self.assertEqual(translation.translate('UUU'), 'F')
+
+    def test_gaps_and_partial_codons(self):
+        self.assertEqual(translation.translate('A-GAAA'), 'XK')
+        self.assertEqual(translation.translate('ATGAA'), 'M')
+        self.assertEqual(translation.translate(''), '')
+
+
+class TestTranslateCDS(unittest.TestCase):
+    """Padding and stop codon screening of a CDS."""
+
+    def test_trailing_stop_is_dropped(self):
+        self.assertEqual(
+            translation.translate_cds('ATGAAATAA'), ('ATGAAATAA', 'MK'))
+
+    def test_internal_stop(self):
+        self.assertEqual(
+            translation.translate_cds('ATGTAAATG'), ('ATGTAAATG', None))
+
+    def test_mixed_case_internal_stop(self):
+        self.assertEqual(
+            translation.translate_cds('ATGTaAATG'), ('ATGTaAATG', None))
+        self.assertEqual(
+            translation.translate_cds('ATGtGAAAA'), ('ATGtGAAAA', None))
+
+    def test_mixed_case_trailing_stop(self):
+        self.assertEqual(
+            translation.translate_cds('ATGAAAtaG'), ('ATGAAAtaG', 'MK'))
+
+    def test_padding(self):
+        self.assertEqual(
+            translation.translate_cds('ATGAAAG'), ('ATGAAAGNN', 'MKX'))
+        self.assertEqual(
+            translation.translate_cds('ATGAAAGC'), ('ATGAAAGCN', 'MKA'))
+
+
+if __name__ == '__main__':
+    unittest.main()